@@ -5,26 +5,64 @@ from builtins import range
 from builtins import object
 
 import os.path
+import queue
 import re
+import threading
 import time
 
-import fitsio
 import astropy.io.fits as pyfits
 
+from hxActor.Commands import cardTable
+from hxActor.charis import readStacker
+
 import opscore.protocols.keys as keys
 import opscore.protocols.types as types
 
 try:
-    import actorcore.utility.fits as actorFits
     import hxActor.charis.winFiles as winFiles
     import hxActor.charis.subaru as subaru
     import hxActor.charis.scexao as scexao
-    reload(winFiles)
-    reload(subaru)
-    reload(scexao)
-except:
+except ImportError:
     pass
 
+class PreparedRamp(threading.Thread):
+    def __init__(self, charisCmd, exptype='TEST', cmd=None):
+        """ Allocate the filename and fetch the header of the next ramp, in the background. """
+
+        super(PreparedRamp, self).__init__(name='prepareRamp', daemon=True)
+        self.charisCmd = charisCmd
+        self.exptype = exptype
+        self.cmd = cmd
+
+        self.outfile = None
+        self.seqno = None
+        self.header = None
+        self.error = None
+        self.prepTime = None
+        self.start()
+
+    def run(self):
+        t0 = time.time()
+        try:
+            fileGenerator = self.charisCmd.fileGenerator
+            self.outfile = fileGenerator.getNextFileset()[0]
+            self.seqno = fileGenerator.seqno
+            self.header = self.charisCmd.getHeader(self.seqno, exptype=self.exptype, cmd=self.cmd)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.prepTime = time.time() - t0
+
+    def wait(self, timeout=None):
+        """ Return self once the ramp is prepared. Raises RuntimeError on timeout or failure. """
+
+        self.join(timeout)
+        if self.is_alive():
+            raise RuntimeError('timed out (%ss) preparing ramp' % (timeout))
+        if self.error is not None:
+            raise RuntimeError('failed to prepare ramp: %s' % (self.error))
+        return self
+
 class CharisCmd(object):
 
     def __init__(self, actor):
@@ -82,6 +120,7 @@ class CharisCmd(object):
 
         self.backend = 'hxhal'
         self.rampConfig = None
+        self.charisCardTable = cardTable.CardTable(cardTable.charisCardSpecs, logger=self.logger)
 
         self.dataRoot = "/home/data/charis"
         self.dataPrefix = "CRSA"
@@ -89,6 +128,29 @@ class CharisCmd(object):
         from hxActor.charis import seqPath
         self.fileGenerator = seqPath.NightFilenameGen(self.dataRoot,
                                                       filePrefix=self.dataPrefix)
+
+        # SCExAO cards are fetched in the background, so that building a header never waits on them.
+        scexaoConfig = getattr(self.actor, 'actorConfig', dict()).get('scexao', dict())
+        try:
+            self.scexaoCards = scexao.cardCache(self.actor,
+                                                host=scexaoConfig.get('host', scexao.HOST),
+                                                port=int(scexaoConfig.get('port', scexao.PORT)),
+                                                ttl=float(scexaoConfig.get('ttl', 30.0)))
+        except Exception as e:
+            self.logger.warning(f'failed to start SCExAO card cache: {e}')
+            self.scexaoCards = None
+
+        # The IDL output watcher runs for the life of the actor, across command reloads.
+        self.winRoot = '/home/data/wincharis/H2RG-C17206-ASIC-104'
+        self.fileWatcher = getattr(self.actor, 'winFileWatcher', None)
+        if self.fileWatcher is None:
+            try:
+                self.fileWatcher = winFiles.WinFileWatcher(self.winRoot)
+                self.fileWatcher.start()
+                self.actor.winFileWatcher = self.fileWatcher
+            except Exception as e:
+                self.logger.warning(f'failed to start IDL file watcher on {self.winRoot}: {e}')
+                self.fileWatcher = None
         
     @property
     def controller(self):
@@ -228,15 +290,7 @@ class CharisCmd(object):
             raise RuntimeError("unknown expType %s" % (expType))
         
     def flushProgramInput(self, cmd, doFinish=True):
-        debris = ''
-        while True:
-            try:
-                ret = self.controller.getOneChar(timeout=0.2)
-                debris = debris + ret
-            except RuntimeError:
-                break
-            except:
-                raise
+        debris = self.controller.flushInput(timeout=0.2, cmd=cmd)
 
         if debris != '':
             cmd.warn('text="flushed stray input: %r"' % (debris))
@@ -244,35 +298,24 @@ class CharisCmd(object):
         if doFinish:
             cmd.finish()
 
-    def _consumeRead(self, path, cmd, header=None):
+    def _reportRead(self, stacker, path, dt, cmd):
         #  /home/data/wincharis/H2RG-C17206-ASIC-104/UpTheRamp/20160712210126/H2RG_R01_M01_N01.fits
-        dirName, fileName = os.path.split(path)
-        cmd.diag('text="checking %s"' % (fileName))
-        match = re.match('^H2RG_R0*(\d+)_M0*(\d+)_N0*(\d+)\.fits', fileName)
+        fileName = os.path.basename(path)
+        match = re.match(r'^H2RG_R0*(\d+)_M0*(\d+)_N0*(\d+)\.fits', fileName)
         if match is None:
-            cmd.warn("failed to split up filename: %s" % (file))
+            cmd.warn('text="failed to split up filename: %s"' % (fileName))
             return
         rampN, groupN, readN = [int(m) for m in match.group(1,2,3)]
-        cmd.diag('text="new read %d %d %d"' % (rampN, groupN, readN))
-        if readN == 1:
-            if header is not None:
-                cmd.diag('text="getting header"')
-                subaruHdr = header
-            else:
-                subaruHdr = pyfits.Header()
-            cards = [dict(name='IDLPATH', value=dirName)]
-            for c in subaruHdr.cards:
-                cards.append(dict(name=c.keyword, value=c.value, comment=c.comment))
-            phdu = fitsio.FITSHDR(cards)
-            fitsio.write(self.outfile, None, header=phdu, clobber=True)
-            cmd.diag('text="new file %s"' % (self.outfile))
-            
-        inData, inHdr = fitsio.read(path, header=True)
-        stackFile = fitsio.FITS(self.outfile, mode='rw')
-        stackFile.write(inData, header=inHdr)
-        stackFile[-1].write_checksum()
-        stackFile.close()
-        cmd.inform('readN=%d,%d,%d,%s' % (rampN,groupN,readN,self.outfile))
+        cmd.diag('text="stacked read %d in %0.3fs"' % (readN, dt))
+        cmd.inform('readN=%d,%d,%d,%s' % (rampN,groupN,readN,stacker.outfile))
+
+    def _reportRamp(self, stacker, cmd):
+        if stacker.ingestTimes:
+            cmd.diag('text="%s: %d reads, ingest ms mean=%0.1f max=%0.1f"' %
+                     (stacker.outfile, stacker.nreads,
+                      1000*sum(stacker.ingestTimes)/len(stacker.ingestTimes),
+                      1000*max(stacker.ingestTimes)))
+        cmd.inform('filename=%s' % (stacker.outfile))
 
     def getSubaruHeader(self, frameId, timeout=1.0,
                         fullHeader=True, exptype='TEST', cmd=None):
@@ -281,78 +324,19 @@ class CharisCmd(object):
         if exptype.lower() == 'nohdr':
             return pyfits.Header()
         
-        headerTask = subaru.FetchHeader(fullHeader=True, frameId=frameId, itime=itime, exptype=exptype)
-        self.logger.debug('text="starting header task timeout=%s frameId=%s"' % (timeout, frameId))
-        headerTask.start()
-        headerQ = headerTask.q
-        self.logger.info('text="header q: %s"' % (headerQ))
-        
         try:
-            hdrString = headerQ.get(True, timeout)
-            if hdrString is None:
-                self.logger.debug('text=".get header: %s"' % (hdrString))
-            else:
-                self.logger.debug('text=".get header: %s"' % (len(hdrString)))
+            hdr = subaru.headerClient(self.actor).fetch(frameId, exptype=exptype, itime=itime,
+                                                        fullHeader=True, timeout=timeout)
         except Exception as e:
             self.logger.warn('text="failed to .getHeader header: %s"' % (e))
             cmd.warn('text="failed to .getHeader header: %s"' % (e))
-            hdrString = ''
-        finally:
-            headerTask.terminate()
-            time.sleep(0.1)
+            hdr = pyfits.Header()
 
-        hdr = pyfits.Header.fromstring(hdrString)
-        
         return hdr
 
     def getCharisCards(self, cmd):
         charisModel = self.actor.models['charis'].keyVarDict
-        cards = []
-
-        cards.append(actorFits.makeCardFromKey(cmd, charisModel,
-                                               'grism', 'Y_GRISM', idx=0,
-                                               comment='deprecated: grism position'))
-        cards.append(actorFits.makeCardFromKey(cmd, charisModel,
-                                               'grism', 'Y_PRISM', idx=0,
-                                               comment='prism position'))
-        # Was CHARIS.FILTER.NAME
-        cards.append(actorFits.makeCardFromKey(cmd, charisModel,
-                                               'filterSlot', 'Y_FLTNAM', idx=1,
-                                               comment='current filter name'))
-        # Was CHARIS.FILTER.SLOT
-        cards.append(actorFits.makeCardFromKey(cmd, charisModel,
-                                               'filterSlot', 'Y_FLTSLT', cnv=int, idx=0,
-                                               comment='current filter slot'))
-        # Was CHARIS.SHUTTER
-        cards.append(actorFits.makeCardFromKey(cmd, charisModel,
-                                               'shutter', 'Y_SHUTTR', idx=1,
-                                               comment='shutter position'))
-        # Was CHARIS.LASER.ENABLED
-        cards.append(actorFits.makeCardFromKey(cmd, charisModel,
-                                               'laserState', 'Y_LSRENB', cnv=bool, idx=0,
-                                               comment='is laserState enabled'))
-        # Was CHARIS.LASER.POWER
-        cards.append(actorFits.makeCardFromKey(cmd, charisModel,
-                                               'laserState', 'Y_LSRPWR', idx=2,
-                                               comment='laser power, percent'))
-        # Was CHARIS.LASER.ALARMS
-        cards.append(actorFits.makeCardFromKey(cmd, charisModel,
-                                               'laserState', 'Y_LSRALM', idx=3,
-                                               comment='laser alarms'))
-        # Was CHARIS.TEMPS.%d
-        for i in range(10):
-            cards.append(actorFits.makeCardFromKey(cmd, charisModel,
-                                                   'temps', 'Y_TEMP%02d'%i, idx=i,
-                                                   comment='temperature sensor %d'%i))
-
-        # Add global Subaru aliases
-        cards.append(actorFits.makeCardFromKey(cmd, charisModel,
-                                               'filterSlot', 'FILTER01', idx=1,
-                                               comment='current filter name'))
-        cards.append(actorFits.makeCardFromKey(cmd, charisModel,
-                                               'grism', 'DISPERSR', idx=0,
-                                               comment='prism position'))
-        return cards
+        return self.charisCardTable.cards(charisModel, cmd=cmd)
         
     def getHeader(self, frameId, fullHeader=True,
                   exptype='TEST', objname='TEST',
@@ -367,18 +351,11 @@ class CharisCmd(object):
             hdr = pyfits.Header()
 
         hdr.set('OBJECT', objname, before=1)
-        hxCards = self.getHxCards(cmd)
-        for c in hxCards:
-            hdr.append(c)
-        
-        scexaoCards = self.getSCExAOCards(cmd)
-        for c in scexaoCards:
-            hdr.append(c)
-        
-        charisCards = self.getCharisCards(cmd)
-        for c in charisCards:
-            hdr.append(c)
-        
+        cards = self.getHxCards(cmd)
+        cards.extend(self.getSCExAOCards(cmd))
+        cards.extend(self.getCharisCards(cmd))
+        cardTable.addCards(hdr, cards)
+
         return hdr
 
     def getCharisHeader(self, seqno=None,
@@ -392,74 +369,107 @@ class CharisCmd(object):
         return []
     
     def getSCExAOCards(self, cmd=None):
-        hdr = []
-        try:
-            hdr = scexao.fetchHeader()
-        except:
-            pass
+        """ Return the latest SCExAO cards, which are refreshed in the background. """
 
-        return hdr
+        if self.scexaoCards is None:
+            return []
+        cards = self.scexaoCards.cards()
+        if cmd is not None and self.scexaoCards.lastError is not None:
+            cmd.warn('text="SCExAO cards are %s old: %s"' % (cards[-1].value, self.scexaoCards.lastError))
+        return cards
     
     def _consumeRamps(self, nramp, ngroup, nreset, nread, ndrop, cmd, timeLimits=None):
+        """ Stack the reads of nramp IDL ramps as they appear, into one file per ramp.
+
+        The event loop here only counts reads and hands them on:
+          - the filename and header of each ramp after the first are prepared
+            in a `PreparedRamp` thread while the previous ramp is read out,
+            starting at its next-to-last read so that the header is fresh.
+          - the reads are stacked by a `readStacker.StackWorker`.
+
+        At the first read of each ramp after the first, we report
+        rampGap=rampN,gap,prepWait,backlog: the seconds since the last read
+        of the previous ramp, how many of those we spent waiting for this
+        ramp to be prepared, and how many stacking jobs were still queued.
+        """
         if timeLimits is None:
             timeLimits = (nreset*1.5+15,
                           nread*1.5+10)
 
-        root = '/home/data/wincharis/H2RG-C17206-ASIC-104'
-        cmd.debug('text="starting winFiles i=on %s with timeout=%s"' % (root, timeLimits[0]))
-        fileAlerts = hxActor.winFiles.FileAlert(root, timeLimit=timeLimits[0])
-        fileQ = fileAlerts.q
-        fileAlerts.start()
+        if self.fileWatcher is None or not self.fileWatcher.is_alive():
+            cmd.warn('text="no IDL file watcher running on %s"' % (self.winRoot))
+            return
+        fileQ = self.fileWatcher.q
+
+        # Events from before this command are from some other ramp.
+        t0 = time.time()
+
+        stackWorker = readStacker.StackWorker(readCB=lambda stacker, path, dt: self._reportRead(stacker, path,
+                                                                                                dt, cmd),
+                                              rampCB=lambda stacker: self._reportRamp(stacker, cmd),
+                                              errorCB=lambda e: cmd.warn('text="failed to stack read: %s"' % (e)),
+                                              logger=self.logger)
+        stackWorker.start()
 
+        nextRamp = PreparedRamp(self, cmd=cmd)
+        thisRamp = None
         try:
             rampsDone = 0
             readsDone = 0
-            cmd.inform('text="ramp %d/%d starting %d resets..."' % (rampsDone+1, nramp, nreset))
-            self.outfile = self.fileGenerator.getNextFileset()[0]
-            cmd.inform('text="new filename %s"' % (self.outfile))
-            try:
-                header = self.getHeader(self.fileGenerator.seqno, nread*self.readTime, cmd=cmd)
-                cmd.debug('text="header process returned %s"' % (None if header is None else len(header)))
-            except Exception as e:
-                cmd.warn('text="failed to start header process: %s"' % (e))
-                header = None
-            
+            lastReadTime = None
             while rampsDone < nramp:
+                if thisRamp is None:
+                    cmd.inform('text="ramp %d/%d starting %d resets..."' % (rampsDone+1, nramp, nreset))
+                    tWait = time.time()
+                    thisRamp = nextRamp.wait(timeLimits[0])
+                    prepWait = time.time() - tWait
+                    nextRamp = None
+                    self.outfile = thisRamp.outfile
+                    cmd.diag('text="new filename %s, prepared in %0.2fs"' % (self.outfile, thisRamp.prepTime))
+
+                if nextRamp is None and rampsDone + 1 < nramp and readsDone >= nread - 1:
+                    nextRamp = PreparedRamp(self, cmd=cmd)
+
                 if readsDone == 0:
                     cmd.debug('text="waiting for filesys event...')
                 event = fileQ.get(timeout=timeLimits[0])
+                if event.time < t0:
+                    continue
 
-                cmd.debug('text="filesys event: %s"' % (event))
-                fileOrDir, action, path = event.split()
+                cmd.debug('text="filesys event: %s"' % (str(event)))
+                if event.kind != 'file' or event.action != 'done':
+                    continue
+
+                path = event.path
+                cmd.debug('text="new read (%d/%d in ramp %d/%d): %s"' % (readsDone+1,nread,
+                                                                         rampsDone+1,nramp,
+                                                                         path))
+                if readsDone == 0:
+                    if lastReadTime is not None:
+                        cmd.inform('rampGap=%d,%0.3f,%0.3f,%d' % (rampsDone+1, event.time - lastReadTime,
+                                                                  prepWait, stackWorker.backlog))
+                    cards = [dict(name='IDLPATH', value=os.path.dirname(path))]
+                    for c in thisRamp.header.cards:
+                        cards.append(dict(name=c.keyword, value=c.value, comment=c.comment))
+                    stackWorker.startRamp(thisRamp.outfile, cards)
+                stackWorker.addRead(path)
+                readsDone += 1
+                lastReadTime = event.time
 
-                if fileOrDir == 'file' and action == 'done':
-                    cmd.debug('text="new read (%d/%d in ramp %d/%d): %s"' % (readsDone+1,nread,
-                                                                             rampsDone+1,nramp,
-                                                                             path))
-                    readsDone += 1
-                    self._consumeRead(path, cmd, header)
-                    
                 if readsDone >= nread:
+                    stackWorker.endRamp()
                     rampsDone += 1
                     readsDone = 0
-                    cmd.inform('filename=%s' % (self.outfile))
-                    self.outfile = None
-                    if rampsDone < nramp:
-                        cmd.inform('text="ramp %d/%d starting %d resets..."' % (rampsDone+1, nramp, nreset))
-                        self.outfile = self.fileGenerator.getNextFileset()[0]
-                        cmd.diag('text="new filename %s"' % (self.outfile))
-                        try:
-                            header = self.getHeader(self.fileGenerator.seqno, nread*self.readTime, cmd=cmd)
-                        except Exception as e:
-                            cmd.warn('text="failed to start header process: %s"' % (e))
-                            header = None
-                        
+                    thisRamp = None
+
+        except queue.Empty:
+            cmd.warn('text="timed out (%ss) waiting for IDL files"' % (timeLimits[0]))
         except Exception as e:
-            cmd.warn('winfile readers failed with %s' % (e))
-            fileAlerts.terminate()
+            cmd.warn('text="winfile readers failed with %s"' % (e))
         finally:
-            fileAlerts.terminate()
-            del fileAlerts
-            
+            if not stackWorker.finish(timeout=timeLimits[1]):
+                cmd.warn('text="read stacking has not finished after %ss: %d jobs left"' %
+                         (timeLimits[1], stackWorker.backlog))
+
         self.outfile = None
 
@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 
-from importlib import reload
-
+import collections
+import contextlib
 import datetime
+import functools
+import importlib
 import logging
 import os.path
 import pickle
+import subprocess
+import sys
 import threading
 import time
+import zlib
 
 import numpy as np
 
@@ -19,20 +24,42 @@ import opscore.protocols.types as types
 from opscore.utility.qstr import qstr
 
 from ics.utils.fits import mhs as fitsUtils
-from ics.utils.fits import fitsWriter
 from ics.utils.fits import timecards as actortime
 from ics.utils.fits import wcs
 from ics.utils.sps import fits as spsFits
 
 from ics.utils.sps import hxramp
+from hxActor.Commands import cardTable
+from hxActor.Commands import commandPool
 from hxActor.Commands import ramp
+from hxActor.Commands import rampPaths
 from hxActor.Commands import rampSim
-
-reload(fitsWriter)
-reload(hxramp)
-reload(ramp)
-reload(rampSim)
-reload(spsFits)
+from hxActor.rampFits import rampCatalog
+from hxActor.rampFits import rampCodecs
+from hxActor.rampFits import rampMigrator
+from hxActor.rampFits import rampWriter
+
+# The modules which reloadModules reloads, in dependency order. Nothing is
+# reloaded in normal operation.
+reloadableModules = ('ics.utils.sps.fits',
+                     'ics.utils.sps.hxramp',
+                     'hxActor.rampFits.fitsBlocks',
+                     'hxActor.rampFits.rampCodecs',
+                     'hxActor.rampFits.rampWriter',
+                     'hxActor.rampFits.rampReader',
+                     'hxActor.rampFits.rampCatalog',
+                     'hxActor.rampFits.rampMigrator',
+                     'hxActor.Commands.cardTable',
+                     'hxActor.Commands.commandPool',
+                     'hxActor.Commands.rampPaths',
+                     'hxActor.Commands.ramp',
+                     'hxActor.Commands.rampSim',
+                     'hxActor.charis.seqPath',
+                     'fpga.opticslab',
+                     'hxActor.Commands.opticslab',
+                     'sam.logic',
+                     'sam.sam',
+                     'hxActor.Controllers.hxhal')
 
 def isoTs(t=None):
     """Return local (HST) time, and a formatted time string without timezone.
@@ -85,6 +112,10 @@ def isoTs(t=None):
 
     return ts, ts.strftime('%Y-%m-%dT%H:%M:%S.%f')
 
+# One PFS ramp's file: its visit, the path it is written to (maybe a staging
+# path), its final path, and the `ramp.Ramp` which follows its writing.
+RampFile = collections.namedtuple('RampFile', ('visit', 'path', 'finalPath', 'reporter'))
+
 class HxCmd(object):
 
     def __init__(self, actor):
@@ -98,43 +129,59 @@ class HxCmd(object):
         # associated methods when matched. The callbacks will be
         # passed a single argument, the parsed and typed command.
         #
+        # Everything which touches the SAM or ASIC goes through the
+        # controller's hardware arbiter: see `_hardwareCmd`.
+        control = self._hardwareCmd
+        housekeeping = functools.partial(self._hardwareCmd, priority='housekeeping')
         self.vocab = [
-            ('hx', '@raw', self.hxRaw),
-            ('bounce', '', self.bounce),
-            ('reconnect', '[<firmwareFile>] [<configName>] [@bouncePower]', self.reconnect),
+            ('hx', '@raw', control(self.hxRaw, 'hx')),
+            ('bounce', '', control(self.bounce, 'bounce')),
+            ('reconnect', '[<firmwareFile>] [<configName>] [@bouncePower]',
+             control(self.reconnect, 'reconnect', longRunning=True)),
             ('hxconfig',
              '[<configName>] [<interleaveRatio>] [<interleaveOffset>] [<preampGain>] [<numOutputs>] '
              '[<idleModeOption>]',
-             self.hxconfig),
-            ('reconfigAsic', '', self.reconfigAsic),
-            ('getVoltage', '<name>', self.sampleVoltage),
-            ('getVoltageSettings', '', self.getVoltageSettings),
-            ('getVoltages', '', self.getVoltages),
-            ('getSpiRegisters', '', self.getSpiRegisters),
-            ('getRefCal', '', self.getRefCal),
-            ('getTelemetry', '', self.getTelemetry),
-            ('getAsicPower', '', self.getAsicPower),
-            ('getAsicErrors', '', self.getAsicErrors),
-            ('idleAsic', '', self.idleAsic),
-            ('resetAsic', '', self.resetAsic),
-            ('powerOffAsic', '', self.powerOffAsic),
-            ('powerOnAsic', '', self.powerOnAsic),
-            ('setVoltage', '<name> <voltage>', self.setVoltage),
+             control(self.hxconfig, 'hxconfig', longRunning=True)),
+            ('reconfigAsic', '', control(self.reconfigAsic, 'reconfigAsic', longRunning=True)),
+            ('getVoltage', '<name>', housekeeping(self.sampleVoltage, 'getVoltage', betweenFrames=True,
+                                                  longRunning=True)),
+            ('getVoltageSettings', '', housekeeping(self.getVoltageSettings, 'getVoltageSettings',
+                                                    cached=self.getCachedVoltageSettings)),
+            ('getVoltages', '', housekeeping(self.getVoltages, 'getVoltages', longRunning=True)),
+            ('getSpiRegisters', '', housekeeping(self.getSpiRegisters, 'getSpiRegisters',
+                                                 cached=self.getCachedSpiRegisters)),
+            ('getRefCal', '', housekeeping(self.getRefCal, 'getRefCal', longRunning=True)),
+            ('getTelemetry', '', housekeeping(self.getTelemetry, 'getTelemetry', betweenFrames=True,
+                                              longRunning=True)),
+            ('getAsicPower', '', housekeeping(self.getAsicPower, 'getAsicPower', betweenFrames=True,
+                                              longRunning=True)),
+            ('getAsicErrors', '', housekeeping(self.getAsicErrors, 'getAsicErrors', betweenFrames=True)),
+            ('idleAsic', '', control(self.idleAsic, 'idleAsic')),
+            ('resetAsic', '', control(self.resetAsic, 'resetAsic', longRunning=True)),
+            ('powerOffAsic', '', control(self.powerOffAsic, 'powerOffAsic', longRunning=True)),
+            ('powerOnAsic', '', control(self.powerOnAsic, 'powerOnAsic', longRunning=True)),
+            ('setVoltage', '<name> <voltage>', control(self.setVoltage, 'setVoltage', longRunning=True)),
             ('ramp',
              '[<nramp>] [<nreset>] [<nread>] [<ngroup>] [<ndrop>] [<itime>] '
              '[<visit>] [<exptype>] [<objname>] [<expectedExptime>] [<pfsDesign>] '
              '[<lamp>] [<lampPower>] [<readoutSize>] [@noOutputReset] [@rawImage]',
-             self.takeOrSimRamp),
+             control(self.takeOrSimRamp, 'ramp')),
             ('ramp', 'finish [<exptime>] [<obstime>] [@stopRamp]', self.finishRamp),
-            ('reloadLogic', '', self.reloadLogic),
-            ('readAsic', '<reg> [<nreg>]', self.getAsicReg),
-            ('writeAsic', '<reg> <value>', self.writeAsicReg),
-            ('readSam', '<reg> [<nreg>]', self.getSamReg),
-            ('setReadSpeed', '@(fast|slow) [@debug]', self.setReadSpeed),
-            ('grabAllH4Info', '[@doRef]', self.grabAllH4Info),
-            ('clearRowSkipping', '', self.clearRowSkipping),
-            ('setRowSkipping', '<skipSequence>', self.setRowSkipping),
-            ('downloadMcdFile', '<firmwareFile>', self.downloadMcdFile),
+            ('reloadLogic', '', control(self.reloadLogic, 'reloadLogic', longRunning=True)),
+            ('reloadModules', '', self.reloadModules),
+            ('startupProfile', '[<limit>]', self.startupProfile),
+            ('readAsic', '<reg> [<nreg>]', housekeeping(self.getAsicReg, 'readAsic', betweenFrames=True)),
+            ('writeAsic', '<reg> <value>', control(self.writeAsicReg, 'writeAsic')),
+            ('readSam', '<reg> [<nreg>]', housekeeping(self.getSamReg, 'readSam', betweenFrames=True)),
+            ('setReadSpeed', '@(fast|slow) [@debug]', control(self.setReadSpeed, 'setReadSpeed')),
+            ('grabAllH4Info', '[@doRef]', control(self.grabAllH4Info, 'grabAllH4Info', longRunning=True)),
+            ('clearRowSkipping', '', control(self.clearRowSkipping, 'clearRowSkipping')),
+            ('setRowSkipping', '<skipSequence>', control(self.setRowSkipping, 'setRowSkipping')),
+            ('downloadMcdFile', '<firmwareFile>', control(self.downloadMcdFile, 'downloadMcdFile',
+                                                       longRunning=True)),
+            ('hardwareStatus', '', self.hardwareStatus),
+            ('migrationStatus', '', self.migrationStatus),
+            ('rampCatalog', '[<visit>] [<exptype>] [<since>] [<limit>] [@stopped]', self.queryRampCatalog),
         ]
 
         # Define typed command arguments for the above commands.
@@ -161,6 +208,10 @@ class HxCmd(object):
                                                  help='time at start of illumination.'),
                                         keys.Key("exptype", types.String(), default=None,
                                                  help='What to put in IMAGETYP/DATA-TYP.'),
+                                        keys.Key("since", types.String(), default=None,
+                                                 help='ISO date or time to search from'),
+                                        keys.Key("limit", types.Int(), default=None,
+                                                 help='maximum number of entries to return'),
                                         keys.Key("objname", types.String(), default=None,
                                                  help='What to put in OBJECT.'),
                                         keys.Key("configName", types.String(), default=None,
@@ -205,6 +256,19 @@ class HxCmd(object):
         self.rampConfig = None
         self.skipSequence = [0, 0, 0, 0, 4096]
         self.rampRunning = False
+        self.daqStart = None
+        self.rampIntegrations = []
+        self.hardwareTimeout = 30.0
+        self.commandWorkers = 4
+        self.commandLimits = dict(sam=1)
+        self.nTimeCards = 0
+        self.lampCardReserve = 24
+        self.lampCommands = dict()
+        self.lampSamples = None
+        self.photodiodeCadence = 0.5
+        self.photodiodeTable = False
+        self.migrator = None
+        self.catalog = None
 
         if self.actor.instrument == "CHARIS":
             self.dataRoot = "/home/data/charis"
@@ -216,30 +280,71 @@ class HxCmd(object):
                 dataRoot = self.actor.actorConfig['dataRoot']
                 rampRoot = self.actor.actorConfig[site].get('rampRoot', None)
                 doCompress = self.actor.actorConfig[site].get('compress', True)
+                codecs = rampCodecs.codecsFromConfig(self.actor.actorConfig[site].get('codecs', None),
+                                                     doCompress=doCompress)
+                rampLayout = self.actor.actorConfig[site].get('rampLayout', 'hdus')
+                preallocate = self.actor.actorConfig[site].get('preallocate', True)
+                self.lampCardReserve = self.actor.actorConfig[site].get('lampCardReserve', 24)
+                self.photodiodeCadence = self.actor.actorConfig[site].get('photodiodeCadence', 0.5)
+                self.photodiodeTable = self.actor.actorConfig[site].get('photodiodeTable', False)
+                self.hardwareTimeout = self.actor.actorConfig[site].get('hardwareTimeout', 30.0)
+                self.commandWorkers = self.actor.actorConfig[site].get('commandWorkers', 4)
+                self.commandLimits = self.actor.actorConfig[site].get('commandLimits', dict(sam=1))
+                catalogPath = self.actor.actorConfig[site].get('rampCatalog',
+                                                               os.path.join(dataRoot, 'rampCatalog.sqlite'))
+                stagingRoot = self.actor.actorConfig[site].get('stagingRoot', None)
+                migrationRate = self.actor.actorConfig[site].get('migrationRate', None)
             except Exception as e:
                 raise RuntimeError(f'failed to fetch dataRoot, etc. for {site}: {e}')
             
             self.dataRoot = dataRoot
             self.dataPrefix = None
-            self.logger.info(f'using dataRoot={self.dataRoot} with rampRoot={rampRoot} site={site}')
+            self.logger.info(f'using dataRoot={self.dataRoot} with rampRoot={rampRoot} site={site} '
+                             f'codecs={codecs} rampLayout={rampLayout}')
 
             # We want the fits writing process to be persistent, mostly so that
             # we do not have to pay attention to when it finishes.
-            self.rampBuffer = fitsWriter.FitsBuffer(doCompress=doCompress, rampRoot=rampRoot)
+            self.rampBuffer = rampWriter.RampBuffer(codecs=codecs, layout=rampLayout,
+                                                    preallocate=preallocate, rampRoot=rampRoot)
+
+            try:
+                self.catalog = rampCatalog.RampCatalog(catalogPath)
+            except Exception as e:
+                self.logger.warning(f'failed to open ramp catalogue {catalogPath}: {e}')
+
+            # If staging, ramps are written to a local directory and migrated to
+            # their butler paths in the background. There must only ever be one
+            # migrator working on the staging queue, so it survives command reloads.
+            if stagingRoot is not None:
+                self.migrator = getattr(self.actor, 'rampMigrator', None)
+                if self.migrator is None:
+                    bcast = self.actor.bcast
+                    self.migrator = rampMigrator.RampMigrator(
+                        stagingRoot, maxRate=migrationRate,
+                        statusCB=lambda status: bcast.inform(self.migrationKey(status)),
+                        migratedCB=lambda staged, final: bcast.inform(f'migratedFilename={final}'))
+                    self.migrator.start()
+                    self.actor.rampMigrator = self.migrator
+                self.logger.info(f'staging ramps in {stagingRoot}, migrating at {migrationRate} MB/s')
 
             import pfs.utils.butler as pfsButler
-            reload(pfsButler)
             butler = pfsButler.Butler(specIds=self.actor.ids)
 
-            def filenameFunc(dataRoot, visit, butler=butler, logger=self.logger):
+            # Resolve the path template now, so that the first ramp does not pay for it.
+            self.rampPaths = rampPaths.RampPathCache(butler, self.actor.ids.camName, logger=self.logger)
+            try:
+                self.rampPaths.refresh()
+            except Exception as e:
+                self.logger.warning(f'failed to resolve the ramp path template: {e}')
+
+            def filenameFunc(dataRoot, visit, rampPaths=self.rampPaths, logger=self.logger):
                 """ Return the ramp filename """
 
-                fileNameB = butler.getPath('rampFile', visit=visit)
-                logger.info(f'butler returned {fileNameB}')
+                fileNameB = rampPaths.getPath(visit)
+                logger.info(f'ramp path is {fileNameB}')
                 return None, fileNameB
 
         from hxActor.charis import seqPath
-        reload(seqPath)
         self.fileGenerator = seqPath.NightFilenameGen(self.dataRoot,
                                                       namesFunc = filenameFunc,
                                                       filePrefix=self.dataPrefix)
@@ -254,7 +359,108 @@ class HxCmd(object):
         ctrlr = self.actor.controllers.get(self.backend, None)
         return ctrlr.sam
 
+    @property
+    def arbiter(self):
+        return getattr(self.controller, 'arbiter', None)
+
+    @property
+    def commandPool(self):
+        return commandPool.commandPool(self.actor, maxWorkers=self.commandWorkers,
+                                       limits=self.commandLimits)
+
+    def _hardwareCmd(self, func, name, priority='control', betweenFrames=False, cached=None,
+                     longRunning=False, resource='sam'):
+        """Return a command handler which calls func(cmd) with the hardware arbiter's permission.
+
+        A longRunning command is run on the command pool, so that it does
+        not hold up the reactor thread, as is any command which would
+        otherwise have to wait for the hardware, or for pool commands
+        already running or queued on its resource.
+
+        While a ramp is reading out, a command with a cached function is
+        answered by that, without touching the hardware. A betweenFrames
+        command is run on the pool, in the next gap between frames.
+        Anything else fails at once.
+
+        Parameters
+        ----------
+        func : callable
+          The command handler.
+        name : `str`
+          The command name, for the arbiter's statistics and our complaints.
+        priority : {'control', 'housekeeping'}
+          Control requests are served before housekeeping ones.
+        betweenFrames : `bool`
+          Whether func is short enough to run between two frames of a ramp.
+        cached : callable
+          Answers the command from what we already know.
+        longRunning : `bool`
+          Whether func takes long enough to hold up other commands.
+        resource : `str`
+          What func uses, for the command pool's per-resource limits.
+        """
+
+        def runWithAccess(cmd, arbiter):
+            if arbiter is None:
+                return func(cmd)
+            try:
+                with arbiter.access(name, priority=getattr(arbiter, priority.upper()),
+                                    timeout=self.hardwareTimeout,
+                                    betweenFrames=betweenFrames) as waited:
+                    self._reportHardwareWait(cmd, name, waited)
+                    func(cmd)
+            except TimeoutError as e:
+                cmd.fail(f'text="{e}"')
+
+        def runOnPool(cmd, arbiter):
+            self.commandPool.submit(name, cmd, functools.partial(runWithAccess, arbiter=arbiter),
+                                    resource=resource)
+
+        def handler(cmd):
+            arbiter = self.arbiter
+            if arbiter is not None and arbiter.readoutActive:
+                if cached is not None:
+                    return cached(cmd)
+                if not betweenFrames:
+                    cmd.fail(f'text="cannot {name} while {arbiter.readoutName} is reading out"')
+                    return
+                cmd.diag(f'text="{name} waiting for a gap between frames of {arbiter.readoutName}"')
+                runOnPool(cmd, arbiter)
+                return
+            if (longRunning or (arbiter is not None and arbiter.busy)
+                    or self.commandPool.isBusy(resource)):
+                runOnPool(cmd, arbiter)
+                return
+            runWithAccess(cmd, arbiter)
+
+        handler.__name__ = func.__name__
+        handler.__doc__ = func.__doc__
+        return handler
+
+    def _reportHardwareWait(self, cmd, name, waited):
+        cmdFunc = cmd.inform if waited > 0.1 else cmd.diag
+        cmdFunc(f'hwWait={name},{waited:0.3f}')
+
+    def hardwareStatus(self, cmd):
+        """Report how long hardware requests have waited for the arbiter, and what the ramps let in. """
+
+        arbiter = self.arbiter
+        if arbiter is None:
+            cmd.fail('text="No hxhal controller"')
+            return
+
+        status = arbiter.status()
+        for req in status['requests']:
+            cmd.inform(f'hwAccess={req["name"]},{req["n"]},{req["meanWait"]:0.3f},'
+                       f'{req["maxWait"]:0.3f},{req["timeouts"]}')
+        gaps = status['gaps']
+        cmd.inform(f'hwGaps={gaps["n"]},{gaps["maxHold"]:0.3f}')
+        for resource, jobs in self.commandPool.status().items():
+            cmd.inform(f'cmdPool={resource},{qstr(",".join(jobs["running"]))},{qstr(",".join(jobs["queued"]))}')
+        cmd.finish(f'hwHolder={qstr(status["holder"] or "")},{qstr(",".join(status["waiting"]))}')
+
     def bounce(self, cmd):
+        self.controller.invalidateDaqState()
         self.controller.disconnect()
 
     def reconnect(self, cmd, doFinish=True):
@@ -338,6 +544,7 @@ class HxCmd(object):
         firmwareFile = cmd.cmd.keywords['firmwareFile'].values[0]
 
         cmd.inform(f'text="downloading .mcd file: {firmwareFile}"')
+        self.controller.invalidateDaqState()
         self.sam.downloadMcdFile(firmwareFile)
         cmd.finish(f'text="download done"')
 
@@ -377,6 +584,7 @@ class HxCmd(object):
 
         # there is a per-frame size override. Clear that and recalculate.
         self.sam.overrideFrameSize(None)
+        self.saveSkipSequence()
         self.reportRowSequence(cmd, doFinish=True)
 
     def clearRowSkipping(self, cmd, doFinish=True):
@@ -387,6 +595,7 @@ class HxCmd(object):
         self.sam.link.WriteAsicReg(0x4302, 0)
         self.sam.link.WriteAsicReg(0x4303, 0)
         self.sam.overrideFrameSize(None)
+        self.saveSkipSequence()
 
         self.reportRowSequence(cmd, doFinish=doFinish)
 
@@ -397,11 +606,31 @@ class HxCmd(object):
         self.getHxConfig(cmd, doFinish=False)
         cmd.finish()
 
-    def updateDaqState(self, cmd, always=False):
-        """Make sure our snapshot of the ASIC config is valid. """
+    def saveSkipSequence(self):
+        """Record the row-skipping sequence we just loaded in the DAQ state snapshot. """
+
+        self.controller.daqState.skipSequence = list(self.skipSequence)
+        self.controller.saveDaqState()
+
+    def updateDaqState(self, cmd, always=False, refreshReadings=False):
+        """Make sure our snapshot of the ASIC config is valid.
 
-        if always or not self.controller.daqState.isValid:
+        The snapshot is kept valid by the commands which change the DAQ,
+        and may have been restored from disk when the controller connected.
+        The bias voltage readings are not part of the configuration: with
+        refreshReadings, they are sampled again even if the rest of the
+        snapshot is reused, so that ramp headers get current values.
+        """
+
+        daqState = self.controller.daqState
+        if always or not daqState.isValid:
             self.getHxConfig(cmd, doFinish=False)
+            return
+
+        if daqState.skipSequence is not None:
+            self.skipSequence = list(daqState.skipSequence)
+        if refreshReadings:
+            self.getMainVoltages(cmd, doFinish=False)
 
     def getHxConfig(self, cmd, doFinish=True):
         self.grabAllH4Info(cmd, doFinish=False)
@@ -448,6 +677,7 @@ class HxCmd(object):
         sam = self.sam
 
         try:
+            self.controller.invalidateDaqState()
             newVoltage = sam.setBiasVoltage(voltageName, voltage)
         except Exception as e:
             cmd.fail('text="Failed to set voltage %s=%s: %s"' % (voltageName,
@@ -488,6 +718,17 @@ class HxCmd(object):
         if doFinish:
             cmd.finish()
 
+    def getCachedVoltageSettings(self, cmd):
+        """Report the bias voltage settings from the DAQ state, while a ramp is reading out. """
+
+        settings = self.controller.daqState.voltageSettings
+        if not settings:
+            cmd.fail(f'text="no cached voltage settings, and {self.arbiter.readoutName} is reading out"')
+            return
+        for name, setting in settings.items():
+            cmd.inform(f'text="{name:12s} = {setting: .3f}"')
+        cmd.finish('text="voltage settings from the DAQ state, not the ASIC: a ramp is reading out"')
+
     def getMainVoltages(self, cmd, doFinish=False):
         cmdKeys = cmd.cmd.keywords
         doRef = 'doRef' in cmdKeys
@@ -566,6 +807,7 @@ class HxCmd(object):
             return
 
         cmd.inform('text="setting 0x%04x = 0x%04x"' % (regnum, value))
+        self.controller.invalidateDaqState()
         sam.link.WriteAsicReg(regnum, value)
         val = sam.link.ReadAsicReg(regnum)
         cmd.inform('text="0x%04x = 0x%04x"' % (regnum, val))
@@ -623,15 +865,7 @@ class HxCmd(object):
             raise RuntimeError("unknown expType %s" % (expType))
 
     def flushProgramInput(self, cmd, doFinish=True):
-        debris = ''
-        while True:
-            try:
-                ret = self.controller.getOneChar(timeout=0.2)
-                debris = debris + ret
-            except RuntimeError:
-                break
-            except:
-                raise
+        debris = self.controller.flushInput(timeout=0.2, cmd=cmd)
 
         if debris != '':
             cmd.warn('text="flushed stray input: %r"' % (debris))
@@ -646,27 +880,15 @@ class HxCmd(object):
         if exptype.lower() == 'nohdr':
             return pyfits.Header()
 
-        headerTask = subaru.FetchHeader(fullHeader=True, frameId=frameId, itime=itime, exptype=exptype)
-        self.logger.debug('text="starting header task timeout=%s frameId=%s"' % (timeout, frameId))
-        headerTask.start()
-        headerQ = headerTask.q
-        self.logger.info('text="header q: %s"' % (headerQ))
+        from hxActor.charis import subaru
 
         try:
-            hdrString = headerQ.get(True, timeout)
-            if hdrString is None:
-                self.logger.debug('text=".get header: %s"' % (hdrString))
-            else:
-                self.logger.debug('text=".get header: %s"' % (len(hdrString)))
+            hdr = subaru.headerClient(self.actor).fetch(frameId, exptype=exptype, itime=itime,
+                                                        fullHeader=True, timeout=timeout)
         except Exception as e:
             self.logger.warn('text="failed to .getHeader header: %s"' % (e))
             cmd.warn('text="failed to .getHeader header: %s"' % (e))
-            hdrString = ''
-        finally:
-            headerTask.terminate()
-            time.sleep(0.1)
-
-        hdr = pyfits.Header.fromstring(hdrString)
+            hdr = pyfits.Header()
 
         return hdr
 
@@ -702,6 +924,19 @@ class HxCmd(object):
 
     def getSpiRegisters(self, cmd):
         h4Regs = self.sam.readAllH4SpiRegs()
+        self._reportSpiRegisters(cmd, h4Regs)
+
+    def getCachedSpiRegisters(self, cmd):
+        """Report the SPI registers from the DAQ state, while a ramp is reading out. """
+
+        h4Regs = self.controller.daqState.spiRegisters
+        if not h4Regs:
+            cmd.fail(f'text="no cached SPI registers, and {self.arbiter.readoutName} is reading out"')
+            return
+        cmd.inform('text="SPI registers from the DAQ state, not the ASIC: a ramp is reading out"')
+        self._reportSpiRegisters(cmd, h4Regs)
+
+    def _reportSpiRegisters(self, cmd, h4Regs):
         allBad = True
         for i, reg in enumerate(h4Regs):
             cmd.inform(f'spiReg%d=0x%04x' % (i, reg))
@@ -718,14 +953,17 @@ class HxCmd(object):
         self.getAsicErrors(cmd)
 
     def resetAsic(self, cmd):
+        self.controller.invalidateDaqState()
         self.sam.resetAsic()
         self.getAsicErrors(cmd)
 
     def powerOffAsic(self, cmd):
+        self.controller.invalidateDaqState()
         self.sam.powerDownAsic()
         self.getAsicErrors(cmd)
 
     def powerOnAsic(self, cmd):
+        self.controller.invalidateDaqState()
         self.sam.initAsics()
         self.getAsicErrors(cmd)
 
@@ -764,16 +1002,59 @@ class HxCmd(object):
         cmd.finish()
 
     def lamp(self, lamp, lampPower, cmd):
+        """Queue a lamp command, without waiting for the illuminator.
+
+        The request time and the command's future are kept in .lampCommands,
+        by 'on' or 'off', for `illuminatorCards`.
+        """
         if self.actor.ids.camName != 'n8':
             return
 
         from hxActor.Commands import opticslab
-        reload(opticslab)
 
         if lamp != 0:
-            opticslab.lampCmd(lamp, lampPower)
+            future = opticslab.illuminator(self.actor).lampCmd(lamp, lampPower)
+            self.lampCommands['on' if lampPower != 0 else 'off'] = (time.time(), future)
+
+            def reportLamp(future, lamp=lamp, lampPower=lampPower):
+                try:
+                    lampCmd = future.result()
+                except Exception as e:
+                    cmd.warn('text="lamp %s=%s failed: %s"' % (lamp, lampPower, e))
+                    return
+                cmd.inform('text="lamp %s=%s: %r after %0.2fs"' % (lamp, lampPower, lampCmd.reply,
+                                                                    lampCmd.doneAt - lampCmd.queuedAt))
+
+                # Sample the photodiode from when the lamp is on, unless the ramp has already moved on.
+                if (lampPower != 0 and 'off' not in self.lampCommands
+                        and self.lampCommands.get('on', (None, None))[1] is future):
+                    opticslab.photodiodeSampler(self.actor, cadence=self.photodiodeCadence).startSampling(lamp)
+            future.add_done_callback(reportLamp)
         cmd.inform('text="lamp %s=%s"' % (lamp, lampPower))
 
+    def illuminatorCards(self):
+        """Return the cards for when the lamp was turned on and off during the ramp.
+
+        The lamp commands are not waited for, so the times are those of the
+        illuminator's replies if we have them, else of our requests.
+        """
+        if self.actor.ids.camName != 'n8':
+            return []
+
+        cards = []
+        for name, what in ('W_OLLPON', 'on'), ('W_OLLPOF', 'off'):
+            if what not in self.lampCommands:
+                continue
+            t, future = self.lampCommands[what]
+            if future.done() and future.exception() is None:
+                t = future.result().doneAt
+                comment = f'when the illuminator acknowledged lamp {what}'
+            else:
+                comment = f'when we requested lamp {what}'
+            _, stamp = isoTs(t)
+            cards.append(dict(name=name, value=stamp, comment=comment))
+        return cards
+
     def setHxCards(self, ramp, group, read, doClear=True):
         if doClear:
             self.hxCards = []
@@ -784,6 +1065,8 @@ class HxCmd(object):
 
     def startLampCards(self, lamp, lampPower):
         self.lampCards = []
+        self.lampCommands = dict()
+        self.lampSamples = None
         if self.actor.ids.camName != 'n8':
             return
 
@@ -791,26 +1074,45 @@ class HxCmd(object):
         self.lampCards.append(dict(name='W_OLLPLV', value=lampPower, comment='Optics lab lamp command level'))
 
     def getLastLampState(self, lamp, lampPower, cmd):
+        """Add the latest photodiode sample to the read cards. Does not touch the hardware. """
+
         self.lampCards = []
         if self.actor.ids.camName != 'n8':
             return
 
         from hxActor.Commands import opticslab
-        reload(opticslab)
 
-        try:
-            current, lam, flux = opticslab.getFlux(lamp)
-        except Exception:
-            cmd.warn('text="failed to get lamp info for optics lab"')
-            return
+        sampler = getattr(self.actor, 'photodiodeSampler', None)
+        latest = sampler.latest() if sampler is not None and sampler.sampling.is_set() else None
+        current = latest[1] if latest is not None else None
+        lam, scale = opticslab.lamps.get(lamp, (None, None))
+        flux = current*scale if current is not None and scale is not None else None
 
         cmd.inform('text="lamp %s=%s %s %s %s"' % (lamp, lampPower,
                                                    current, lam, flux))
         self.hxCards.append(dict(name='W_OLLAMP', value=lamp, comment='Optics lab lamp'))
         self.hxCards.append(dict(name='W_OLLPLV', value=lampPower, comment='Optics lab lamp command level'))
-        self.hxCards.append(dict(name='W_OLLPWV', value=lam, comment='[nm] Lamp center wavelength'))
-        self.hxCards.append(dict(name='W_OLLPCR', value=current, comment='[A] Photodiode current'))
-        self.hxCards.append(dict(name='W_OLFLUX', value=flux, comment='[photons/s] Calibrated flux'))
+        # FITS has no NaN: skip what we do not know, e.g. before the first sample, or for darks.
+        if lam is not None:
+            self.hxCards.append(dict(name='W_OLLPWV', value=lam, comment='[nm] Lamp center wavelength'))
+        if current is not None:
+            self.hxCards.append(dict(name='W_OLLPCR', value=current, comment='[A] Photodiode current'))
+        if flux is not None:
+            self.hxCards.append(dict(name='W_OLFLUX', value=flux, comment='[photons/s] Calibrated flux'))
+
+    def stopPhotodiode(self, cmd):
+        """Stop sampling the photodiode, and keep the samples for the PHDU. """
+
+        sampler = getattr(self.actor, 'photodiodeSampler', None)
+        if sampler is None or not sampler.sampling.is_set():
+            return
+        self.lampSamples = samples = sampler.stopSampling()
+        cmd.inform('text="photodiode: %s"' % (samples.summary()))
+
+    def photodiodeCards(self):
+        if self.lampSamples is None:
+            return []
+        return self.lampSamples.cards()
 
     def placeSkippedRows(self, cmd, image, rowSequence):
         """Place the packed rows from a row-skipping read into a full-sized image.
@@ -848,15 +1150,80 @@ class HxCmd(object):
         cmd.inform(f'text="haveRead={total},{haveRead}"')
         return newImage
 
+    def planeShapes(self, rawImage=False, rowSequence=None, readoutSize=None):
+        """Return the (rows, cols) shapes of the IMAGE and REF planes of a single read.
+
+        The REF plane is the same size as the IMAGE plane when IRP is not enabled.
+        readoutSize is any (cols, rows) override of the frame size, but a
+        row-skipping read is always placed into a full-height image.
+        """
+
+        if readoutSize is not None:
+            frameSize = readoutSize
+        else:
+            frameSize, _ = self.sam.calcFrameSize()
+        width, height = [int(n) for n in frameSize]
+        if rowSequence is not None:
+            height = 1024 * self.sam.hxrgDetectorConfig.muxType
+        if rawImage:
+            return (height, width), None
+
+        cfg = self.controller.daqState.hxConfig
+        if not cfg.h4Interleaving:
+            return (height, width), (height, width)
+
+        dataWidth = width * cfg.interleaveRatio // (cfg.interleaveRatio + 1)
+        return (height, dataWidth), (height, width - dataWidth)
+
+    def rampPlan(self, nreset, nread, outputReset=True, rawImage=False, rowSequence=None,
+                 readoutSize=None):
+        """Return the expected shape of a ramp file, for the ramp writer. """
+
+        dataShape, refShape = self.planeShapes(rawImage=rawImage, rowSequence=rowSequence,
+                                               readoutSize=readoutSize)
+        cfg = self.controller.daqState.hxConfig
+
+        return dict(nread=nread, nreset=nreset if outputReset else 0,
+                    dataShape=dataShape, refShape=refShape,
+                    irp=bool(cfg.h4Interleaving) and not rawImage,
+                    dtype='u2')
+
     def writeSingleRead(self, cmd, image, hdr, ramp, group, read, nChannel, irpOffset,
-                        rawImage=False, rowSequence=None, isResetRead=False):
+                        rawImage=False, rowSequence=None, readoutSize=None, isResetRead=False):
         """Write the image for a single read to disk.
 
         - splits out the DATA and IRP components
         - interpolates row-skipped images into full images
-        - knows about reset frames.
+        - knows about reset frames, which might not have any pixels.
+        - records the CRC-32 of the raw frame in W_H4CRC, so that the stored
+          pixels can be checked against what came off the DAQ.
+
+        We always want the file to have IMAGE and REF HDUs, but do not send
+        constant planes (no IRP, or no reset pixels) to the writer: it stores
+        them as header-only HDUs.
         """
 
+        extnamePrefix = 'RESET_' if isResetRead else ''
+        imageName = f'{extnamePrefix}IMAGE_{read}'
+        refName = f'{extnamePrefix}REF_{read}'
+
+        if image is None:
+            dataShape, refShape = self.planeShapes(rawImage=rawImage, rowSequence=rowSequence,
+                                                   readoutSize=readoutSize)
+            cmd.inform(f'text="adding empty HDUs at group={group} read={read} isReset={isResetRead} '
+                       f'shape={dataShape} ref={refShape}"')
+            self.rampBuffer.addConstantHdu(0, dataShape, np.uint16, hdr,
+                                           hduId=(ramp, group, read), extname=imageName)
+            if refShape is not None:
+                self.rampBuffer.addConstantHdu(0, refShape, np.uint16, None,
+                                               hduId=(ramp, group, None), extname=refName)
+            return
+
+        # CRC of the frame exactly as the DAQ delivered it, before any splitting or row placement.
+        frameCrc = zlib.crc32(np.ascontiguousarray(image))
+        hdr = list(hdr) if hdr is not None else []
+        hdr.append(dict(name='W_H4CRC', value=frameCrc, comment='CRC-32 of the raw DAQ frame for this read'))
+
         if rawImage:
             data = image
             ref = None
@@ -865,17 +1232,14 @@ class HxCmd(object):
                 image = self.placeSkippedRows(cmd, image, rowSequence)
             data, ref = hxramp.splitIRP(image, nChannel=nChannel, refPix=irpOffset)
 
-            # We always want the file to have IMAGE and REF HDUs:
-            if ref is None:
-                ref = data*0
-
-        extnamePrefix = 'RESET_' if isResetRead else ''
-        cmd.inform(f'text="adding HDUs at group={group} read={read} isReset={isResetRead} shape={data.shape} ref={data.shape} med={np.median(data)}"')
-        self.rampBuffer.addHdu(data, hdr, hduId=(ramp, group, read),
-                                extname=f'{extnamePrefix}IMAGE_{read}')
+        cmd.inform(f'text="adding HDUs at group={group} read={read} isReset={isResetRead} shape={data.shape} '
+                   f'ref={None if ref is None else ref.shape} med={np.median(data)}"')
+        self.rampBuffer.addHdu(data, hdr, hduId=(ramp, group, read), extname=imageName)
         if ref is not None:
-            self.rampBuffer.addHdu(ref, None, hduId=(ramp, group, None),
-                                    extname=f'{extnamePrefix}REF_{read}')
+            self.rampBuffer.addHdu(ref, None, hduId=(ramp, group, None), extname=refName)
+        elif not rawImage:
+            self.rampBuffer.addConstantHdu(0, data.shape, data.dtype, None,
+                                           hduId=(ramp, group, None), extname=refName)
 
     def takeOrSimRamp(self, cmd):
         """Take a ramp, either from real DAQ/detector or from the simulator. """
@@ -982,7 +1346,7 @@ class HxCmd(object):
         cmd.inform('ramp=%d,%d,%d,%d,%d' % (nramp,ngroup,nreset,nread,ndrop))
         cmd.inform('rampConfig=%d,%d,%d,%d,%d' % (visit,ngroup,nreset,nread,ndrop))
 
-        self.updateDaqState(cmd, always=True)
+        self.updateDaqState(cmd, refreshReadings=True)
         self.hxCards = []
 
         if self.backend == 'hxhal':
@@ -996,13 +1360,21 @@ class HxCmd(object):
                 runThreaded = True
                 self.doStopRamp = False
                 self.rampPatched = False
-                if nramp != 1:
-                    raise ValueError("PFS can only take one ramp at a time")
 
-                seqno = None if visit == 0 else visit
-                _, rampFilename = self.fileGenerator.getNextFileset(seqno=seqno)
-
-                rampReporter = ramp.Ramp(cmd)
+                rampPlan = self.rampPlan(nreset, nread, outputReset=outputReset,
+                                         rawImage=rawImage, rowSequence=rowSequence,
+                                         readoutSize=readoutSize)
+
+                # The ASIC takes the ramps back to back, each starting at the
+                # frame after the last read of the one before. Each ramp gets
+                # its own visit and file: the first the commanded visit, the
+                # others visits allocated in turn, as the ramp before closes.
+                # Closing a file is only queued to the writer, so it overlaps
+                # the next ramp's resets.
+                framesPerRamp = nreset + ngroup*nread + (ngroup-1)*ndrop
+                rampFiles = [self._newRampFile(cmd, visit)]
+                rampReporters = [rampFiles[0].reporter]
+                self.rampIntegrations = []
                 # self.grabAllH4Info(cmd, doFinish=False)
                 self.startLampCards(lamp, lampPower)
                 self.setHxCards(0, 0, 0, doClear=True)
@@ -1032,6 +1404,12 @@ class HxCmd(object):
                     """
 
                     global t0
+
+                    # Between frames: let any waiting housekeeping at the hardware.
+                    held = self.arbiter.frameGap()
+                    if held > 0:
+                        cmd.diag(f'text="held readout for {held:0.3f}s between frames"')
+
                     self.setHxCards(ramp, group, read)
 
                     cmd.debug(f'text="cb ramp={ramp} group={group} read={read} '
@@ -1039,48 +1417,60 @@ class HxCmd(object):
 
                     # This call is made at the start of the RESET frame, and we use that to reference
                     # and advertise our frame timing. In this case, there is no image data.
-                    if ramp == 0 and group == 0 and read == 0:
-                        cmd.debug('text="DAQ output start"')
-                        t0 = time.time()
-                        self.readTime = self.calcFrameTime()
-                        self.read0Start = t0 + nreset*self.readTime
-                        _, resetStartStamp = isoTs(t0)
-                        _, self.read0StartStamp = isoTs(self.read0Start)
-                        self.exptime = nread * self.readTime
-                        cmd.inform(f'readTimes={visit},{resetStartStamp},{self.read0StartStamp},{self.readTime:0.3f}')
+                    if group == 0 and read == 0:
+                        if ramp == 0:
+                            cmd.debug('text="DAQ output start"')
+                            t0 = time.time()
+                            self.daqStart = t0
+                            self.readTime = self.calcFrameTime()
+                            self.startRampTimes(cmd, visit, 0, nreset, nread, framesPerRamp)
                         return True
 
                     # We are starting a ramp: either with a reset read to write or without.
                     # In either case, generate RESET HDU(s) if wanted.
                     if ((outputReset and group == 0 and read == 1)
                             or ((not outputReset or nreset == 0) and group == 1 and read == 1)):
-                        cmd.inform(f'text="creating FITS files at group={group} read={read}"')
+                        while len(rampFiles) <= ramp:
+                            rampFiles.append(self._newRampFile(cmd, None))
+                            rampReporters.append(rampFiles[-1].reporter)
+                        rampFile = rampFiles[ramp]
+                        if ramp > 0:
+                            # The ramp before has been closed: start this one afresh.
+                            self.rampPatched = False
+                            self.visit = rampFile.visit
+                            self.nread = nread
+                            self.startLampCards(lamp, lampPower)
+                            self.startRampTimes(cmd, rampFile.visit, ramp, nreset, nread, framesPerRamp)
+
+                        cmd.inform(f'text="creating FITS files for ramp {ramp+1}/{nramp} '
+                                   f'at group={group} read={read}"')
                         if lampPower != 0:
                             cmd.inform(f'text="turning on flat lamp {lamp}@{lampPower}"')
                             self.lamp(lamp, lampPower, cmd)
 
-                        phdr = self.getPfsHeader(visit=visit, exptype=exptype,
+                        phdr = self.getPfsHeader(visit=rampFile.visit, exptype=exptype,
                                                  obstime=self.read0StartStamp,
                                                  pfsDesign=pfsDesign,
                                                  objname=objname, cmd=cmd)
-                        self.logger.info(f'filename={rampFilename}')
-                        self.rampBuffer.createFile(rampReporter, rampFilename, phdr)
+                        self.logger.info(f'filename={rampFile.path}')
+                        self.rampBuffer.createFile(rampFile.reporter, rampFile.path, phdr, plan=rampPlan,
+                                                   reserveCards=self.phduReserveCards())
 
                     if group == ngroup-1 and read == nread-1:
                         self.getLastLampState(lamp, lampPower, cmd)
 
                     if group == 0:  # Reset read
                         if outputReset:
-                            resetImageToWrite = 0 if image is None else image
                             hdr = self.getResetHeader(cmd)
-                            self.writeSingleRead(cmd, resetImageToWrite, hdr, ramp, group, read, nChannel,
+                            self.writeSingleRead(cmd, image, hdr, ramp, group, read, nChannel,
                                                  irpOffset, rawImage=rawImage, rowSequence=rowSequence,
-                                                 isResetRead=True)
+                                                 readoutSize=readoutSize, isResetRead=True)
                     else:       # Non reset read
-                        hdr = self.getPfsHeader(visit=visit, exptype=exptype,
+                        hdr = self.getPfsHeader(visit=self.visit, exptype=exptype,
                                                 objname=objname, fullHeader=False, cmd=cmd)
                         self.writeSingleRead(cmd, image, hdr, ramp, group, read, nChannel, irpOffset,
-                                             rawImage=rawImage, rowSequence=rowSequence, isResetRead=False)
+                                             rawImage=rawImage, rowSequence=rowSequence,
+                                             readoutSize=readoutSize, isResetRead=False)
                         # INSTRM-1993 investigations: turn logging off after first read done.
                         sam.link.readLogger.setLevel(logging.INFO)
                     if self.doStopRamp:
@@ -1093,13 +1483,22 @@ class HxCmd(object):
                         # sam.waitForAsicIdle()
                     if (group >= ngroup and read == nread) or nread == 0 or self.doStopRamp:
                         cmd.diag(f'text="closing FITS file from read cb... with stopRamp={self.doStopRamp}"')
-                        self._doFinishRamp(cmd)
-                        self.rampBuffer.finishFile()
+                        # Only queued, so turn the lamp off first and get its card into the PHDU.
                         if lampPower != 0:
                             self.lamp(lamp, 0, cmd)
+                            self.stopPhotodiode(cmd)
+                        self._doFinishRamp(cmd)
+                        if self.photodiodeTable and self.lampSamples is not None:
+                            self.rampBuffer.addTable(self.lampSamples.table(), extname='PHOTODIODE')
+                        self.rampBuffer.finishFile()
+                        self.rampIntegrations.append(self.nread * self.readTime)
                         if self.doStopRamp:
                             cmd.diag('text="idling ASIC and clearing SAM FIFO"')
                             self.sam.idleAsic()
+                        elif ramp + 1 < nramp:
+                            # Get the next visit now, not in the middle of its first read.
+                            rampFiles.append(self._newRampFile(cmd, None))
+                            rampReporters.append(rampFiles[-1].reporter)
                         return self.doStopRamp is not True
 
                     return True
@@ -1107,9 +1506,10 @@ class HxCmd(object):
                 runThreaded = False
                 sam.fileGenerator = self.fileGenerator
                 noFiles = False
-                rampReporter = None
+                rampReporters = None
 
                 def readCB(ramp, group, read, filename, image):
+                    self.arbiter.frameGap()
                     cmd.inform('hxread=%s,%d,%d' % (filename, group, read))
                     if read == nread-1:
                         self.getLastState(lamp, lampPower, cmd)
@@ -1123,7 +1523,7 @@ class HxCmd(object):
 
             rampArgs = (cmd, sam, nramp, nreset, nread, ndrop, visit,
                         exptype, outputReset, readoutSize,
-                        noFiles, rampReporter, headerCB, readCB, t0)
+                        noFiles, rampReporters, headerCB, readCB, t0)
             if runThreaded:
                 cmd.debug(f'text="launching ramp thread, with {len(threading.enumerate())} active threads: {threading.enumerate()}"')
                 rampThread = threading.Thread(target=self.runRamp, name=f'ramp_{visit}',
@@ -1138,41 +1538,93 @@ class HxCmd(object):
             dosplit = 'splitRamps' in cmdKeys
             self.winRead(cmd, nramp, nreset, nread, ngroup, ndrop, dosplit)
 
+    def _newRampFile(self, cmd, visit=None):
+        """Return the `RampFile` for a new PFS ramp.
+
+        Parameters
+        ----------
+        visit : `int`
+          The visit to use. If None, the next one is allocated; if 0, the
+          file is allocated but the header visit is left as 0.
+        """
+
+        seqno = visit if visit else None
+        _, finalFilename = self.fileGenerator.getNextFileset(seqno=seqno)
+        if visit is None:
+            visit = self.fileGenerator.seqno
+
+        rampFilename = finalFilename
+        if self.migrator is not None:
+            rampFilename = self.migrator.stagedPath(finalFilename)
+            self.migrator.expect(rampFilename, finalFilename)
+            closedCB = lambda reply, finalFilename=finalFilename: self.migrator.enqueue(reply['path'],
+                                                                                         finalFilename)
+        else:
+            closedCB = None
+        rampReporter = ramp.Ramp(cmd, closedCB=closedCB, catalog=self.catalog,
+                                 camera=self.actor.ids.camName, finalPath=finalFilename)
+        return RampFile(visit, rampFilename, finalFilename, rampReporter)
+
+    def startRampTimes(self, cmd, visit, rampN, nreset, nread, framesPerRamp):
+        """Set and advertise the frame timing of ramp rampN of a back-to-back sequence.
+
+        The ramps follow each other with no gaps, so ramp rampN's resets
+        start rampN*framesPerRamp frames after the DAQ output start.
+        """
+
+        rampStart = self.daqStart + rampN*framesPerRamp*self.readTime
+        self.read0Start = rampStart + nreset*self.readTime
+        _, resetStartStamp = isoTs(rampStart)
+        _, self.read0StartStamp = isoTs(self.read0Start)
+        self.exptime = nread * self.readTime
+        cmd.inform(f'readTimes={visit},{resetStartStamp},{self.read0StartStamp},{self.readTime:0.3f}')
+
     def runRamp(self, cmd, sam,
                 nramp, nreset, nread, ndrop, visit,
                 exptype, outputReset, readoutSize,
-                noFiles, rampReporter, headerCB, readCB, t0):
-        """Run and finish a fully prepared ramp.
+                noFiles, rampReporters, headerCB, readCB, t0):
+        """Run and finish a fully prepared ramp, or sequence of ramps.
 
         This method is intended to be callable as a Thread target.
+        rampReporters is the list of the `ramp.Ramp` for each ramp's file,
+        which the read callback might append to, or None.
         """
 
         self.rampRunning = True
+        arbiter = self.arbiter
+        readout = (arbiter.readout(f'ramp_{visit}', timeout=self.hardwareTimeout) if arbiter is not None
+                   else contextlib.nullcontext(0.0))
         try:
-            sam.takeRamp(nResets=nreset, nReads=nread, nRamps=nramp,
-                         exptype=exptype,
-                         outputReset=outputReset,
-                         actualFrameSize=readoutSize,
-                         readCallback=readCB)
+            with readout as waited:
+                self._reportHardwareWait(cmd, f'ramp_{visit}', waited)
+                try:
+                    sam.takeRamp(nResets=nreset, nReads=nread, nRamps=nramp,
+                                 exptype=exptype,
+                                 outputReset=outputReset,
+                                 actualFrameSize=readoutSize,
+                                 readCallback=readCB)
+                finally:
+                    sam.overrideFrameSize(None)
         except Exception as e:
             cmd.fail(f'text="ramp failed! -- {e}"')
             return
         finally:
             cmd.diag(f'text="closing FITS file from read thread..."')
             self.rampRunning = False
-            sam.overrideFrameSize(None)
 
         cmd.inform('text="acquisition done; waiting for files to be closed."')
         t1 = time.time()
         dt = t1-t0
         cmd.inform('text="%d ramps, elapsed=%0.3f, perRamp=%0.3f, perRead=%0.3f"' %
                    (nramp, dt, dt/nramp, dt/(nramp*(nread+nreset+ndrop))))
-        # Now possibly wait on the fitsWriter processes.
-        if rampReporter is not None:
+        # Now possibly wait on the ramp writer process. Only the last
+        # files can still be open: the others were closed while the
+        # following ramps were read.
+        if rampReporters is not None:
             waitFor = 60
             waitUntil = time.time() + waitFor
             while True:
-                if rampReporter.isFinished:
+                if all(r.isFinished for r in rampReporters):
                     break
                 now = time.time()
                 if now > waitUntil:
@@ -1181,6 +1633,9 @@ class HxCmd(object):
                 time.sleep(0.5)
         t1 = time.time()
         dt = t1-t0
+        if rampReporters is not None and self.rampIntegrations:
+            integTime = sum(self.rampIntegrations)
+            cmd.inform(f'dutyCycle={len(self.rampIntegrations)},{integTime:0.3f},{dt:0.3f},{integTime/dt:0.3f}')
         cmd.finish('text="%d ramps, elapsed=%0.3f, perRamp=%0.3f, perRead=%0.3f"' %
                    (nramp, dt, dt/nramp, dt/(nramp*(nread+nreset+ndrop))))
 
@@ -1214,8 +1669,11 @@ class HxCmd(object):
           - any _END cards
         If the ramp is stopped, also update the W_H4NRED card.
 
-        WARNING: if a card is *added* to the PHDU, any later cards to patch will
-                 not be patched but instead added in duplicate to the PHDU.
+        The PHDU is created with space reserved for all of these (see
+        `phduReserveCards`), and the writer overwrites the header in place. Cards
+        are replaced by name, so nothing is duplicated. If the cards do not fit,
+        the amendment is refused: the ramp reporter warns, and the file keeps
+        its unpatched header.
         """
 
         if self.rampPatched:
@@ -1231,6 +1689,8 @@ class HxCmd(object):
         newLampCards = self.hdrMgr.genLampCards(cmd, exptime, 
                                                 visit=self.visit)
         patchCards.extend(newLampCards)
+        patchCards.extend(self.illuminatorCards())
+        patchCards.extend(self.photodiodeCards())
         patchCards.append(dict(name='W_H4PTCH', value=True, comment='PHDU has been patched'))
 
         for c in patchCards:
@@ -1238,6 +1698,55 @@ class HxCmd(object):
         self.logger.info('amending PHDU...')
         self.rampBuffer.amendPHDU(patchCards)
 
+    @staticmethod
+    def migrationKey(status):
+        return (f'migration={status["nQueued"]},{status["backlogMB"]:0.1f},{status["oldestAge"]:0.1f},'
+                f'{status["lastRate"]:0.1f},{qstr(status["lastError"] or "")}')
+
+    def migrationStatus(self, cmd):
+        """Report the backlog of staged ramps waiting to be moved to their final paths. """
+
+        if self.migrator is None:
+            cmd.finish('text="ramps are not staged: no stagingRoot configured"')
+            return
+        cmd.finish(self.migrationKey(self.migrator.status()))
+
+    def queryRampCatalog(self, cmd):
+        """List the catalogued ramps matching the given visit, exptype, closing time, or early stop. """
+
+        if self.catalog is None:
+            cmd.fail('text="no ramp catalogue"')
+            return
+
+        cmdKeys = cmd.cmd.keywords
+        visit = cmdKeys['visit'].values[0] if 'visit' in cmdKeys else None
+        exptype = cmdKeys['exptype'].values[0].upper() if 'exptype' in cmdKeys else None
+        since = cmdKeys['since'].values[0] if 'since' in cmdKeys else None
+        limit = cmdKeys['limit'].values[0] if 'limit' in cmdKeys else 20
+        stopped = True if 'stopped' in cmdKeys else None
+
+        rows = self.catalog.find(visit=visit, camera=self.actor.ids.camName, exptype=exptype,
+                                 since=since, stopped=stopped, limit=limit)
+        for r in rows:
+            cmd.inform(f'rampCatalogEntry={r["visit"]},{qstr(r["path"])},{qstr(r["exptype"] or "")},'
+                       f'{r["nread"] or 0},{r["nreadDone"]},{r["stoppedAt"] or 0},{int(bool(r["patched"]))},'
+                       f'{r["fileSize"]},{r["dataSum"]},{qstr(r["closedAt"])}')
+        cmd.finish(f'text="{len(rows)} matching ramps"')
+
+    def phduReserveCards(self):
+        """Return the number of PHDU cards which _doFinishRamp and stopRamp might patch.
+
+        All the time cards, up to `lampCardReserve` lamp cards, W_H4NRED,
+        and W_H4PTCH. With the optics lab illuminator, also the two lamp time
+        cards and the photodiode summary cards.
+        """
+
+        nCards = self.nTimeCards + self.lampCardReserve + 2
+        if self.actor.ids.camName == 'n8':
+            from hxActor.Commands import opticslab
+            nCards += 2 + opticslab.nPhotodiodeCards
+        return nCards
+
     def winRead(self, cmd, nramp, nreset, nread, ngroup, ndrop, dosplit):
         nrampCmds = nramp if dosplit else 1
         self.flushProgramInput(cmd, doFinish=False)
@@ -1329,7 +1838,9 @@ class HxCmd(object):
         self.controller.grabAllH4Info()
         self.getVoltageSettings(cmd, doFinish=False)
         self.getMainVoltages(cmd, doFinish=False)
+        self.controller.daqState.skipSequence = list(self.skipSequence)
         self.controller.daqState.isValid =  True
+        self.controller.saveDaqState()
 
         if doFinish:
             cmd.finish()
@@ -1370,47 +1881,25 @@ class HxCmd(object):
         """Return the H4 cards for the PHDU. Consumes what .grabAllH4Info() gathered
         """
 
-        voltageCardNames = dict(VReset='W_4VRST',
-                                DSub='W_4DSUB',
-                                VBiasGate='W_4VBG',
-                                VBiasPower='W_4VBP',
-                                CellDrain='W_4CDRN',
-                                Drain='W_4DRN',
-                                VDDA='W_4VDDA',
-                                VDD='W_4VDD',
-                                Vrefmain='W_4VRM')
-
-        # *Start* with the MHS dictionary cards, then overwrite what we know better about.
+        # *Start* with the MHS dictionary cards, then override what we know better about.
         cards = self._getH4MhsHeader(cmd)
+        newCards = []
 
         daqState = self.controller.daqState
 
         for i, reg in enumerate(self.controller.daqState.spiRegisters):
-            cards.append(dict(name=f'W_4SPI{i+1:02d}', value=reg, comment=f'H4 SPI register {i+1}'))
+            newCards.append(dict(name=f'W_4SPI{i+1:02d}', value=reg, comment=f'H4 SPI register {i+1}'))
         for name, setting in daqState.voltageSettings.items():
-            cardName = voltageCardNames.get(name)
+            cardName = cardTable.h4VoltageCardNames.get(name)
             if cardName is None:
                 continue
-            cards.append(dict(name=f'{cardName}S', value=np.round(setting, 4), comment=f'[V] {name} setting'))
+            newCards.append(dict(name=f'{cardName}S', value=np.round(setting, 4), comment=f'[V] {name} setting'))
 
         for name, reading in daqState.voltageReadings.items():
-            cardName = voltageCardNames.get(name)
+            cardName = cardTable.h4VoltageCardNames.get(name)
             if cardName is None:
                 continue
-            cards.append(dict(name=f'{cardName}V', value=np.round(reading, 4), comment=f'[V] {name} reading'))
-
-        def _replaceCard(cards, newCard):
-            for c_i, c in enumerate(cards):
-                if c['name'] == newCard['name']:
-                    cards.pop(c_i)
-                    break
-            cards.append(newCard)
-
-        def _replaceCardValue(cards, cardName, newValue):
-            for c_i, c in enumerate(cards):
-                if c['name'] == cardName:
-                    c['value'] = newValue
-                    break
+            newCards.append(dict(name=f'{cardName}V', value=np.round(reading, 4), comment=f'[V] {name} reading'))
 
         cfg = daqState.hxConfig
         frameTime = self.calcFrameTime()
@@ -1422,37 +1911,43 @@ class HxCmd(object):
             self.rampGain = 9999.0
             cmd.warn(f'text="failed to get configured gain: {e}"')
             
-        _replaceCard(cards, dict(name="W_FRMTIM", value=frameTime,
-                                 comment='[s] individual read time, per ASIC'))
-        _replaceCard(cards, dict(name="W_H4FRMT", value=frameTime,
-                                 comment='[s] individual read time, per ASIC'))
-        _replaceCard(cards, dict(name='W_H4IRP', value=bool(cfg.h4Interleaving),
-                                 comment='whether we are using IRP-enabled firmware'))
-        _replaceCard(cards, dict(name='W_H4IRPN', value=int(cfg.interleaveRatio),
-                                 comment='the number of data pixels per ref pixel'))
-        _replaceCard(cards, dict(name='W_H4IRPO', value=int(cfg.interleaveOffset),
-                                 comment='how many data pixels before the ref pixel'))
-
-        _replaceCard(cards, dict(name='W_H4NCHN', value=int(cfg.numOutputs),
-                                 comment='how many readout channels we have'))
-        _replaceCard(cards, dict(name='W_H4GNST', value=int(cfg.preampGain),
-                                 comment='the ASIC preamp gain setting'))
-        _replaceCard(cards, dict(name='W_H4GAIN', value=preampGain,
-                                 comment='the ASIC preamp gain factor'))
+        newCards.append(dict(name="W_FRMTIM", value=frameTime,
+                             comment='[s] individual read time, per ASIC'))
+        newCards.append(dict(name="W_H4FRMT", value=frameTime,
+                             comment='[s] individual read time, per ASIC'))
+        newCards.append(dict(name='W_H4IRP', value=bool(cfg.h4Interleaving),
+                             comment='whether we are using IRP-enabled firmware'))
+        newCards.append(dict(name='W_H4IRPN', value=int(cfg.interleaveRatio),
+                             comment='the number of data pixels per ref pixel'))
+        newCards.append(dict(name='W_H4IRPO', value=int(cfg.interleaveOffset),
+                             comment='how many data pixels before the ref pixel'))
+
+        newCards.append(dict(name='W_H4NCHN', value=int(cfg.numOutputs),
+                             comment='how many readout channels we have'))
+        newCards.append(dict(name='W_H4GNST', value=int(cfg.preampGain),
+                             comment='the ASIC preamp gain setting'))
+        newCards.append(dict(name='W_H4GAIN', value=preampGain,
+                             comment='the ASIC preamp gain factor'))
 
         try:
             ver = self.sam.instrumentTweaks.formatVersion
         except:
             cmd.warn('text="No defined H4 ramp format version, using 0"')
             ver = 0
-        _replaceCard(cards, dict(name='W_4FMTVR', value=ver,
-                                 comment='Data format version'))
+        newCards.append(dict(name='W_4FMTVR', value=ver,
+                             comment='Data format version'))
+
+        # Replace everything in one pass, rather than searching the list for each card.
+        cards = cardTable.mergeCards(cards, newCards)
 
         try:
             serials = self.actor.actorConfig['serialNumbers']
-            _replaceCardValue(cards, 'W_SRH4', serials['h4'])
-            _replaceCardValue(cards, 'W_SRASIC', serials['asic'])
-            _replaceCardValue(cards, 'W_SRSAM', serials['sam'])
+            serialValues = dict(W_SRH4=serials['h4'],
+                                W_SRASIC=serials['asic'],
+                                W_SRSAM=serials['sam'])
+            for c in cards:
+                if c['name'] in serialValues:
+                    c['value'] = serialValues[c['name']]
         except Exception as e:
             cmd.warn(f'text="failed to set H4 serial cards: {e}"')
 
@@ -1567,7 +2062,8 @@ class HxCmd(object):
 
             timeCards, exptime = self.getTimeCards(cmd=cmd, exptype=exptype,
                                                    obstime=obstime)
-                
+            self.nTimeCards = len(timeCards)
+
             hxCards = self.genAllH4Cards(cmd)
             newCards = hdrMgr.finishHeaderKeys(cmd, visit,
                                                timeCards, expTime=exptime,
@@ -1612,9 +2108,71 @@ class HxCmd(object):
         return allCards
 
     def reloadLogic(self, cmd):
+        self.controller.invalidateDaqState()
         self.sam.reloadLogic()
         cmd.finish()
 
+    def reloadModules(self, cmd):
+        """Reload the already imported helper modules, for development.
+
+        Objects which already exist (the writer process, the hxhal
+        controller, the command sets) keep their old code: reload the
+        command sets or reconnect to pick up new classes.
+        """
+
+        for name in reloadableModules:
+            module = sys.modules.get(name, None)
+            if module is None:
+                continue
+            t0 = time.time()
+            try:
+                importlib.reload(module)
+            except Exception as e:
+                cmd.fail(f'text="failed to reload {name}: {e}"')
+                return
+            cmd.inform(f'text="reloaded {name} in {(time.time()-t0)*1000:0.1f} ms"')
+        cmd.finish()
+
+    def startupProfile(self, cmd):
+        """Report what importing the actor's modules costs, from a fresh interpreter.
+
+        Runs `python -X importtime` on the command and controller modules,
+        and reports the total and the slowest (by cumulative time) imports.
+        """
+
+        cmdKeys = cmd.cmd.keywords
+        limit = cmdKeys['limit'].values[0] if 'limit' in cmdKeys else 15
+
+        modules = ('hxActor.Commands.HxCmd', 'hxActor.Controllers.hxhal')
+        imports = '; '.join(f'import {m}' for m in modules)
+        try:
+            proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', imports],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                  timeout=120, text=True)
+        except Exception as e:
+            cmd.fail(f'text="failed to run import profile: {e}"')
+            return
+
+        # Lines look like "import time:       412 |       1520 |   numpy.core"
+        times = []
+        for line in proc.stderr.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            fields = line[len('import time:'):].split('|')
+            try:
+                selfUs, cumulativeUs = int(fields[0]), int(fields[1])
+            except ValueError:
+                continue
+            times.append((cumulativeUs, selfUs, fields[2].strip()))
+        if not times:
+            cmd.fail(f'text="no import profile from {modules}: {qstr(proc.stderr[-200:])}"')
+            return
+
+        total = sum(t[1] for t in times)
+        for cumulativeUs, selfUs, name in sorted(times, reverse=True)[:limit]:
+            cmd.inform(f'importTime={qstr(name)},{cumulativeUs/1000:0.1f},{selfUs/1000:0.1f}')
+        cmd.finish(f'text="importing {len(times)} modules took {total/1000:0.1f} ms"')
+
     def setReadSpeed(self, cmd):
         cmdKeys = cmd.cmd.keywords
 
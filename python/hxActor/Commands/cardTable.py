@@ -0,0 +1,216 @@
+"""Declarative tables of FITS cards made from actor model keys.
+
+Each `CardSpec` names a model key, which of its values to use, how to
+convert it, and the card to put it in. A `CardTable` compiles a list of
+specs once: the specs are grouped by key, so that each key is looked up
+once per header however many cards come from it, and the cards are
+returned as one list, to be added to a header in one batch with
+`addCards`.
+
+    python -m hxActor.Commands.cardTable
+
+times header assembly the old way (one lookup and one `Header.append` per
+card) and the compiled way.
+"""
+
+import argparse
+import collections
+import logging
+import time
+
+import astropy.io.fits as pyfits
+
+# keyName : the model key
+# cardName : the FITS keyword
+# idx : the index of the value in the key, or None for the key's .getValue()
+# cnv : a conversion function, or None
+# comment : the FITS comment
+CardSpec = collections.namedtuple('CardSpec', ('keyName', 'cardName', 'idx', 'cnv', 'comment'))
+
+charisCardSpecs = (
+    CardSpec('grism', 'Y_GRISM', 0, None, 'deprecated: grism position'),
+    CardSpec('grism', 'Y_PRISM', 0, None, 'prism position'),
+    # Was CHARIS.FILTER.NAME
+    CardSpec('filterSlot', 'Y_FLTNAM', 1, None, 'current filter name'),
+    # Was CHARIS.FILTER.SLOT
+    CardSpec('filterSlot', 'Y_FLTSLT', 0, int, 'current filter slot'),
+    # Was CHARIS.SHUTTER
+    CardSpec('shutter', 'Y_SHUTTR', 1, None, 'shutter position'),
+    # Was CHARIS.LASER.ENABLED
+    CardSpec('laserState', 'Y_LSRENB', 0, bool, 'is laserState enabled'),
+    # Was CHARIS.LASER.POWER
+    CardSpec('laserState', 'Y_LSRPWR', 2, None, 'laser power, percent'),
+    # Was CHARIS.LASER.ALARMS
+    CardSpec('laserState', 'Y_LSRALM', 3, None, 'laser alarms'),
+    # Was CHARIS.TEMPS.%d
+    *[CardSpec('temps', 'Y_TEMP%02d' % i, i, None, 'temperature sensor %d' % i) for i in range(10)],
+    # Global Subaru aliases
+    CardSpec('filterSlot', 'FILTER01', 1, None, 'current filter name'),
+    CardSpec('grism', 'DISPERSR', 0, None, 'prism position'),
+)
+
+# The H4 voltage cards, by hxhal voltage name. The setting cards get an 'S'
+# suffix, the reading cards a 'V'.
+h4VoltageCardNames = dict(VReset='W_4VRST',
+                          DSub='W_4DSUB',
+                          VBiasGate='W_4VBG',
+                          VBiasPower='W_4VBP',
+                          CellDrain='W_4CDRN',
+                          Drain='W_4DRN',
+                          VDDA='W_4VDDA',
+                          VDD='W_4VDD',
+                          Vrefmain='W_4VRM')
+
+class CardTable(object):
+    def __init__(self, specs, logger=None):
+        """Compile a sequence of `CardSpec` into one extractor.
+
+        Parameters
+        ----------
+        specs : sequence of `CardSpec`
+          The cards, in the order they should appear in the header.
+        """
+
+        self.logger = logger if logger is not None else logging.getLogger('cardTable')
+        self.specs = tuple(specs)
+
+        names = [s.cardName for s in self.specs]
+        if len(set(names)) != len(names):
+            raise ValueError(f'duplicate card names in table: {sorted(n for n in set(names) if names.count(n) > 1)}')
+
+        # For each key, in order of first use: the output slots it fills.
+        byKey = collections.OrderedDict()
+        for slot, spec in enumerate(self.specs):
+            byKey.setdefault(spec.keyName, []).append((slot, spec.idx, spec.cnv,
+                                                       spec.cardName, spec.comment))
+        self.byKey = tuple((keyName, tuple(fields)) for keyName, fields in byKey.items())
+
+    def __len__(self):
+        return len(self.specs)
+
+    def cards(self, keyVarDict, cmd=None):
+        """Return the (name, value, comment) cards for the current values of the model keys.
+
+        As with `actorFits.makeCardFromKey`, a failure does not raise: the
+        card gets a None value and the error as its comment, and we warn
+        once per failed key.
+        """
+
+        cards = [None] * len(self.specs)
+        for keyName, fields in self.byKey:
+            try:
+                keyVar = keyVarDict[keyName]
+            except KeyError:
+                self._warn(cmd, f'failed to fetch {keyName}')
+                for slot, idx, cnv, cardName, comment in fields:
+                    cards[slot] = (cardName, None, f'failed to fetch {keyName}')
+                continue
+
+            failures = []
+            for slot, idx, cnv, cardName, comment in fields:
+                try:
+                    val = keyVar.getValue() if idx is None else keyVar[idx]
+                    if cnv is not None:
+                        val = cnv(val)
+                except Exception as e:
+                    failures.append(cardName)
+                    cards[slot] = (cardName, None, f'failed to get {keyName}[{idx}]: {e}')
+                    continue
+                cards[slot] = (cardName, val, comment)
+            if failures:
+                self._warn(cmd, f'failed to get {keyName} values for {",".join(failures)}')
+
+        return cards
+
+    def _warn(self, cmd, errStr):
+        if cmd is not None:
+            cmd.warn('text="%s"' % (errStr))
+        else:
+            self.logger.warning(errStr)
+
+def addCards(hdr, cards):
+    """Add cards to the end of a `pyfits.Header`, in one batch.
+
+    Appending cards one at a time costs a search of the header for each;
+    this does not.
+    """
+
+    hdr.extend(cards, strip=False, end=True)
+    return hdr
+
+def mergeCards(cards, newCards):
+    """Return card dicts with newCards replacing any cards of the same name, and appended to the end.
+
+    Parameters
+    ----------
+    cards : list of card dicts
+    newCards : list of card dicts
+    """
+
+    newNames = {c['name'] for c in newCards}
+    return [c for c in cards if c['name'] not in newNames] + list(newCards)
+
+class _FakeKeyVar(object):
+    """Just enough of an opscore KeyVar for the benchmark. """
+
+    def __init__(self, values):
+        self.values = values
+
+    def __getitem__(self, idx):
+        return self.values[idx]
+
+    def getValue(self):
+        return self.values[0] if len(self.values) == 1 else self.values
+
+def main(argv=None):
+    """Time CHARIS header assembly, card by card and compiled. """
+
+    parser = argparse.ArgumentParser(description='benchmark CHARIS card table header assembly')
+    parser.add_argument('--count', type=int, default=500, help='how many headers to build each way')
+    parser.add_argument('--baseCards', type=int, default=300,
+                        help='how many cards the Gen2 header has before we add ours')
+    args = parser.parse_args(argv)
+
+    keyVarDict = dict(grism=_FakeKeyVar(['J']),
+                      filterSlot=_FakeKeyVar([3, 'Broadband']),
+                      shutter=_FakeKeyVar([1, 'open']),
+                      laserState=_FakeKeyVar([1, 0, 45.0, 'none']),
+                      temps=_FakeKeyVar([80.0 + i for i in range(10)]))
+    baseHdr = ''.join(pyfits.Card('GEN2%04d' % i, i, 'a Gen2 card').image for i in range(args.baseCards))
+    baseHdr += 'END'.ljust(80)
+
+    def cardByCard():
+        hdr = pyfits.Header.fromstring(baseHdr)
+        for spec in charisCardSpecs:
+            val = keyVarDict[spec.keyName][spec.idx]
+            if spec.cnv is not None:
+                val = spec.cnv(val)
+            hdr.append((spec.cardName, val, spec.comment))
+        return hdr
+
+    table = CardTable(charisCardSpecs)
+
+    def compiled():
+        hdr = pyfits.Header.fromstring(baseHdr)
+        return addCards(hdr, table.cards(keyVarDict))
+
+    def gen2Only():
+        return pyfits.Header.fromstring(baseHdr)
+
+    assert list(cardByCard().items()) == list(compiled().items())
+
+    for name, func in ('gen2 header only', gen2Only), ('card by card', cardByCard), ('compiled', compiled):
+        t0 = time.perf_counter()
+        for i in range(args.count):
+            func()
+        dt = (time.perf_counter() - t0) / args.count
+        print('%-18s %7.3f ms per header' % (name, dt*1000))
+
+    t0 = time.perf_counter()
+    for i in range(args.count):
+        table.cards(keyVarDict)
+    dt = (time.perf_counter() - t0) / args.count
+    print('%-18s %7.3f ms per header' % ('card extraction', dt*1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+"""Run slow actor commands on worker threads, off the twisted reactor.
+
+Commands which take seconds (bias voltage surveys, reconnects, firmware
+downloads) would otherwise hold up every other command, including
+`status` and `ramp finish`. A `CommandPool` runs them on a small pool
+of worker threads, at most a given number at a time for each hardware
+resource: commands waiting for a busy resource are queued without
+occupying a worker. Their replies are passed back to the reactor thread
+through a `ThreadedCmd`.
+
+    python -m hxActor.Commands.commandPool
+
+times a stand-in fast command while a stand-in voltage survey runs, with
+and without the pool.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+def callFromReactor(func, *args, **kwargs):
+    """Call func in the twisted reactor thread: now if we are in it, else when it next can. """
+
+    from twisted.internet import reactor
+    from twisted.python import threadable
+
+    if threadable.isInIOThread():
+        func(*args, **kwargs)
+    else:
+        reactor.callFromThread(func, *args, **kwargs)
+
+class ThreadedCmd(object):
+    """Wrap an actor command so that its replies are made from the reactor thread.
+
+    Everything but the replies is passed through to the wrapped command.
+    """
+
+    replyMethods = frozenset(('inform', 'respond', 'diag', 'debug', 'warn', 'fail', 'finish'))
+
+    def __init__(self, cmd, callFromThread=callFromReactor):
+        self._cmd = cmd
+        self._callFromThread = callFromThread
+
+    def __getattr__(self, name):
+        attr = getattr(self._cmd, name)
+        if name not in self.replyMethods:
+            return attr
+
+        def reply(*args, **kwargs):
+            self._callFromThread(attr, *args, **kwargs)
+        return reply
+
+# One command waiting for or running on a worker. The times are from time.time().
+Job = collections.namedtuple('Job', ('name', 'resource', 'cmd', 'func', 'queuedAt'))
+
+class CommandPool(object):
+    def __init__(self, maxWorkers=4, limits=None, defaultLimit=1,
+                 callFromThread=callFromReactor, logger=None):
+        """A worker pool for slow commands, with a concurrency limit per resource.
+
+        Parameters
+        ----------
+        maxWorkers : `int`
+          The number of worker threads.
+        limits : `dict`
+          For each resource name, how many of its commands can run at once.
+        defaultLimit : `int`
+          The limit for resources not in limits.
+        callFromThread : callable
+          How to get a reply made in the reactor thread.
+        """
+
+        self.logger = logger if logger is not None else logging.getLogger('commandPool')
+        self.maxWorkers = maxWorkers
+        self.limits = dict(limits) if limits else dict()
+        self.defaultLimit = defaultLimit
+        self.callFromThread = callFromThread
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers,
+                                                              thread_name_prefix='hxCmd')
+        self.lock = threading.Lock()
+        self.running = collections.defaultdict(list)
+        self.pending = collections.defaultdict(collections.deque)
+
+    def limit(self, resource):
+        return self.limits.get(resource, self.defaultLimit)
+
+    def submit(self, name, cmd, func, resource='sam'):
+        """Run func(cmd) on a worker, once resource has a free slot.
+
+        func is passed a `ThreadedCmd`, and should make all its replies
+        through that. If func raises, the command is failed.
+        """
+
+        job = Job(name, resource, cmd, func, time.time())
+        with self.lock:
+            if len(self.running[resource]) < self.limit(resource):
+                self._start(job)
+                return
+            self.pending[resource].append(job)
+            busyWith = ','.join(j.name for j in self.running[resource])
+            nAhead = len(self.pending[resource]) - 1
+        cmd.diag(f'text="{name} queued for {resource} behind {busyWith} and {nAhead} more"')
+
+    def _start(self, job):
+        """Hand a job to a worker. Call with the lock held. """
+
+        self.running[job.resource].append(job)
+        self.executor.submit(self._run, job)
+
+    def _run(self, job):
+        threadedCmd = ThreadedCmd(job.cmd, callFromThread=self.callFromThread)
+        t0 = time.time()
+        try:
+            job.func(threadedCmd)
+        except Exception as e:
+            self.logger.warning(f'{job.name} failed', exc_info=True)
+            threadedCmd.fail(f'text="{job.name} failed: {e}"')
+        finally:
+            t1 = time.time()
+            self.logger.info(f'{job.name} on {job.resource}: queued {t0-job.queuedAt:0.3f}s, ran {t1-t0:0.3f}s')
+            with self.lock:
+                self.running[job.resource].remove(job)
+                if self.pending[job.resource]:
+                    self._start(self.pending[job.resource].popleft())
+
+    def isBusy(self, resource):
+        """Return whether resource has any commands running or queued. """
+
+        with self.lock:
+            return bool(self.running.get(resource) or self.pending.get(resource))
+
+    def status(self):
+        """Return, for each resource, the names of its running and queued commands. """
+
+        with self.lock:
+            resources = sorted(set(self.running) | set(self.pending))
+            return {r: dict(running=[j.name for j in self.running[r]],
+                            queued=[j.name for j in self.pending[r]])
+                    for r in resources}
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+def commandPool(actor, maxWorkers=4, limits=None):
+    """Return the actor's command pool, creating it if necessary. """
+
+    pool = getattr(actor, 'hxCommandPool', None)
+    if pool is None:
+        pool = CommandPool(maxWorkers=maxWorkers, limits=limits)
+        actor.hxCommandPool = pool
+    return pool
+
+class _FakeCmd(object):
+    """Just enough of an actor command for the benchmark: records its replies and their threads. """
+
+    def __init__(self, name):
+        self.name = name
+        self.replies = []
+        self.finished = threading.Event()
+
+    def _reply(self, level, text=''):
+        self.replies.append((level, text, threading.current_thread().name))
+        if level in ('finish', 'fail'):
+            self.finished.set()
+
+    def inform(self, text=''):
+        self._reply('inform', text)
+
+    def diag(self, text=''):
+        self._reply('diag', text)
+
+    def warn(self, text=''):
+        self._reply('warn', text)
+
+    def fail(self, text=''):
+        self._reply('fail', text)
+
+    def finish(self, text=''):
+        self._reply('finish', text)
+
+def main(argv=None):
+    """Time a fast command arriving while slow ones run, in the command thread and on the pool. """
+
+    parser = argparse.ArgumentParser(description='benchmark fast command latency during slow commands')
+    parser.add_argument('--nVoltages', type=int, default=9, help='voltages in the stand-in survey')
+    parser.add_argument('--sampleTime', type=float, default=0.3, help='seconds per voltage sample')
+    parser.add_argument('--nFast', type=int, default=10, help='fast commands to send during the survey')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    # A stand-in for the twisted reactor: one thread running queued calls in order.
+    calls = queue.Queue()
+
+    def reactorLoop():
+        while True:
+            call = calls.get()
+            if call is None:
+                break
+            func, callArgs, callKwargs = call
+            func(*callArgs, **callKwargs)
+
+    def callFromThread(func, *callArgs, **callKwargs):
+        calls.put((func, callArgs, callKwargs))
+
+    def voltageSurvey(cmd):
+        for i in range(args.nVoltages):
+            time.sleep(args.sampleTime)
+            cmd.inform(f'text="voltage {i} = {i*0.1:0.3f}"')
+        cmd.finish()
+
+    def status(cmd):
+        cmd.finish('text="status"')
+
+    pool = CommandPool(callFromThread=callFromThread, limits=dict(sam=1))
+
+    for mode in 'reactor', 'pool':
+        reactor = threading.Thread(target=reactorLoop, name='reactor', daemon=True)
+        reactor.start()
+
+        survey = _FakeCmd('getVoltages')
+        if mode == 'pool':
+            callFromThread(pool.submit, 'getVoltages', survey, voltageSurvey, resource='sam')
+        else:
+            callFromThread(voltageSurvey, survey)
+        # Queue behind the survey, to show the per-resource limit.
+        second = _FakeCmd('getAsicPower')
+        if mode == 'pool':
+            callFromThread(pool.submit, 'getAsicPower', second, voltageSurvey, resource='sam')
+
+        latencies = []
+        for i in range(args.nFast):
+            fastCmd = _FakeCmd('status')
+            t0 = time.perf_counter()
+            callFromThread(status, fastCmd)
+            fastCmd.finished.wait()
+            latencies.append(time.perf_counter() - t0)
+            time.sleep(args.nVoltages * args.sampleTime / args.nFast / 2)
+
+        survey.finished.wait()
+        if mode == 'pool':
+            second.finished.wait()
+        calls.put(None)
+        reactor.join()
+
+        replyThreads = sorted(set(t for _, _, t in survey.replies))
+        print(f'{mode:8s}: status latency mean {1000*sum(latencies)/len(latencies):8.2f} ms, '
+              f'max {1000*max(latencies):8.2f} ms; survey replies made from {replyThreads}')
+
+    pool.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,22 @@
-from importlib import reload
-
+import collections
+import concurrent.futures
 import logging
-import numpy as np
+import queue
 import socket
+import threading
 import time
 
+import numpy as np
+
 from fpga import opticslab
-reload(opticslab)
 
 logger = logging.getLogger('illuminati')
 logger.setLevel(logging.DEBUG)
 
+illuminatorAddr = 'illuminati.pfs', 6563
+
 def illuminatorCommand(cmdStr, timeout=5.0):
-    host = 'illuminati.pfs'
-    port = 6563
+    host, port = illuminatorAddr
 
     logger.info('illuminator command: %s', cmdStr)
     
@@ -37,6 +40,107 @@ def illuminatorCommand(cmdStr, timeout=5.0):
     
     return data.decode('latin-1')
 
+# What an IlluminatorClient command future resolves to. The times are from time.time().
+LampCommand = collections.namedtuple('LampCommand', ('cmdStr', 'reply', 'queuedAt', 'sentAt', 'doneAt'))
+
+class IlluminatorClient(threading.Thread):
+    def __init__(self, addr=illuminatorAddr, connectTimeout=3.0, timeout=5.0):
+        """A long-lived illuminator client, which never blocks its callers.
+
+        Commands are queued and sent in order by this thread, over one
+        connection which is kept open between commands. If a reused
+        connection fails, the command is retried once on a new one.
+        Each command returns a `concurrent.futures.Future`, which
+        resolves to a `LampCommand` with the command's timestamps.
+        """
+        super(IlluminatorClient, self).__init__(name='illuminator', daemon=True)
+
+        self.addr = addr
+        self.connectTimeout = connectTimeout
+        self.timeout = timeout
+        self.sock = None
+
+        self.commands = queue.Queue()
+
+    def exit(self):
+        self.commands.put(None)
+
+    def command(self, cmdStr):
+        """Queue a command, and return a future for its `LampCommand`. """
+
+        future = concurrent.futures.Future()
+        self.commands.put((cmdStr, time.time(), future))
+        return future
+
+    def lampCmd(self, lamp, level):
+        """Queue the command to turn a lamp on at level, or all off if level is 0. """
+
+        return self.command(lampCmdStr(lamp, level))
+
+    def _connect(self):
+        self._disconnect()
+        self.sock = socket.create_connection(self.addr, self.connectTimeout)
+        self.sock.settimeout(self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+
+    def _send(self, cmdStr):
+        """Send one command and return its reply and the time it was sent. """
+
+        if self.sock is None:
+            self._connect()
+        sentAt = time.time()
+        self.sock.sendall(('%s\n' % (cmdStr)).encode('latin-1'))
+        data = self.sock.recv(1024)
+        if not data:
+            raise RuntimeError('connection closed by illuminator')
+        return data.strip().decode('latin-1'), sentAt
+
+    def run(self):
+        while True:
+            item = self.commands.get()
+            if item is None:
+                break
+            cmdStr, queuedAt, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            logger.info('illuminator command: %s', cmdStr)
+            for attempt in range(2):
+                freshConnection = self.sock is None
+                try:
+                    reply, sentAt = self._send(cmdStr)
+                except Exception as e:
+                    self._disconnect()
+                    if freshConnection or attempt > 0:
+                        logger.warning('illuminator command %r failed: %s', cmdStr, e)
+                        future.set_exception(e)
+                        break
+                    continue
+                doneAt = time.time()
+                logger.debug('cmd: %r reply=%r queued=%0.3fs sent=%0.3fs',
+                             cmdStr, reply, sentAt - queuedAt, doneAt - sentAt)
+                future.set_result(LampCommand(cmdStr, reply, queuedAt, sentAt, doneAt))
+                break
+        self._disconnect()
+
+def illuminator(actor):
+    """Return the actor's illuminator client, starting it if necessary. """
+
+    client = getattr(actor, 'illuminatorClient', None)
+    if client is None or not client.is_alive():
+        client = IlluminatorClient()
+        client.start()
+        actor.illuminatorClient = client
+    return client
+
 """
 Murdock sez:
 For GPIO 20 and 26
@@ -76,10 +180,191 @@ def getFlux(lamp=None):
     lam, scale = lamps[lamp]
     return current, lam, current*scale
 
-def lampCmd(lamp, level):
+def lampCmdStr(lamp, level):
     if lamp is None or level == 0:
-        cmdStr = 'off'
+        return 'off'
     else:
-        cmdStr = f'on {lamp} {level}'
+        return f'on {lamp} {level}'
+
+def lampCmd(lamp, level):
+    """Turn a lamp on at level, or all off if level is 0, and wait for the reply. """
+
+    return illuminatorCommand(lampCmdStr(lamp, level))
+
+class PhotodiodeSampler(threading.Thread):
+    def __init__(self, cadence=0.5, capacity=7200, readCurrent=None):
+        """Sample the photodiode current at a fixed cadence while a lamp is on.
+
+        Samples go into a numpy ring buffer, so a long ramp keeps only the
+        last `capacity` samples. `startSampling` and `stopSampling` bracket
+        a lamp exposure; nothing is read from the photodiode in between.
+
+        Parameters
+        ----------
+        cadence : `float`
+          Seconds between samples.
+        capacity : `int`
+          How many samples the ring buffer holds.
+        readCurrent : callable
+          Returns the current, in A. Default: `fpga.opticslab.getCurrent`.
+        """
+        super(PhotodiodeSampler, self).__init__(name='photodiode', daemon=True)
+
+        self.cadence = cadence
+        self.readCurrent = readCurrent if readCurrent is not None else opticslab.getCurrent
+
+        self.times = np.zeros(capacity, dtype='f8')
+        self.currents = np.zeros(capacity, dtype='f8')
+        self.nSamples = 0
+        self.nFailures = 0
+        self.lamp = None
+
+        self.lock = threading.Lock()
+        self.sampling = threading.Event()
+        self.exiting = False
+
+    def exit(self):
+        self.exiting = True
+        self.sampling.set()
+
+    def startSampling(self, lamp):
+        """Forget any old samples, and start sampling for the given lamp. """
+
+        with self.lock:
+            self.nSamples = 0
+            self.nFailures = 0
+            self.lamp = lamp
+        self.sampling.set()
+
+    def stopSampling(self):
+        """Stop sampling, and return the samples as a `PhotodiodeSamples`. """
+
+        self.sampling.clear()
+        return self.samples()
+
+    def samples(self):
+        """Return a copy of the samples so far, oldest first. """
+
+        with self.lock:
+            capacity = len(self.times)
+            n = min(self.nSamples, capacity)
+            order = np.arange(self.nSamples - n, self.nSamples) % capacity
+            return PhotodiodeSamples(self.lamp, self.times[order], self.currents[order],
+                                     self.nSamples - n, self.nFailures)
+
+    def latest(self):
+        """Return the (time, current) of the latest sample, or None. """
+
+        with self.lock:
+            if self.nSamples == 0:
+                return None
+            i = (self.nSamples - 1) % len(self.times)
+            return self.times[i], self.currents[i]
+
+    def run(self):
+        while True:
+            self.sampling.wait()
+            if self.exiting:
+                break
+            t0 = time.time()
+            try:
+                current = float(self.readCurrent())
+            except Exception as e:
+                with self.lock:
+                    self.nFailures += 1
+                if self.nFailures == 1:
+                    logger.warning('failed to read photodiode: %s', e)
+            else:
+                with self.lock:
+                    i = self.nSamples % len(self.times)
+                    self.times[i] = t0
+                    self.currents[i] = current
+                    self.nSamples += 1
+
+            # Keep to the cadence, however long the read took.
+            time.sleep(max(0.0, self.cadence - (time.time() - t0)))
+
+def finiteOrNone(value):
+    """Return value as a float, or None if it is None or not finite. """
+
+    if value is None or not np.isfinite(value):
+        return None
+    return float(value)
+
+class PhotodiodeSamples(object):
+    def __init__(self, lamp, times, currents, nDropped=0, nFailures=0):
+        """The photodiode samples from one lamp exposure, and what we derive from them. """
+
+        self.lamp = lamp
+        self.times = times
+        self.currents = currents
+        self.nDropped = nDropped
+        self.nFailures = nFailures
+
+        wavelength, scale = lamps.get(lamp, (np.nan, np.nan))
+        self.wavelength = wavelength
+        self.fluxes = currents * scale
+
+    def __len__(self):
+        return len(self.times)
+
+    def integratedFlux(self):
+        """The flux integrated over the samples, in photons, or None if that is unknown. """
+
+        if len(self) < 2:
+            return None
+        return finiteOrNone(np.sum((self.fluxes[1:] + self.fluxes[:-1]) * np.diff(self.times)) / 2)
+
+    def summary(self):
+        """Return a one-line description of the samples, for the command's replies. """
+
+        flux = self.integratedFlux()
+        fluxText = 'integrated flux %g photons' % (flux) if flux is not None else 'no integrated flux'
+        return '%d samples (%d dropped, %d failed reads), %s' % (len(self), self.nDropped,
+                                                                 self.nFailures, fluxText)
+
+    def cards(self):
+        """Return the PHDU cards summarizing the samples.
+
+        Always the same `nPhotodiodeCards` cards, so that they fit in the
+        reserved PHDU space. FITS has no NaN, so values we cannot know
+        (no samples, or a lamp we have no calibration for) are undefined.
+        """
+
+        n = len(self)
+        if n == 0:
+            mean = lo = hi = meanFlux = None
+        else:
+            mean, lo, hi = self.currents.mean(), self.currents.min(), self.currents.max()
+            meanFlux = self.fluxes.mean()
+        return [dict(name='W_OLNSMP', value=n, comment='number of photodiode samples'),
+                dict(name='W_OLLPWV', value=finiteOrNone(self.wavelength),
+                     comment='[nm] Lamp center wavelength'),
+                dict(name='W_OLLPCR', value=finiteOrNone(mean), comment='[A] mean photodiode current'),
+                dict(name='W_OLCRMN', value=finiteOrNone(lo), comment='[A] min photodiode current'),
+                dict(name='W_OLCRMX', value=finiteOrNone(hi), comment='[A] max photodiode current'),
+                dict(name='W_OLFLUX', value=finiteOrNone(meanFlux), comment='[photons/s] mean calibrated flux'),
+                dict(name='W_OLFLXI', value=self.integratedFlux(),
+                     comment='[photons] calibrated flux integrated over samples')]
+
+    def table(self):
+        """Return the samples as a table, for a PHOTODIODE HDU. """
+
+        table = np.zeros(len(self), dtype=[('TIME', 'f8'), ('CURRENT', 'f8'), ('FLUX', 'f8')])
+        table['TIME'] = self.times
+        table['CURRENT'] = self.currents
+        table['FLUX'] = self.fluxes
+        return table
+
+# How many cards PhotodiodeSamples.cards returns.
+nPhotodiodeCards = 7
+
+def photodiodeSampler(actor, cadence=0.5):
+    """Return the actor's photodiode sampler, starting it if necessary. """
 
-    illuminatorCommand(cmdStr)
+    sampler = getattr(actor, 'photodiodeSampler', None)
+    if sampler is None or not sampler.is_alive():
+        sampler = PhotodiodeSampler(cadence=cadence)
+        sampler.start()
+        actor.photodiodeSampler = sampler
+    return sampler
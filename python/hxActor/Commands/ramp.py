@@ -1,16 +1,27 @@
 import logging
 import pathlib
 
-from ics.utils.fits import fitsWriter
-
 class Ramp(object):
-    def __init__(self, cmd, reportReads=True, logLevel=logging.INFO):
-        """A per-ramp object which relays completed FITS events to the MHS command. """
+    def __init__(self, cmd, reportReads=True, closedCB=None,
+                 catalog=None, camera=None, finalPath=None, logLevel=logging.INFO):
+        """A per-ramp object which relays completed FITS events to the MHS command.
+
+        If closedCB is set, it is called with the successful closedFits reply,
+        after the filename has been published.
+
+        If catalog (a `hxActor.rampFits.rampCatalog.RampCatalog`) is set, the
+        closed file is added to it, under the given camera name and with
+        finalPath as its path if the file is to be migrated there.
+        """
         self.logger = logging.getLogger('ramp')
         self.logger.setLevel(logLevel)
         self.cmd = cmd
         self.name = f'ramp_{id(self):#08x}'
         self.reportReads = reportReads
+        self.closedCB = closedCB
+        self.catalog = catalog
+        self.camera = camera
+        self.finalPath = finalPath
         self.isFinished = False
 
     def createdFits(self, reply):
@@ -48,6 +59,16 @@ class Ramp(object):
             self.cmd.inform('hxread=%d,%d,%d,%d' % (int(path.stem[4:-2], base=10),
                                                     ramp, group, read))
 
+    def wroteTable(self, reply):
+        """A table HDU has been written to the FITS file. """
+        if reply['status'] != 'OK':
+            msg = f'failed to append {reply["extname"]} table to FITS file {reply["path"]}: {reply["errorDetails"]}'
+            self.cmd.warn(msg)
+            self.logger.warning(msg)
+            return
+
+        self.logger.info(f'{self.name} wroteTable: {reply}')
+
     def closedFits(self, reply):
         """The FITS file has been closed and renamed to the final pathname. """
         if reply['status'] != 'OK':
@@ -58,6 +79,18 @@ class Ramp(object):
 
         self.logger.info(f'{self.name} closedFits: {reply}')
         self.cmd.inform('filename=%s' % (reply['path']))
+        if self.catalog is not None:
+            try:
+                self.catalog.addRamp(reply, camera=self.camera, finalPath=self.finalPath)
+            except Exception as e:
+                self.logger.warning(f'{self.name} failed to catalogue {reply["path"]}: {e}')
+                self.cmd.warn(f'text="failed to add {reply["path"]} to the ramp catalogue: {e}"')
+        if self.closedCB is not None:
+            try:
+                self.closedCB(reply)
+            except Exception as e:
+                self.logger.warning(f'{self.name} closedCB failed: {e}')
+                self.cmd.warn(f'text="failed to handle closed file {reply["path"]}: {e}"')
         self.isFinished = True
 
     def fitsFailure(self, reply):
@@ -0,0 +1,95 @@
+"""Cached butler ramp paths.
+
+For a given camera and night, the butler's rampFile path only varies with the
+visit, but resolving it through the butler on every ramp takes time between
+the `ramp` command and the first reset. `RampPathCache` asks the butler for
+the paths of two probe visits, derives the template from them, and then only
+formats visits into that template until the night rolls over.
+
+If the two probe paths do not agree on a template, every path is resolved
+through the butler, as before.
+"""
+
+import logging
+import time
+
+class RampPathCache(object):
+    # Visits which are unlikely to collide with any other digits in a path. The
+    # second is short, so that it also tells us how the visit is zero-padded.
+    probeVisits = (987654, 4321)
+
+    def __init__(self, butler, camName, dayOffset=-3600*12, logger=None):
+        """Cache the butler rampFile paths for one camera.
+
+        Parameters
+        ----------
+        butler : `pfs.utils.butler.Butler`
+          The butler to derive the templates from.
+        camName : `str`
+          The camera, only used to key the cache.
+        dayOffset : `int`
+          The night's rollover time, as for `seqPath.NightFilenameGen`.
+        """
+
+        self.butler = butler
+        self.camName = camName
+        self.dayOffset = dayOffset
+        self.logger = logger if logger is not None else logging.getLogger('rampPaths')
+
+        self.key = None
+        self.parts = None
+        self.width = None
+
+    def invalidate(self):
+        """Forget the template, e.g. after a configuration change. """
+
+        self.key = None
+        self.parts = None
+
+    def nightKey(self, now=None):
+        """The cache key for the given time.
+
+        We do not know exactly when the butler rolls its directories over,
+        so rebuild the template both at our night's rollover and at UT midnight.
+        """
+        if now is None:
+            now = time.time()
+        night = time.strftime('%Y-%m-%d', time.gmtime(now + self.dayOffset))
+        utDay = time.strftime('%Y-%m-%d', time.gmtime(now))
+        return (self.camName, night, utDay)
+
+    def _compile(self):
+        """Derive the path template from the butler's paths for the probe visits. """
+
+        v1, v2 = self.probeVisits
+        path1 = str(self.butler.getPath('rampFile', visit=v1))
+        path2 = str(self.butler.getPath('rampFile', visit=v2))
+
+        for width in 6, 0:
+            visitStr = f'{v1:0{width}d}'
+            parts = path1.split(visitStr)
+            if len(parts) > 1 and f'{v2:0{width}d}'.join(parts) == path2:
+                self.parts = parts
+                self.width = width
+                self.logger.info(f'using ramp path template {f"{{visit:0{width}d}}".join(parts)}')
+                return
+
+        self.parts = None
+        self.logger.warning(f'could not derive a ramp path template from {path1} and {path2}; '
+                            'resolving every path through the butler')
+
+    def refresh(self):
+        """Derive the template if we do not have one for the current night. """
+
+        key = self.nightKey()
+        if key != self.key:
+            self._compile()
+            self.key = key
+
+    def getPath(self, visit):
+        """Return the rampFile path for the given visit. """
+
+        self.refresh()
+        if self.parts is None:
+            return str(self.butler.getPath('rampFile', visit=visit))
+        return f'{visit:0{self.width}d}'.join(self.parts)
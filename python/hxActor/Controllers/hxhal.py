@@ -1,14 +1,16 @@
-from importlib import reload
-
+import collections
+import contextlib
+import itertools
 import logging
+import os
+import pickle
+import threading
 import time
+import zlib
 
 from sam import sam as samControl
 from sam import logic as samLogic
 
-reload(samControl)
-reload(samLogic)
-
 class DaqState(object):
     def __init__(self):
         self.isValid = False
@@ -16,8 +18,212 @@ class DaqState(object):
         self.spiRegisters = dict()
         self.voltageSettings = dict()
         self.voltageReadings = dict()
+        self.skipSequence = None
+        self.fingerprint = None
+        self.savedAt = None
+
+    def save(self, path):
+        """Atomically replace the snapshot at path with this state. """
+
+        dirName = os.path.dirname(path)
+        os.makedirs(dirName, exist_ok=True)
+        tmpPath = f'{path}.tmp'
+        with open(tmpPath, 'wb') as f:
+            pickle.dump(self.__dict__, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpPath, path)
+
+    @classmethod
+    def load(cls, path):
+        """Return the snapshot saved at path. """
+
+        with open(path, 'rb') as f:
+            savedState = pickle.load(f)
+        state = cls()
+        state.__dict__.update(savedState)
+        return state
+
+class HardwareArbiter(object):
+    """Serialize all SAM/ASIC access, with the readout first.
+
+    Every access is made inside `access` (or `readout`), which waits until
+    the hardware is free and no more urgent request is waiting:
+      READOUT : a ramp. Holds the hardware for the whole ramp.
+      CONTROL : anything which changes the DAQ.
+      HOUSEKEEPING : reads of registers, voltages, and power.
+
+    While a readout holds the hardware, only requests made with
+    betweenFrames=True can get in, one at a time, when the readout thread
+    calls `frameGap` between frames. Everything else waits for the end of
+    the readout, or for its timeout.
+
+    Access is re-entrant: a thread which holds the hardware is never
+    blocked by its own nested requests.
+    """
+
+    READOUT, CONTROL, HOUSEKEEPING = 0, 1, 2
+    priorityNames = {READOUT: 'readout', CONTROL: 'control', HOUSEKEEPING: 'housekeeping'}
+
+    Ticket = collections.namedtuple('Ticket', ('priority', 'seq', 'name', 'betweenFrames'))
+
+    def __init__(self, logger=None, statsLength=100):
+        self.logger = logger if logger is not None else logging.getLogger('hxArbiter')
+
+        self.cond = threading.Condition()
+        self.seq = itertools.count()
+        self.waiting = []
+
+        self.ownerThread = None
+        self.ownerTicket = None
+        self.depth = 0
+
+        self.readoutThread = None
+        self.readoutName = None
+        self.gapAdmits = 0
+
+        # For each request name: its recent waits, and how many timed out.
+        self.statsLength = statsLength
+        self.waits = collections.defaultdict(lambda: collections.deque(maxlen=self.statsLength))
+        self.timeouts = collections.Counter()
+        self.gapHolds = collections.deque(maxlen=statsLength)
+
+    @property
+    def readoutActive(self):
+        return self.readoutThread is not None
+
+    @property
+    def busy(self):
+        """Whether a new request would have to wait. """
+        return self.ownerThread is not None or bool(self.waiting)
+
+    def _eligible(self, ticket):
+        if self.readoutThread is None:
+            return True
+        return ticket.betweenFrames and self.gapAdmits > 0
+
+    def _next(self):
+        """The waiting ticket which should get the hardware next, or None. """
+
+        eligible = [t for t in self.waiting if self._eligible(t)]
+        return min(eligible) if eligible else None
+
+    @contextlib.contextmanager
+    def access(self, name, priority=HOUSEKEEPING, timeout=None, betweenFrames=False):
+        """Hold the hardware for the body of the with statement, which gets the seconds waited.
+
+        Raises TimeoutError if the hardware is not ours within timeout seconds.
+        """
+
+        me = threading.get_ident()
+        t0 = time.time()
+        with self.cond:
+            if self.ownerThread == me:
+                self.depth += 1
+            else:
+                ticket = self.Ticket(priority, next(self.seq), name, betweenFrames)
+                self.waiting.append(ticket)
+                deadline = None if timeout is None else t0 + timeout
+                while self.ownerThread is not None or self._next() is not ticket:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        self.waiting.remove(ticket)
+                        self.timeouts[name] += 1
+                        self.cond.notify_all()
+                        holder = self.ownerTicket.name if self.ownerTicket is not None else self.readoutName
+                        raise TimeoutError(f'waited {timeout}s for the hardware for {name}; held by {holder}')
+                    self.cond.wait(remaining)
+                self.waiting.remove(ticket)
+                if self.readoutThread is not None:
+                    self.gapAdmits -= 1
+                self.ownerThread = me
+                self.ownerTicket = ticket
+                self.depth = 1
+                self.waits[name].append(time.time() - t0)
+        waited = time.time() - t0
+
+        try:
+            yield waited
+        finally:
+            with self.cond:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.ownerThread = None
+                    self.ownerTicket = None
+                    self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def readout(self, name='readout', timeout=None):
+        """Hold the hardware for a ramp, letting only betweenFrames requests in at `frameGap`. """
+
+        with self.access(name, priority=self.READOUT, timeout=timeout) as waited:
+            with self.cond:
+                self.readoutThread = threading.get_ident()
+                self.readoutName = name
+            try:
+                yield waited
+            finally:
+                with self.cond:
+                    self.readoutThread = None
+                    self.readoutName = None
+                    self.gapAdmits = 0
+                    self.cond.notify_all()
+
+    def frameGap(self, maxRequests=1):
+        """Let up to maxRequests waiting betweenFrames requests use the hardware, then take it back.
+
+        Only does anything when called by the readout thread. Returns how
+        long the readout was held up, in seconds.
+        """
+
+        me = threading.get_ident()
+        with self.cond:
+            if self.readoutThread != me or self.ownerThread != me or self.depth != 1:
+                return 0.0
+            if not any(t.betweenFrames for t in self.waiting):
+                return 0.0
+
+            t0 = time.time()
+            ticket = self.ownerTicket
+            self.gapAdmits = maxRequests
+            self.ownerThread = None
+            self.ownerTicket = None
+            self.depth = 0
+            self.cond.notify_all()
+
+            while self.ownerThread is not None or (self.gapAdmits > 0 and self._next() is not None):
+                self.cond.wait()
+
+            self.gapAdmits = 0
+            self.ownerThread = me
+            self.ownerTicket = ticket
+            self.depth = 1
+        held = time.time() - t0
+        self.gapHolds.append(held)
+        return held
+
+    def status(self):
+        """Return the wait statistics for each request name, and for the frame gaps. """
+
+        with self.cond:
+            names = sorted(set(self.waits) | set(self.timeouts))
+            stats = []
+            for name in names:
+                waits = list(self.waits.get(name, []))
+                stats.append(dict(name=name, n=len(waits),
+                                  meanWait=sum(waits)/len(waits) if waits else 0.0,
+                                  maxWait=max(waits) if waits else 0.0,
+                                  timeouts=self.timeouts[name]))
+            gaps = dict(n=len(self.gapHolds), maxHold=max(self.gapHolds) if self.gapHolds else 0.0)
+            waiting = [t.name for t in sorted(self.waiting)]
+            holder = self.ownerTicket.name if self.ownerTicket is not None else self.readoutName
+        return dict(requests=stats, gaps=gaps, waiting=waiting, holder=holder)
 
 class hxhal(object):
+    # The ASIC registers whose checksum identifies a configured DAQ: the
+    # HxRG configuration block and the row-skipping registers.
+    fingerprintRegisters = tuple(range(0x4000, 0x4040)) + (0x4300, 0x4301, 0x4302, 0x4303)
+
     def __init__(self, actor, name,
                  loglevel=logging.DEBUG):
 
@@ -28,8 +234,12 @@ class hxhal(object):
         self.logger.setLevel(loglevel)
 
         self.sam = None
+        self.arbiter = HardwareArbiter(logger=self.logger)
 
         self.daqState = DaqState()
+        defaultStatePath = os.path.join(os.path.expanduser('~'), '.hxActor',
+                                        f'{self.actor.name}_daqState.pickle')
+        self.daqStatePath = self.actor.actorConfig.get('daqStateFile', defaultStatePath)
 
     def start(self, cmd=None):
         return self.connect(cmd=cmd)
@@ -86,6 +296,9 @@ class hxhal(object):
                      'SAM is connected but not initialized: consider `reconnect bouncePower`"')
             return
 
+        if self.restoreDaqState(cmd=cmd):
+            return
+
         cmd.inform('text="connected to ASIC; updating status"')
         self.grabAllH4Info()
 
@@ -192,6 +405,73 @@ class hxhal(object):
         self.daqState.hxConfig = self.sam.hxrgDetectorConfig.copy()
         self.daqState.spiRegisters = self.sam.readAllH4SpiRegs()
 
+    def daqFingerprint(self):
+        """Return a cheap checksum of the DAQ configuration.
+
+        Covers the `fingerprintRegisters` and the bias voltage settings,
+        which are all fast register readbacks.
+        """
+
+        regs = [self.sam.link.ReadAsicReg(reg) for reg in self.fingerprintRegisters]
+        biases = [(name, round(setting, 4)) for name, setting in self.sam.getBiasVoltages()]
+        return f'{zlib.crc32(repr((regs, biases)).encode("latin-1")):08x}'
+
+    def saveDaqState(self):
+        """Persist the current, valid, DAQ state, so that an actor restart can reuse it. """
+
+        if not self.daqState.isValid:
+            return
+        try:
+            self.daqState.fingerprint = self.daqFingerprint()
+            self.daqState.savedAt = time.time()
+            self.daqState.save(self.daqStatePath)
+        except Exception as e:
+            self.logger.warning(f'failed to save DAQ state to {self.daqStatePath}: {e}')
+
+    def invalidateDaqState(self):
+        """Declare that the DAQ may no longer match our state, and forget the snapshot. """
+
+        self.daqState.isValid = False
+        try:
+            os.unlink(self.daqStatePath)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.warning(f'failed to remove DAQ state {self.daqStatePath}: {e}')
+
+    def restoreDaqState(self, cmd=None):
+        """Adopt the saved DAQ state if the DAQ still matches it.
+
+        Returns
+        -------
+        restored : `bool`
+          Whether the snapshot was used.
+        """
+
+        try:
+            savedState = DaqState.load(self.daqStatePath)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            self.logger.warning(f'failed to load DAQ state from {self.daqStatePath}: {e}')
+            return False
+
+        try:
+            fingerprint = self.daqFingerprint()
+        except Exception as e:
+            self.logger.warning(f'failed to fingerprint DAQ: {e}')
+            return False
+        if not savedState.isValid or fingerprint != savedState.fingerprint:
+            self.logger.info(f'DAQ fingerprint {fingerprint} does not match saved {savedState.fingerprint}')
+            return False
+
+        self.daqState = savedState
+        self.sam.hxrgDetectorConfig = savedState.hxConfig.copy()
+        age = time.time() - savedState.savedAt
+        if cmd is not None:
+            cmd.inform(f'text="restored DAQ state saved {age:0.0f}s ago (fingerprint {fingerprint})"')
+        return True
+
     def sampleVoltage(self, voltageName):
         sam = self.sam
 
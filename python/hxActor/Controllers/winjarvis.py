@@ -1,7 +1,13 @@
+import argparse
 import errno
 import logging
 import select
 import socket
+import socketserver
+import threading
+import time
+
+import numpy as np
 
 def _eintr_retry(func, *args):
     """restart a system call interrupted by EINTR"""
@@ -14,110 +20,216 @@ def _eintr_retry(func, *args):
 
 class winjarvis(object):
     def __init__(self, actor, name,
-                 loglevel=logging.INFO):
+                 loglevel=logging.INFO,
+                 host=None, port=None):
+        """The client for the line-oriented protocol of the Windows IDL backend.
+
+        Commands and responses are single lines, terminated by CRLF. The
+        connection is kept open between commands, and responses are read
+        in chunks into a byte buffer.
+
+        host and port default to the actor's configuration for name.
+        """
 
         self.actor = actor
         self.name = name
         self.logger = logging.getLogger(self.name)
         self.logger.setLevel(loglevel)
 
-        self.EOL = '\r\n'
+        self.EOL = b'\r\n'
+        self.recvSize = 65536
 
-        self.host = self.actor.config.get(self.name, 'host')
-        self.port = int(self.actor.config.get(self.name, 'port'))
+        self.host = host if host is not None else self.actor.config.get(self.name, 'host')
+        self.port = int(port if port is not None else self.actor.config.get(self.name, 'port'))
 
         self.sock = None
-        
+        self.rxBuffer = bytearray()
+
     def start(self):
         pass
 
     def stop(self, cmd=None):
-        pass
+        self.disconnect()
 
     def disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
         self.sock = None
-        
+        self.rxBuffer = bytearray()
+
     def connect(self, cmd, force=False):
         if self.sock is not None and not force:
             return self.sock
-        
+
         if cmd is not None:
             cmd.inform('text="connecting socket to %s..."' % (self.name))
-        self.sock = None
-        
+        self.disconnect()
+
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.settimeout(1.0)
         except socket.error as e:
-            cmd.warn('text="failed to create socket to %s: %s"' % (self.name, e))
+            if cmd is not None:
+                cmd.warn('text="failed to create socket to %s: %s"' % (self.name, e))
             raise
- 
+
         try:
             s.connect((self.host, self.port))
         except socket.error as e:
-            cmd.warn('text="failed to connect to %s: %s"' % (self.name, e))
+            if cmd is not None:
+                cmd.warn('text="failed to connect to %s: %s"' % (self.name, e))
             s.close()
             raise
 
+        # Commands are short and we wait for each response: do not let Nagle delay them.
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.sock = s
         return s
-    
-    def getOneChar(self, s=None, timeout=2, cmd=None):
-        if s is None:
-            s = self.connect(cmd=cmd)
 
-        readers, writers, broken = _eintr_retry(select.select, [s], [], [], timeout)
-        if len(readers) == 0:
-            if cmd is not None:
-                cmd.warn('text="Timed out (%s) reading character from %s controller"' % (timeout,
-                                                                                         self.name))
-            raise RuntimeError('timeout')
-        return s.recv(1)
+    def flushInput(self, timeout=0.2, cmd=None):
+        """Discard and return (as a `str`) anything buffered or arriving within timeout seconds. """
+
+        s = self.connect(cmd=cmd)
+        while True:
+            readers, writers, broken = _eintr_retry(select.select, [s], [], [], timeout)
+            if len(readers) == 0:
+                break
+            chunk = s.recv(self.recvSize)
+            if not chunk:
+                break
+            self.rxBuffer.extend(chunk)
+
+        debris = bytes(self.rxBuffer).decode('latin-1')
+        self.rxBuffer = bytearray()
+        return debris
 
     def getOneResponse(self, s=None, cmd=None, timeout=10):
+        """Return the next CRLF-terminated response line, without the CRLF, as a `str`.
+
+        timeout is for the whole response. If None, wait forever.
+        """
         if s is None:
             s = self.connect(cmd=cmd)
 
-        ret = ''
-        while not ret.endswith(self.EOL):
-            c = self.getOneChar(s, cmd=cmd, timeout=(timeout if not ret else None))
-            ret += c
-            if cmd is not None:
-                cmd.diag('text="response: %r"' % (ret))
-            
-        ret = ret[:-len(self.EOL)]
-        cmd.diag('text="raw from %s: %r"' % (self.name, ret))
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            eol = self.rxBuffer.find(self.EOL)
+            if eol >= 0:
+                break
+
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            readers, writers, broken = _eintr_retry(select.select, [s], [], [], remaining)
+            if len(readers) == 0:
+                if cmd is not None:
+                    cmd.warn('text="Timed out (%s) reading response from %s controller"' % (timeout,
+                                                                                           self.name))
+                raise RuntimeError('timeout')
+
+            chunk = s.recv(self.recvSize)
+            if not chunk:
+                raise RuntimeError('connection closed by %s' % (self.name))
+            self.rxBuffer.extend(chunk)
+
+        ret = bytes(self.rxBuffer[:eol]).decode('latin-1')
+        del self.rxBuffer[:eol + len(self.EOL)]
         return ret
-    
+
     def sendOneCommand(self, cmdStr, cmd=None, timeout=None, noResponse=False):
-        if cmd is None:
+        if cmd is None and self.actor is not None:
             cmd = self.actor.bcast
 
-        fullCmd = "%s%s" % (cmdStr, self.EOL)
-        self.logger.debug('sending %r', fullCmd)
-        cmd.diag('text="sending %r with timeout=%s"' % (cmdStr, timeout))
+        fullCmd = ("%s\r\n" % (cmdStr)).encode('latin-1')
+        if cmd is not None:
+            cmd.diag('text="sending %r with timeout=%s"' % (cmdStr, timeout))
 
         self.connect(cmd=cmd)
-        
+
+        # Anything left over belongs to no command of ours.
+        if self.rxBuffer:
+            self.logger.warning('discarding %d unexpected bytes from %s: %r',
+                                len(self.rxBuffer), self.name, bytes(self.rxBuffer[:80]))
+            self.rxBuffer = bytearray()
+
+        t0 = time.time()
         try:
             self.sock.sendall(fullCmd)
         except socket.error as e:
-            cmd.warn('text="failed to send to %s: %s"' % (self.name, e))
-            self.sock = None
+            if cmd is not None:
+                cmd.warn('text="failed to send to %s: %s"' % (self.name, e))
+            self.disconnect()
             raise
 
         if not noResponse:
             try:
-                ret = self.getOneResponse(self.sock, cmd=cmd, timeout=timeout) 
+                ret = self.getOneResponse(self.sock, cmd=cmd, timeout=timeout)
             except Exception as e:
-                cmd.warn('text="failed to read response from %s: %s"' % (self.name, e))
-                self.sock = None
+                if cmd is not None:
+                    cmd.warn('text="failed to read response from %s: %s"' % (self.name, e))
+                self.disconnect()
                 raise
 
-            self.logger.debug('received %r', ret)
-            cmd.diag('text="received %r"' % ret)
+            dt = time.time() - t0
+            self.logger.debug('%r -> %r: %d bytes in %0.4fs', cmdStr, ret, len(ret), dt)
+            if cmd is not None:
+                cmd.diag('text="received %d bytes in %0.4fs: %r"' % (len(ret), dt, ret))
         else:
             ret = None
-            
+
         return ret
 
+class _FakeServerHandler(socketserver.StreamRequestHandler):
+    """Answer every line with a fixed-size response line, as the IDL backend would. """
+
+    def handle(self):
+        response = b'x' * self.server.responseSize + b'\r\n'
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            self.wfile.write(response)
+            self.wfile.flush()
+
+class _FakeServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+def main(argv=None):
+    """Benchmark command round trips against a local fake backend. """
+
+    parser = argparse.ArgumentParser(description='benchmark winjarvis round trips against a fake server')
+    parser.add_argument('--count', type=int, default=1000, help='number of commands per response size')
+    parser.add_argument('--responseSize', type=int, nargs='+', default=[16, 1024, 65536])
+    args = parser.parse_args(argv)
+
+    for responseSize in args.responseSize:
+        server = _FakeServer(('127.0.0.1', 0), _FakeServerHandler)
+        server.responseSize = responseSize
+        serverThread = threading.Thread(target=server.serve_forever, daemon=True)
+        serverThread.start()
+
+        host, port = server.server_address
+        client = winjarvis(None, 'fakejarvis', host=host, port=port)
+        client.sendOneCommand('hello', timeout=5)
+
+        times = []
+        t0 = time.time()
+        for i in range(args.count):
+            t1 = time.perf_counter()
+            ret = client.sendOneCommand('status %d' % (i), timeout=5)
+            times.append(time.perf_counter() - t1)
+            assert len(ret) == responseSize
+        dt = time.time() - t0
+        times = np.array(times) * 1e6
+
+        print('response=%6d bytes: %d commands in %0.2fs; round trip us: median=%0.0f p99=%0.0f max=%0.0f' %
+              (responseSize, args.count, dt, np.median(times), np.percentile(times, 99), times.max()))
+
+        client.disconnect()
+        server.shutdown()
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
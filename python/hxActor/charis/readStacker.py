@@ -0,0 +1,209 @@
+"""Stack the per-read IDL files of a CHARIS ramp into one multi-HDU file.
+
+The output file is opened once per ramp and each read is appended as an
+image extension, so the cost of a read does not grow with the number
+already stacked. Each input file is memory-mapped, and its data unit is
+written out unchanged: it is already big-endian FITS data. Only the header
+is rebuilt, as an extension header with checksums computed from the mapped
+data.
+
+`StackWorker` does the stacking in its own thread, so that whoever is
+watching for new reads never waits on the disk.
+"""
+
+import logging
+import mmap
+import queue
+import threading
+import time
+
+import numpy as np
+
+import astropy.io.fits as pyfits
+
+from hxActor.rampFits import fitsBlocks
+
+def headerEnd(buf):
+    """Return the offset just past the block holding the END card of the header at the start of buf. """
+
+    for blockStart in range(0, len(buf), fitsBlocks.BLOCK):
+        for cardStart in range(blockStart, blockStart + fitsBlocks.BLOCK, fitsBlocks.CARD):
+            if buf[cardStart:cardStart+8] == b'END     ':
+                return blockStart + fitsBlocks.BLOCK
+    raise ValueError('no END card in header')
+
+class ReadStacker(object):
+    def __init__(self, outfile, cards, logger=None):
+        """Create the stack file for one ramp, with the given primary header cards.
+
+        Parameters
+        ----------
+        outfile : `str`
+          The path of the stack file. Any existing file is replaced.
+        cards : list of card dicts
+          The PHDU cards.
+        """
+
+        self.logger = logger if logger is not None else logging.getLogger('readStacker')
+        self.outfile = outfile
+        self.outFile = open(outfile, 'wb')
+        self.outFile.write(fitsBlocks.PrimaryHeader(cards).toBytes())
+        self.nreads = 0
+        self.ingestTimes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def addRead(self, path):
+        """Append the image in the IDL read file at path as a new extension.
+
+        Returns
+        -------
+        dt : `float`
+          How long the read took to ingest, in seconds.
+        """
+
+        t0 = time.time()
+        with open(path, 'rb') as inFile:
+            mm = mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ)
+        data = None
+        try:
+            dataStart = headerEnd(mm)
+            inHdr = pyfits.Header.fromstring(mm[:dataStart].decode('ascii'))
+
+            bitpix = inHdr['BITPIX']
+            shape = [inHdr[f'NAXIS{i}'] for i in range(inHdr['NAXIS'], 0, -1)]
+            nbytes = abs(bitpix) // 8 * int(np.prod(shape))
+            if dataStart + nbytes > len(mm):
+                raise ValueError(f'{path} is truncated: needs {dataStart + nbytes} bytes, has {len(mm)}')
+
+            data = memoryview(mm)[dataStart:dataStart + nbytes]
+            padding = b'\0' * (fitsBlocks.paddedSize(nbytes) - nbytes)
+            dataSum = fitsBlocks.onesSum(data)
+
+            structural = [dict(name='XTENSION', value='IMAGE', comment='Image extension'),
+                          dict(name='BITPIX', value=bitpix, comment='array data type'),
+                          dict(name='NAXIS', value=len(shape), comment='number of array dimensions')]
+            for i, n in enumerate(reversed(shape)):
+                structural.append(dict(name=f'NAXIS{i+1}', value=n))
+            structural.append(dict(name='PCOUNT', value=0, comment='number of parameters'))
+            structural.append(dict(name='GCOUNT', value=1, comment='number of groups'))
+            for name in 'BZERO', 'BSCALE':
+                if name in inHdr:
+                    structural.append(dict(name=name, value=inHdr[name]))
+
+            cards = [dict(name=c.keyword, value=c.value, comment=c.comment)
+                     for c in inHdr.cards if c.keyword and c.keyword != 'CONTINUE']
+
+            self.outFile.write(fitsBlocks.checksummedHeader(structural, cards, dataSum))
+            self.outFile.write(data)
+            self.outFile.write(padding)
+        finally:
+            if data is not None:
+                data.release()
+            mm.close()
+
+        self.nreads += 1
+        dt = time.time() - t0
+        self.ingestTimes.append(dt)
+        return dt
+
+    def close(self):
+        """Close the stack file, once all the reads are in. """
+
+        if self.outFile is None:
+            return
+        self.outFile.close()
+        self.outFile = None
+        if self.ingestTimes:
+            self.logger.info(f'{self.outfile}: stacked {self.nreads} reads; '
+                             f'ingest ms mean={np.mean(self.ingestTimes)*1000:0.1f} '
+                             f'max={np.max(self.ingestTimes)*1000:0.1f}')
+
+class StackWorker(threading.Thread):
+    def __init__(self, readCB=None, rampCB=None, errorCB=None, logger=None):
+        """Stack the reads of a sequence of ramps in the background, in the order they are queued.
+
+        Parameters
+        ----------
+        readCB : callable
+          Called as readCB(stacker, path, dt) after each read is stacked.
+        rampCB : callable
+          Called as rampCB(stacker) after each ramp's file is closed.
+        errorCB : callable
+          Called as errorCB(exception) if a ramp or read could not be handled.
+
+        All the callbacks are called from this thread.
+        """
+        super(StackWorker, self).__init__(name='stackWorker', daemon=True)
+
+        self.logger = logger if logger is not None else logging.getLogger('readStacker')
+        self.readCB = readCB
+        self.rampCB = rampCB
+        self.errorCB = errorCB
+
+        self.q = queue.Queue()
+        self.stacker = None
+
+    @property
+    def backlog(self):
+        """The number of queued ramp starts, reads, and ramp ends not yet handled. """
+        return self.q.qsize()
+
+    def startRamp(self, outfile, cards):
+        """Queue the creation of a new stack file. Any open one is closed first. """
+        self.q.put(('start', outfile, cards))
+
+    def addRead(self, path):
+        """Queue a read for the current stack file. """
+        self.q.put(('read', path))
+
+    def endRamp(self):
+        """Queue the closing of the current stack file. """
+        self.q.put(('end',))
+
+    def finish(self, timeout=None):
+        """Handle everything queued so far, then stop. Returns True if the thread has finished. """
+
+        self.q.put(None)
+        self.join(timeout)
+        return not self.is_alive()
+
+    def _closeRamp(self):
+        if self.stacker is None:
+            return
+        stacker = self.stacker
+        self.stacker = None
+        stacker.close()
+        if self.rampCB is not None:
+            self.rampCB(stacker)
+
+    def run(self):
+        while True:
+            item = self.q.get()
+            if item is None:
+                break
+            try:
+                if item[0] == 'start':
+                    self._closeRamp()
+                    self.stacker = ReadStacker(item[1], item[2], logger=self.logger)
+                elif item[0] == 'read':
+                    if self.stacker is None:
+                        raise RuntimeError(f'no stack file open for {item[1]}')
+                    dt = self.stacker.addRead(item[1])
+                    if self.readCB is not None:
+                        self.readCB(self.stacker, item[1], dt)
+                elif item[0] == 'end':
+                    self._closeRamp()
+            except Exception as e:
+                self.logger.warning(f'failed to handle {item[0]} {item[1:2]}: {e}')
+                if self.errorCB is not None:
+                    self.errorCB(e)
+
+        try:
+            self._closeRamp()
+        except Exception as e:
+            self.logger.warning(f'failed to close the last stack file: {e}')
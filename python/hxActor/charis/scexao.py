@@ -1,35 +1,217 @@
+import argparse
+import errno
+import logging
 import pickle
 import socket
-import sys
+import socketserver
+import threading
+import time
+
+import astropy.io.fits as pyfits
 
 HOST, PORT = '133.40.162.192', 18447
-data = " ".join(sys.argv[1:])
 
-def fetchHeader():
-    try:
-        sock = socket.create_connection(address=(HOST, PORT),
-                                        timeout=1.0)
-        sock.sendall('hdr\n')
-    except Exception as e:
-        logging.error("failed to send: %s" % (e))
-        return []
+def fetchHeader(host=HOST, port=PORT, timeout=1.0):
+    """ Fetch the current SCExAO cards, as a list of `pyfits.Card`.
 
+    The server answers 'hdr' with a pickled list of cards and closes the
+    connection. Raises on any failure.
+    """
+
+    sock = socket.create_connection(address=(host, port), timeout=timeout)
     try:
-        received = ""
+        sock.sendall(b'hdr\n')
+        received = bytearray()
         while True:
             try:
-                oneBlock = sock.recv(1024)
-                received = received + oneBlock
+                oneBlock = sock.recv(65536)
             except socket.error as e:
-                if e.errno != errno.EINTR:
-                    raise
-            if oneBlock == '':
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not oneBlock:
                 break
-        
+            received.extend(oneBlock)
     finally:
         sock.close()
 
-    return pickle.loads(received)
+    # The server might be running python 2.
+    cards = pickle.loads(bytes(received), encoding='latin-1')
+    return [toCard(c) for c in cards]
+
+def toCard(c):
+    """ Return a `pyfits.Card` for a card, a (name, value[, comment]) tuple, or a card dict. """
+
+    if isinstance(c, pyfits.Card):
+        return c
+    if isinstance(c, dict):
+        return pyfits.Card(c['name'], c['value'], c.get('comment', ''))
+    return pyfits.Card(*c)
+
+class CardCache(threading.Thread):
+    def __init__(self, host=HOST, port=PORT, ttl=30.0, refreshInterval=None, timeout=1.0,
+                 logger=None):
+        """ Keep the latest SCExAO card set in memory, refreshing it in the background.
+
+        Parameters
+        ----------
+        host, port : `str`, `int`
+          The SCExAO header server.
+        ttl : `float`
+          How old, in seconds, the cards can be before we stop putting them in headers.
+        refreshInterval : `float`
+          How often to fetch new cards. Defaults to a third of the ttl.
+        timeout : `float`
+          The socket timeout for each fetch.
+        """
+        super(CardCache, self).__init__(name='scexaoCards', daemon=True)
+
+        self.logger = logger if logger is not None else logging.getLogger('scexao')
+        self.addr = host, port
+        self.ttl = ttl
+        self.refreshInterval = refreshInterval if refreshInterval is not None else ttl/3
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.latest = []
+        self.fetchedAt = None
+        self.lastError = None
+        self.nFailures = 0
+
+        self.exiting = threading.Event()
+
+    def exit(self):
+        self.exiting.set()
+
+    def refresh(self):
+        """ Fetch the cards now. Returns True on success. """
+
+        t0 = time.time()
+        try:
+            cards = fetchHeader(*self.addr, timeout=self.timeout)
+        except Exception as e:
+            with self.lock:
+                self.lastError = e
+                self.nFailures += 1
+            # Only complain on the first of a run of failures.
+            if self.nFailures == 1:
+                self.logger.warning('failed to fetch SCExAO cards from %s:%s: %s', *self.addr, e)
+            return False
+
+        with self.lock:
+            if self.nFailures > 0:
+                self.logger.info('fetched SCExAO cards after %d failures', self.nFailures)
+            self.latest = cards
+            self.fetchedAt = time.time()
+            self.lastError = None
+            self.nFailures = 0
+        self.logger.debug('fetched %d SCExAO cards in %0.3fs', len(cards), time.time() - t0)
+        return True
+
+    def run(self):
+        while not self.exiting.is_set():
+            self.refresh()
+            self.exiting.wait(self.refreshInterval)
+
+    def age(self, now=None):
+        """ The age of the latest cards, in seconds, or None if we have never had any. """
+
+        if self.fetchedAt is None:
+            return None
+        return (time.time() if now is None else now) - self.fetchedAt
+
+    def cards(self, now=None):
+        """ Return the cards to put in a header, without touching the network.
+
+        The cards are only returned if they are younger than the ttl. A
+        Y_SXAGE card always gives their age, or -1 if we have never had any.
+        """
+
+        with self.lock:
+            cards = self.latest
+            age = self.age(now=now)
+
+        if age is None:
+            ageCard = pyfits.Card('Y_SXAGE', -1.0, 'no SCExAO cards fetched yet')
+            return [ageCard]
+        ageCard = pyfits.Card('Y_SXAGE', round(age, 1), '[s] age of SCExAO cards')
+        if age > self.ttl:
+            ageCard.comment = '[s] age of SCExAO cards: too old, dropped'
+            return [ageCard]
+        return list(cards) + [ageCard]
+
+def cardCache(actor, host=HOST, port=PORT, ttl=30.0):
+    """ Return the actor's SCExAO card cache, starting it if necessary. """
+
+    cache = getattr(actor, 'scexaoCardCache', None)
+    if cache is None or not cache.is_alive():
+        cache = CardCache(host=host, port=port, ttl=ttl)
+        cache.start()
+        actor.scexaoCardCache = cache
+    return cache
+
+class _FakeServerHandler(socketserver.BaseRequestHandler):
+    """ Answer 'hdr' with a pickled card list, as the SCExAO server does. """
+
+    def handle(self):
+        self.request.recv(1024)
+        self.server.nRequests += 1
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        cards = [('X_SERVER', 'stand-in', 'fake SCExAO header server'),
+                 ('X_NREQ', self.server.nRequests, 'request number'),
+                 ('X_TIME', time.time(), 'when these cards were made')]
+        self.request.sendall(pickle.dumps(cards, protocol=2))
+
+class _FakeServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    nRequests = 0
+    delay = 0.0
+
+def main(argv=None):
+    """ Run a stand-in SCExAO header server, or exercise the card cache against one. """
+
+    parser = argparse.ArgumentParser(description='stand-in SCExAO header server, and card cache test')
+    parser.add_argument('--serve', action='store_true', help='only run the stand-in server, forever')
+    parser.add_argument('--port', type=int, default=0, help='the stand-in server port')
+    parser.add_argument('--delay', type=float, default=0.2, help='how long the server takes to answer')
+    parser.add_argument('--ttl', type=float, default=2.0)
+    parser.add_argument('--duration', type=float, default=5.0, help='how long to test the cache for')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    server = _FakeServer(('127.0.0.1', args.port), _FakeServerHandler)
+    server.delay = args.delay
+    host, port = server.server_address
+    if args.serve:
+        print('serving SCExAO cards on %s:%d' % (host, port))
+        server.serve_forever()
+        return
+    serverThread = threading.Thread(target=server.serve_forever, daemon=True)
+    serverThread.start()
+
+    t0 = time.perf_counter()
+    fetchHeader(host, port)
+    print('direct fetch: %0.1f ms' % ((time.perf_counter() - t0)*1000))
+
+    cache = CardCache(host, port, ttl=args.ttl)
+    cache.start()
+    t1 = time.time()
+    while time.time() - t1 < args.duration:
+        t0 = time.perf_counter()
+        cards = cache.cards()
+        dt = time.perf_counter() - t0
+        print('%5.2fs: %d cards in %0.3f ms, %s' % (time.time() - t1, len(cards), dt*1000, cards[-1]))
+        time.sleep(0.5)
 
+    # Let the cards go stale.
+    server.shutdown()
+    server.server_close()
+    time.sleep(args.ttl + 0.5)
+    cards = cache.cards()
+    print('after the server went away: %d cards, %s' % (len(cards), cards[-1]))
 
-        
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,22 @@
 from builtins import object
+import argparse
+import fcntl
+import multiprocessing
 import os.path
+import tempfile
 import threading
 import time
 
+import numpy as np
+
 class NightFilenameGen(object):
     def __init__(self, rootDir='.',
                  seqnoFile='nextSeqno', 
                  namesFunc=None,
                  filePrefix='TEST', fileSuffix="fits",
                  filePattern="%(filePrefix)s%(seqno)08d.%(fileSuffix)s",
-                 dayOffset=-3600*12):
+                 dayOffset=-3600*12,
+                 blockSize=1):
 
         """ Set up a per-night filename generator.
         
@@ -35,6 +42,15 @@ class NightFilenameGen(object):
         filePattern - string, optional, default="%(filePrefix)s%(seqno)08d.%(fileSuffix)",
         dayOffset - integer, optional, default=3600*12
           The night's rollover time. By default, noon UT.
+        blockSize - integer, optional, default=1
+          How many sequence numbers to reserve in the seqno file at a
+          time. With more than one, most allocations do not touch the
+          file at all, but the unused part of a block is skipped
+          if the process exits.
+
+        The seqno file is only ever replaced atomically (written, fsync'ed
+        and renamed), under an fcntl lock on a separate ".lock" file, so
+        any number of processes can share it.
         """
         
         self.rootDir = rootDir
@@ -52,8 +68,18 @@ class NightFilenameGen(object):
             seqnoFile = os.path.join(rootDir, tail)
         self.seqnoFile = seqnoFile
 
+        self.seqnoLockFile = seqnoFile + '.lock'
         self.seqnoFileLock = threading.Lock()
         self.seqno = 0
+        self.blockSize = blockSize
+
+        # The reserved block is [blockNext, blockEnd]
+        self.blockNext = None
+        self.blockEnd = None
+
+        # The current night's directory, and when we next need to roll over to a new one.
+        self.nightDir = None
+        self.nightEnd = 0
         
         self.setup()
         
@@ -70,8 +96,8 @@ class NightFilenameGen(object):
 
 
         if not os.access(seqnoFile, os.F_OK):
-            seqFile = open(seqnoFile, "w")
-            seqFile.write("%d\n" % (seqno))
+            with open(seqnoFile, "w") as seqFile:
+                seqFile.write("%d\n" % (seqno))
 
     def defaultNamesFunc(self, rootDir, seqno):
         """ Returns a list of filenames. """ 
@@ -80,52 +106,99 @@ class NightFilenameGen(object):
         filename = os.path.join(rootDir, self.filePattern % d)
         return (filename,)
                                 
+    def _readSeqno(self):
+        """ Return the last used (or reserved) sequence number from the seqno file. """
+
+        try:
+            with open(self.seqnoFile, "r") as sf:
+                return int(sf.readline().strip())
+        except Exception as e:
+            raise RuntimeError("could not read sequence integer from %s: %s" %
+                               (self.seqnoFile, e))
+
+    def _writeSeqno(self, seqno):
+        """ Atomically replace the seqno file. Must be called with the file lock held. """
+
+        seqDir = os.path.dirname(os.path.abspath(self.seqnoFile))
+        tmpName = "%s.tmp" % (self.seqnoFile)
+        try:
+            with open(tmpName, "w") as sf:
+                sf.write("%d\n" % (seqno))
+                sf.flush()
+                os.fsync(sf.fileno())
+            os.rename(tmpName, self.seqnoFile)
+
+            dirFd = os.open(seqDir, os.O_RDONLY)
+            try:
+                os.fsync(dirFd)
+            finally:
+                os.close(dirFd)
+        except Exception as e:
+            raise RuntimeError("could not WRITE sequence integer to %s: %s" %
+                               (self.seqnoFile, e))
+
+    def _updateSeqno(self, func):
+        """ Replace the seqno file's value n with func(n), holding the file lock. Returns func(n). """
+
+        with open(self.seqnoLockFile, "a") as lockFile:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+            try:
+                newSeqno = func(self._readSeqno())
+                self._writeSeqno(newSeqno)
+            finally:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
+        return newSeqno
+
     def consumeNextSeqno(self, seqno=None):
-        """ Return the next free sequence number. """
+        """ Return the next free sequence number.
+
+        If seqno is passed in, it is the seqno we want, and it becomes
+        the new base for the following ones. Otherwise the number comes
+        from our reserved block, and a new block is only reserved in the
+        seqno file when that is used up.
+        """
 
         with self.seqnoFileLock:
-            try:
-                sf = open(self.seqnoFile, "r")
-                seq = sf.readline()
-                seq = seq.strip()
-                fileSeqno = int(seq)
-            except Exception as e:
-                raise RuntimeError("could not read sequence integer from %s: %s" %
-                                   (self.seqnoFile, e))
-
-            # If seqno is passed in, it is the seqno we want.
-            # The file contains the _last_ seqno
-            if seqno is None:
-                seqno = fileSeqno
+            if seqno is not None:
+                # The file contains the _last_ seqno
+                nextSeqno = self._updateSeqno(lambda fileSeqno: seqno)
+                self.blockNext = self.blockEnd = None
             else:
-                seqno -= 1
-                
-            nextSeqno = seqno+1
-            try:
-                sf = open(self.seqnoFile, "w")
-                sf.write("%d\n" % (nextSeqno))
-                sf.truncate()
-                sf.close()
-            except Exception as e:
-                raise RuntimeError("could not WRITE sequence integer to %s: %s" %
-                                   (self.seqnoFile, e))
+                if self.blockNext is None or self.blockNext > self.blockEnd:
+                    self.blockEnd = self._updateSeqno(lambda fileSeqno: fileSeqno + self.blockSize)
+                    self.blockNext = self.blockEnd - self.blockSize + 1
+                nextSeqno = self.blockNext
+                self.blockNext += 1
 
         self.seqno = nextSeqno
         return nextSeqno
 
-    def dirname(self):
-        """ Return the next directory to use. """
+    def dirname(self, now=None):
+        """ Return the next directory to use.
+
+        The directory is only looked for and created when the night rolls
+        over, not on every call.
+        """
 
-        dirnow = time.time() + self.dayOffset
+        if now is None:
+            now = time.time()
+        if self.nightDir is not None and now < self.nightEnd:
+            return self.nightDir
+
+        dirnow = now + self.dayOffset
         utday = time.strftime('%Y-%m-%d', time.gmtime(dirnow))
 
         dataDir = os.path.join(self.rootDir, utday)
         if not os.path.isdir(dataDir):
             # cmd.respond('text="creating new directory %s"' % (dataDir))
-            os.mkdir(dataDir, 0o2775)
+            os.makedirs(dataDir, 0o2775, exist_ok=True)
+
+        # The next UT midnight, shifted back by dayOffset.
+        self.nightEnd = (dirnow // 86400 + 1) * 86400 - self.dayOffset
+        self.nightDir = dataDir
 
         return dataDir
-    
+
     def genNextRealPath(self, seqno=None):
         """ Return the next filename to create. """
 
@@ -150,9 +223,49 @@ class NightFilenameGen(object):
         else:
             return self.genNextRealPath(seqno=seqno)
 
-def test1():
-    # def __init__(self, rootDir, seqnoFile, filePrefix='test', namesFunc=None):
+def _benchCaller(rootDir, blockSize, nCalls, queue):
+    gen = NightFilenameGen(rootDir, blockSize=blockSize)
+    latencies = []
+    seqnos = []
+    for i in range(nCalls):
+        t0 = time.perf_counter()
+        seqnos.append(gen.consumeNextSeqno())
+        latencies.append(time.perf_counter() - t0)
+    queue.put((seqnos, latencies))
 
-    gen = FilenameGen('/tmp', 'testSeq')
-    gen.setup()
-    
+def main(argv=None):
+    """ Measure sequence number allocation latency with concurrent callers. """
+
+    parser = argparse.ArgumentParser(description='benchmark NightFilenameGen.consumeNextSeqno')
+    parser.add_argument('--root', default=None, help='directory for the seqno file (default: a temporary one)')
+    parser.add_argument('--callers', type=int, default=4, help='number of concurrent processes')
+    parser.add_argument('--calls', type=int, default=500, help='allocations per process')
+    parser.add_argument('--blockSize', type=int, nargs='+', default=[1, 10, 100])
+    args = parser.parse_args(argv)
+
+    for blockSize in args.blockSize:
+        rootDir = args.root if args.root else tempfile.mkdtemp(prefix='seqBench')
+        NightFilenameGen(rootDir)
+
+        queue = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_benchCaller,
+                                         args=(rootDir, blockSize, args.calls, queue))
+                 for i in range(args.callers)]
+        t0 = time.perf_counter()
+        for p in procs:
+            p.start()
+        results = [queue.get() for p in procs]
+        for p in procs:
+            p.join()
+        dt = time.perf_counter() - t0
+
+        seqnos = [s for r in results for s in r[0]]
+        latencies = np.array([l for r in results for l in r[1]]) * 1e6
+        nDup = len(seqnos) - len(set(seqnos))
+        print("blockSize=%4d callers=%d: %6d allocs in %0.2fs  "
+              "latency us: median=%0.0f p99=%0.0f max=%0.0f  duplicates=%d" %
+              (blockSize, args.callers, len(seqnos), dt,
+               np.median(latencies), np.percentile(latencies, 99), latencies.max(), nDup))
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,17 @@
-from __future__ import division
-from past.utils import old_div
 import errno
 import logging
-import multiprocessing
+import queue
 import socket
+import threading
+import time
 
 import astropy.io.fits as pyfits
 
 headerAddr = 'rhodey', 6666
 
+BLOCK = 2880
+CARD = 80
+
 def fetchSeqno(prefix='A', instrument='CRS'):
     """ Request frame_id from Gen2. """
 
@@ -18,109 +21,247 @@ def fetchSeqno(prefix='A', instrument='CRS'):
     try:
         # Connect to server and send data
         sock.connect(headerAddr)
-        sock.sendall(query)
+        sock.sendall(query.encode('latin-1'))
     except Exception as e:
         logging.error("failed to send: %s" % (e))
-        received = ""
         return '%s%s%0*d' % (instrument, prefix, 9-len(prefix), 9999)
 
     logging.debug("sent query: %s ", query[:-1])
     try:
-        received = ""
+        received = b""
         while True:
             # Receive data from the server and shut down
             oneBlock = sock.recv(1024)
             logging.debug("received: %s", oneBlock)
             received = received + oneBlock
 
-            if len(received) >= 12:
+            if len(received) >= 12 or not oneBlock:
                 break
 
     except Exception as e:
         logging.error("failed to read: %s" % (e))
-        received = ""
+        received = b""
     finally:
         sock.close()
 
     logging.debug("final received: %s", received)
-    return received
+    return received.decode('latin-1')
 
-def fetchHeader(fullHeader=True, frameid=9999, exptype='TEST', itime=0.0):
-    """Request FITS cards from the Gen2 side. """
+class HeaderRequest(object):
+    def __init__(self, frameId, exptype, itime, fullHeader):
+        """ One outstanding request for a Gen2 header, which the client thread completes. """
 
-    try:
-        gen2Frameid = "CRSA%08d" % (frameid)
-    except:
-        gen2Frameid = 'None'
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    query = "hdr %s %s %0.2f %s\n" % (gen2Frameid, exptype, itime, fullHeader)
-    logging.info("sending query: %s ", query[:-1])
-    try:
-        # Connect to server and send data
-        sock.connect(headerAddr)
-        sock.sendall(query)
-    except Exception as e:
-        logging.error("failed to send: %s" % (e))
-        received = ""
-        return pyfits.Header()
+        self.key = (frameId, exptype, round(itime, 2), bool(fullHeader))
+        self.done = threading.Event()
+        self.header = None
+        self.error = None
+
+    @property
+    def query(self):
+        frameId, exptype, itime, fullHeader = self.key
+        try:
+            gen2Frameid = "CRSA%08d" % (frameId)
+        except Exception:
+            gen2Frameid = 'None'
+        return "hdr %s %s %0.2f %s\n" % (gen2Frameid, exptype, itime, fullHeader)
+
+    def finish(self, header=None, error=None):
+        self.header = header
+        self.error = error
+        self.done.set()
+
+    def get(self, timeout=None):
+        """ Return the `pyfits.Header`, waiting at most timeout seconds.
+
+        Raises RuntimeError on timeout or if the fetch failed.
+        """
+        if not self.done.wait(timeout):
+            raise RuntimeError('timed out (%ss) waiting for header %s' % (timeout, self.key[0]))
+        if self.error is not None:
+            raise RuntimeError('failed to fetch header %s: %s' % (self.key[0], self.error))
+        return self.header
+
+class HeaderClient(threading.Thread):
+    def __init__(self, addr=headerAddr, maxPipeline=4, timeout=5.0, logger=None):
+        """ A long-lived client for the Gen2 header server.
+
+        Requests are queued, and all those waiting are sent back-to-back
+        over one connection, which is kept open between requests and
+        re-opened (once per request) if the server has closed it. Replies
+        are read into a buffer which grows in whole 2880-byte blocks, and
+        split on their END cards. If the server turns out to close the
+        connection after each reply, requests are sent one at a time.
+
+        Parameters
+        ----------
+        addr : (host, port)
+          The header server.
+        maxPipeline : `int`
+          How many requests to send before reading any replies.
+        timeout : `float`
+          The socket timeout.
+        """
+        super(HeaderClient, self).__init__(name='gen2HeaderClient', daemon=True)
+
+        self.logger = logger if logger is not None else logging.getLogger('gen2Headers')
+        self.addr = addr
+        self.maxPipeline = maxPipeline
+        self.pipelining = maxPipeline > 1
+        self.timeout = timeout
+
+        self.requests = queue.Queue()
+
+        self.sock = None
+        self.rxBuffer = bytearray(4 * BLOCK)
+        self.rxLen = 0
+        self.exiting = False
+
+    def exit(self):
+        self.exiting = True
+        self.requests.put(None)
+
+    def request(self, frameId, exptype='TEST', itime=0.0, fullHeader=True):
+        """ Queue a header request, and return its `HeaderRequest`. """
+
+        req = HeaderRequest(frameId, exptype, itime, fullHeader)
+        self.requests.put(req)
+        return req
+
+    def fetch(self, frameId, exptype='TEST', itime=0.0, fullHeader=True, timeout=1.0):
+        """ Return a header, waiting at most timeout seconds for it. """
+
+        req = self.request(frameId, exptype=exptype, itime=itime, fullHeader=fullHeader)
+        return req.get(timeout)
+
+    def _connect(self):
+        self._disconnect()
+        self.sock = socket.create_connection(self.addr, timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rxLen = 0
+
+    def _disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+
+    def _headerEnd(self):
+        """ Return the length of the complete header at the start of the buffer, or None. """
+
+        for i in range(0, self.rxLen, CARD):
+            card = bytes(self.rxBuffer[i:min(i + CARD, self.rxLen)])
+            if card[:3] == b'END' and not card[3:].strip():
+                return min(i + CARD, self.rxLen)
+        return None
+
+    def _dropLeadingBlanks(self):
+        """ Drop the padding between one reply and the next. """
+
+        n = 0
+        while n < self.rxLen and self.rxBuffer[n] in b' \r\n\0':
+            n += 1
+        if n:
+            self.rxBuffer[:self.rxLen - n] = self.rxBuffer[n:self.rxLen]
+            self.rxLen -= n
+
+    def _readHeader(self):
+        """ Return the next reply from the server, as a `pyfits.Header`. """
 
-    logging.debug("sent query: %s ", query[:-1])
-    try:
-        received = ""
         while True:
-            # Receive data from the server and shut down
+            self._dropLeadingBlanks()
+            end = self._headerEnd()
+            if end is not None:
+                break
+            if self.rxLen == len(self.rxBuffer):
+                self.rxBuffer.extend(bytes(len(self.rxBuffer)))
             try:
-                oneBlock = sock.recv(2880)
-                logging.debug("received: %s", oneBlock)
-                received = received + oneBlock
+                nbytes = self.sock.recv_into(memoryview(self.rxBuffer)[self.rxLen:])
             except socket.error as e:
-                if e.errno != errno.EINTR:
-                    raise
-    
-            if received.strip().endswith('END'):
-                break
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if nbytes == 0:
+                raise RuntimeError('connection closed by header server')
+            self.rxLen += nbytes
 
-    except Exception as e:
-        logging.error("failed to read: %s" % (e))
-        received = ""
-    finally:
-        sock.close()
+        hdrString = bytes(self.rxBuffer[:end]).decode('latin-1').ljust(end + (-end) % CARD)
+        self.rxBuffer[:self.rxLen - end] = self.rxBuffer[end:self.rxLen]
+        self.rxLen -= end
+
+        return pyfits.Header.fromstring(hdrString)
+
+    def _sendBatch(self, batch):
+        """ Send a batch of requests and read their replies. Returns the unanswered requests. """
+
+        if self.sock is None:
+            self._connect()
+        t0 = time.time()
+        self.sock.sendall(''.join(req.query for req in batch).encode('latin-1'))
+
+        while batch:
+            req = batch[0]
+            hdr = self._readHeader()
+            req.finish(header=hdr)
+            batch.pop(0)
+            self.logger.info('header %s: %d cards in %0.3fs', req.key[0], len(hdr), time.time() - t0)
+        return batch
 
-    logging.debug("final received: %s", old_div(len(received), 80.0))
-    hdr = pyfits.Header.fromstring(received)
-
-    logging.info("read %d bytes, %0.4f blocks, header len=%d" % (len(received), old_div(len(received), 2880.0), len(hdr)))
-
-    return hdr
-
-class FetchHeader(multiprocessing.Process):
-    def __init__(self, logger=None, fullHeader=True, timeLimit=15, frameId=9999, itime=0.0, exptype='TEST'):
-        super(FetchHeader, self).__init__(name="FetchHeader")
-        self.daemon = True
-        self.q = multiprocessing.Queue()
-        self.timeLimit = timeLimit
-        self.frameId = frameId
-        self.itime = itime
-        self.exptype = exptype
-        self.fullHeader = fullHeader
-        if logger is None:
-            self.logger = logging.getLogger('fetchHeader')
-            self.logger.setLevel(logging.DEBUG)
-            
-        self.logger.debug('inited process %s (frameId=%s)' % (self.name, frameId))
-    
     def run(self):
-        self.logger.info('starting process %s (%s)' % (self.name, self.frameId))
+        while not self.exiting:
+            req = self.requests.get()
+            if req is None:
+                continue
+            batch = [req]
+            while len(batch) < self.maxPipeline:
+                try:
+                    req = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if req is not None:
+                    batch.append(req)
 
-        try:
-            hdr = fetchHeader(self.fullHeader,self.frameId, exptype=self.exptype, itime=self.itime)
-            hdrString = hdr.tostring()
-        except Exception as e:
-            self.logger.warn('fetchHeader failed: %s', e)
-            self.q.put(pyfits.Header().tostring())
-            return
-        
-        self.logger.info('header: %s' % (len(hdrString)))
-        
-        self.q.put(hdrString)
-        
+            # The server might have closed an idle connection, so a failure on
+            # a reused connection is retried on a new one; a failure on a new
+            # connection fails the request. A server which closes after every
+            # reply also drops any pipelined requests: stop pipelining.
+            while batch:
+                nsend = len(batch) if self.pipelining else 1
+                freshConnection = self.sock is None
+                try:
+                    unanswered = self._sendBatch(batch[:nsend])
+                except Exception as e:
+                    self._disconnect()
+                    unanswered = [req for req in batch[:nsend] if not req.done.is_set()]
+                    if nsend > 1 and len(unanswered) < nsend:
+                        self.logger.warning('header server closed a pipelined connection; '
+                                            'sending one request at a time')
+                        self.pipelining = False
+                    elif freshConnection:
+                        self.logger.warning('header fetch for %s failed: %s', unanswered[0].key[0], e)
+                        unanswered.pop(0).finish(error=e)
+                batch = unanswered + batch[nsend:]
+
+def headerClient(actor):
+    """ Return the actor's header client, starting it if necessary. """
+
+    client = getattr(actor, 'gen2HeaderClient', None)
+    if client is None or not client.is_alive():
+        client = HeaderClient()
+        client.start()
+        actor.gen2HeaderClient = client
+    return client
+
+def fetchHeader(fullHeader=True, frameid=9999, exptype='TEST', itime=0.0, timeout=5.0):
+    """Request FITS cards from the Gen2 side, with a one-off client. """
+
+    client = HeaderClient()
+    client.start()
+    try:
+        return client.fetch(frameid, exptype=exptype, itime=itime, fullHeader=fullHeader, timeout=timeout)
+    except Exception as e:
+        logging.error("failed to fetch header: %s" % (e))
+        return pyfits.Header()
+    finally:
+        client.exit()
@@ -1,4 +1,5 @@
 from __future__ import print_function
+import collections
 import logging
 import multiprocessing
 import os
@@ -7,72 +8,82 @@ import time
 
 import inotify.adapters
 
-def trackWinDir(rootDir, q, logger=None, timeLimit=None, doOneOnly=False):
+# What the watcher reports:
+#   kind : 'file' or 'dir'
+#   action : 'add' or 'done'
+#   path : the full path
+#   time : when the event was seen
+FileEvent = collections.namedtuple('FileEvent', ('kind', 'action', 'path', 'time'))
+
+def trackWinDir(rootDir, q, logger=None, sectionsToWatch=('UpTheRamp',)):
     """ Generate notifications of directory and file events from the Teledyne IDL software..
 
-    Specifically, we expect `rootDir` to be the per-detectory directory which contains 
+    Specifically, we expect `rootDir` to be the per-detectory directory which contains
     the UpTheRamp, CDSReference, Reference directories.
-    
+
     As it stands we only watch the UpTheRamp directory, but that might change.
- 
+
+    New ramp (`201*`) directories in a section are followed automatically,
+    and the previous ramp directory of that section is declared done and
+    dropped. The CREATE/MODIFY/CLOSE_WRITE bursts for each read file are
+    coalesced into one 'add' and one 'done' event.
+
     Args:
        rootDir (str) : the root of the directory tree to watch.
-       q (Queue)     : the queue to write notifications to.
+       q (Queue)     : the queue to write `FileEvent`s to.
 
     """
 
-    sectionsToWatch = {'UpTheRamp'}
+    if logger is None:
+        logger = logging.getLogger('winFiles')
+
     subDirs = dict()
-    filesDone = dict()
+    filesAdded = set()
+    filesDone = set()
 
     logger.debug('setting up inotify')
-    
+
     i = inotify.adapters.Inotify()
     i.add_watch(rootDir)
     for d in sectionsToWatch:
         i.add_watch(os.path.join(rootDir, d))
 
     logger.debug('looping on inotify')
-    lastTime = time.time()
     for event in i.event_gen():
-        logger.debug('inotify event: %s', event)
         if event is None:
-            thisTime = time.time()
-            if thisTime - lastTime > timeLimit:
-                raise RuntimeError('timeout (>%s sec) listening for image files.' % (thisTime-lastTime))
-            lastTime = thisTime
             continue
 
         try:
             (header, events, watch_path, filename) = event
-            logger.info('new fs event: %s', event)
             filepath = os.path.join(watch_path, filename)
             if 'IN_ISDIR' in events:
-
-                    if filename[:3] == '201':
-                        lastWatch = subDirs.get(watch_path, None)
-                        if lastWatch is not None:
-                            q.put('dir done %s' % (lastWatch))
+                if 'IN_CREATE' in events and filename[:3] == '201':
+                    logger.info('new ramp directory: %s', filepath)
+                    lastWatch = subDirs.get(watch_path, None)
+                    if lastWatch is not None:
+                        q.put(FileEvent('dir', 'done', lastWatch, time.time()))
+                        try:
                             i.remove_watch(lastWatch)
-                            if doOneOnly:
-                                q.put('alldone alldone alldone')
-                                return
-                        subDirs[watch_path] = filepath
-                        i.add_watch(filepath)
-                        q.put('dir add %s' % (filepath))
-                        continue
-            elif 'IN_CLOSE_NOWRITE' in events:
-                    continue
-            elif 'IN_CREATE' in events and filename.startswith('H2RG_'):
-                q.put('file add %s' % (filepath))
-                continue
-            elif 'IN_CLOSE_WRITE' in events and filename.startswith('H2RG_'):
-                if filepath not in filesDone:
-                    filesDone[filepath] = True
-                    q.put('file done %s' % (filepath))
+                        except Exception as e:
+                            logger.warning('failed to remove watch on %s: %s', lastWatch, e)
+                        filesAdded = {f for f in filesAdded if not f.startswith(lastWatch + os.sep)}
+                        filesDone = {f for f in filesDone if not f.startswith(lastWatch + os.sep)}
+                    subDirs[watch_path] = filepath
+                    i.add_watch(filepath)
+                    q.put(FileEvent('dir', 'add', filepath, time.time()))
                 continue
 
-            if 'IN_MODIFY' not in events:
+            if not filename.startswith('H2RG_'):
+                continue
+            if 'IN_CREATE' in events:
+                if filepath not in filesAdded:
+                    filesAdded.add(filepath)
+                    q.put(FileEvent('file', 'add', filepath, time.time()))
+            elif 'IN_CLOSE_WRITE' in events:
+                if filepath not in filesDone:
+                    filesDone.add(filepath)
+                    q.put(FileEvent('file', 'done', filepath, time.time()))
+            elif 'IN_MODIFY' not in events and 'IN_CLOSE_NOWRITE' not in events:
                 logger.debug("WD=(%d) MASK=(%d) COOKIE=(%d) LEN=(%d) MASK->NAMES=%s "
                              "WATCH-PATH=[%s] FILENAME=[%s]",
                              header.wd, header.mask, header.cookie, header.len, events,
@@ -80,24 +91,33 @@ def trackWinDir(rootDir, q, logger=None, timeLimit=None, doOneOnly=False):
         except Exception as e:
             logger.error("error handling fs event %s: %s", event, e)
             continue
-        
-class FileAlert(multiprocessing.Process):
-    def __init__(self, topDir, logger=None, timeLimit=15):
-        super(FileAlert, self).__init__(name="FileAlert(%s)" % (topDir))
+
+class WinFileWatcher(multiprocessing.Process):
+    def __init__(self, topDir, logger=None, retryDelay=10.0):
+        """ The long-lived process which watches the IDL output tree, and reports to .q
+
+        Start it once: it follows new ramp directories by itself. If the
+        tree cannot be watched (e.g. it is not mounted yet), it retries
+        every retryDelay seconds.
+        """
+        super(WinFileWatcher, self).__init__(name="WinFileWatcher(%s)" % (topDir))
         self.daemon = True
         self.topDir = topDir
         self.q = multiprocessing.Queue()
-        self.timeLimit = timeLimit
-        if logger is None:
-            self.logger = logging.getLogger('winFiles')
+        self.retryDelay = retryDelay
+        self.logger = logger if logger is not None else logging.getLogger('winFiles')
         self.logger.debug('inited process %s' % (self.name))
-    
+
     def run(self):
         self.logger.info('starting process %s' % (self.name))
-        os.chdir(self.topDir)
-        
-        trackWinDir(self.topDir, self.q, self.logger, timeLimit=self.timeLimit)
-        
+        while True:
+            try:
+                trackWinDir(self.topDir, self.q, self.logger)
+            except Exception as e:
+                self.logger.warning('watching %s failed, retrying in %ss: %s',
+                                    self.topDir, self.retryDelay, e)
+                time.sleep(self.retryDelay)
+
 def main():
     logging.basicConfig()
     logger = logging.getLogger()
@@ -107,12 +127,12 @@ def main():
         root = sys.argv[1]
     else:
         root = os.path.realpath(os.path.curdir)
-        
-    f = FileAlert(root, logger=logger)
+
+    f = WinFileWatcher(root, logger=logger)
     f.start()
     while True:
         ev = f.q.get()
         print(ev)
-    
+
 if __name__ == "__main__":
     main()
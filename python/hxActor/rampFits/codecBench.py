@@ -0,0 +1,105 @@
+"""Benchmark the ramp codecs over recorded reads.
+
+Every codec is run over the IMAGE, REF, and RESET HDUs of one or more existing
+ramp files, and the speed (MB/s of raw read data) and compression ratio
+(raw bytes / stored bytes) are reported for each HDU type.
+
+Usage:
+  python -m hxActor.rampFits.codecBench [--codecs rice,diff:rice] [--nreads N] ramp.fits [...]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import fitsio
+
+from hxActor.rampFits import rampCodecs
+
+def loadReads(path, maxReads=None):
+    """Load and decode the reads of an existing ramp file.
+
+    Returns
+    -------
+    reads : `dict`
+      For each HDU type, a list of (extname, array).
+    """
+
+    reads = {t:[] for t in rampCodecs.hduTypes}
+    decoded = dict()
+    with fitsio.FITS(path) as ff:
+        for hdu in ff[1:]:
+            extname = hdu.get_extname()
+            if not rampCodecs.isReadHdu(extname):
+                continue
+            hdr = hdu.read_header()
+            data = rampCodecs.expandConstant(hdr)
+            if data is None:
+                prevName = hdr.get('W_H4DREF')
+                data = rampCodecs.undoDifference(hdu.read(), hdr, decoded.get(prevName))
+            decoded[extname] = data
+
+            hduList = reads[rampCodecs.hduType(extname)]
+            if maxReads is None or len(hduList) < maxReads:
+                hduList.append((extname, data))
+
+    return reads
+
+def benchCodec(codec, reads, tmpDir):
+    """Write a list of reads with one codec, and return (seconds, rawBytes, storedBytes). """
+
+    with tempfile.NamedTemporaryFile(dir=tmpDir, suffix='.fits') as tmpFile:
+        ff = fitsio.FITS(tmpFile.name, 'rw', clobber=True)
+        ff.write(None)
+        emptySize = os.path.getsize(tmpFile.name)
+
+        previous = dict()
+        rawBytes = 0
+        t0 = time.time()
+        for extname, data in reads:
+            stream = rampCodecs.hduStream(extname)
+            prevName, prev = previous.get(stream, (None, None))
+            stored, cards = codec.encode(data, previous=prev, previousName=prevName)
+            ff.write(stored, header=cards, extname=extname, **codec.writeArgs())
+            previous[stream] = (extname, data)
+            rawBytes += data.nbytes
+        ff.close()
+        dt = time.time() - t0
+
+        storedBytes = os.path.getsize(tmpFile.name) - emptySize
+
+    return dt, rawBytes, storedBytes
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark ramp codecs over recorded reads')
+    parser.add_argument('rampFiles', nargs='+', help='existing ramp files to take reads from')
+    parser.add_argument('--codecs', default=None,
+                        help='comma-separated codec specs. Default is all known codecs.')
+    parser.add_argument('--nreads', type=int, default=None,
+                        help='maximum number of reads of each type to use from each file')
+    parser.add_argument('--tmpdir', default=None,
+                        help='directory to write test files to. Use the data disk for realistic timing.')
+    args = parser.parse_args(argv)
+
+    specs = args.codecs.split(',') if args.codecs else rampCodecs.allCodecSpecs()
+    codecs = [rampCodecs.getCodec(s) for s in specs]
+
+    allReads = {t:[] for t in rampCodecs.hduTypes}
+    for path in args.rampFiles:
+        reads = loadReads(path, maxReads=args.nreads)
+        for t in rampCodecs.hduTypes:
+            allReads[t].extend(reads[t])
+
+    print(f'{"type":6s} {"codec":16s} {"nhdu":>5s} {"MB/s":>8s} {"ratio":>7s}')
+    for hduType in rampCodecs.hduTypes:
+        reads = allReads[hduType]
+        if not reads:
+            continue
+        for codec in codecs:
+            dt, rawBytes, storedBytes = benchCodec(codec, reads, args.tmpdir)
+            print(f'{hduType:6s} {codec.name:16s} {len(reads):5d} '
+                  f'{rawBytes/1e6/dt:8.1f} {rawBytes/storedBytes:7.3f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+"""Minimal FITS block-level writing, for ramp files whose layout we control byte by byte.
+
+Only what the raw ramp writer needs: image HDU headers with optional reserved
+space, big-endian data with unsigned integer BZERO handling, the sizes
+needed to plan where each HDU will land in a file, a primary header
+which can always be amended in place, and simple binary tables.
+
+Reserved header space is a run of blank cards just before END, which FITS
+readers (including cfitsio) ignore.
+
+The FITS DATASUM and CHECKSUM cards are computed from the bytes we already
+have in memory, so that files never need to be read back to checksum them.
+"""
+
+import numpy as np
+
+import astropy.io.fits as pyfits
+
+BLOCK = 2880
+CARD = 80
+
+# Pixel types we write, with their BITPIX and unsigned offset.
+imageTypes = {np.dtype('u1'): (8, None),
+              np.dtype('i2'): (16, None),
+              np.dtype('u2'): (16, 1 << 15),
+              np.dtype('i4'): (32, None),
+              np.dtype('u4'): (32, 1 << 31),
+              np.dtype('i8'): (64, None),
+              np.dtype('f4'): (-32, None),
+              np.dtype('f8'): (-64, None)}
+
+# Filled in by setChecksum, so never taken from callers' cards.
+checksumNames = {'CHECKSUM', 'DATASUM'}
+checksumPlaceholder = '0' * 16
+
+# Binary table column types we write, with their TFORM codes.
+tableForms = {np.dtype('u1'): 'B',
+              np.dtype('i2'): 'I',
+              np.dtype('i4'): 'J',
+              np.dtype('i8'): 'K',
+              np.dtype('f4'): 'E',
+              np.dtype('f8'): 'D'}
+
+structuralNames = {'SIMPLE', 'EXTEND', 'XTENSION', 'BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT',
+                   'BZERO', 'BSCALE', 'EXTNAME', 'END'}
+
+def paddedSize(nbytes):
+    """Return nbytes rounded up to a whole number of FITS blocks. """
+
+    return (nbytes + BLOCK - 1) // BLOCK * BLOCK
+
+def isStructural(name):
+    return name in structuralNames or (name.startswith('NAXIS') and name[5:].isdigit())
+
+def splitImage(image):
+    """Return the 80-character cards of a card image.
+
+    A long string value makes astropy emit CONTINUE cards, so one card's
+    image can be several 80-character cards.
+    """
+
+    return [image[i:i+CARD] for i in range(0, len(image), CARD)]
+
+def cardImages(cards):
+    """Return the 80-character card images of a list of card dicts, skipping structural cards.
+
+    A card with a long string value gives several images, one for each of
+    its CONTINUE cards.
+    """
+
+    images = []
+    for c in cards:
+        name = c['name'].upper()
+        if isStructural(name):
+            continue
+        card = pyfits.Card(name, c.get('value'), c.get('comment', ''))
+        images.extend(splitImage(card.image))
+    return images
+
+def structuralCards(shape=None, dtype=None, extname=None, primary=False):
+    """Return the leading structural cards for a primary or image extension HDU.
+
+    If shape is None, the HDU has no data (NAXIS=0).
+    """
+
+    if primary:
+        cards = [dict(name='SIMPLE', value=True, comment='conforms to FITS standard')]
+    else:
+        cards = [dict(name='XTENSION', value='IMAGE', comment='Image extension')]
+
+    if shape is None:
+        bitpix, bzero = 8, None
+        shape = ()
+    else:
+        bitpix, bzero = imageTypes[np.dtype(dtype).newbyteorder('=')]
+
+    cards.append(dict(name='BITPIX', value=bitpix, comment='array data type'))
+    cards.append(dict(name='NAXIS', value=len(shape), comment='number of array dimensions'))
+    for i, n in enumerate(reversed(shape)):
+        cards.append(dict(name=f'NAXIS{i+1}', value=int(n)))
+    if primary:
+        cards.append(dict(name='EXTEND', value=True))
+    else:
+        cards.append(dict(name='PCOUNT', value=0, comment='number of parameters'))
+        cards.append(dict(name='GCOUNT', value=1, comment='number of groups'))
+    if bzero is not None:
+        cards.append(dict(name='BZERO', value=bzero, comment='offset data range to that of unsigned'))
+        cards.append(dict(name='BSCALE', value=1))
+    if extname is not None:
+        cards.append(dict(name='EXTNAME', value=extname, comment='extension name'))
+
+    return cards
+
+def headerBytes(structural, cards, minBlocks=0):
+    """Return a complete FITS header, padded to whole blocks.
+
+    Parameters
+    ----------
+    structural : list of card dicts
+      The leading structural cards, from `structuralCards`
+    cards : list of card dicts
+      The other cards. Any structural cards here are dropped.
+    minBlocks : `int`
+      Pad the header with blank cards so that it uses at least this many blocks.
+    """
+
+    images = []
+    for c in structural:
+        images.extend(splitImage(pyfits.Card(c['name'], c['value'], c.get('comment', '')).image))
+    images.extend(cardImages(cards))
+
+    nbytes = paddedSize((len(images) + 1) * CARD)
+    nbytes = max(nbytes, minBlocks * BLOCK)
+    nblank = nbytes // CARD - len(images) - 1
+    images.extend([' ' * CARD] * nblank)
+    images.append('END'.ljust(CARD))
+
+    return ''.join(images).encode('ascii')
+
+def onesSum(buf, total=0, offset=0):
+    """Add bytes to a running 32-bit ones' complement sum, as used by the FITS checksums.
+
+    Parameters
+    ----------
+    buf : `bytes`
+      FITS (big-endian) bytes.
+    total : `int`
+      The sum so far.
+    offset : `int`
+      Where buf starts in its header or data unit, if it might not be word-aligned.
+    """
+
+    lead = offset % 4
+    tail = -(lead + len(buf)) % 4
+    if lead or tail:
+        buf = b'\0' * lead + bytes(buf) + b'\0' * tail
+    total += int(np.frombuffer(buf, dtype='>u4').sum(dtype=np.uint64))
+    while total >> 32:
+        total = (total & 0xffffffff) + (total >> 32)
+    return total
+
+def addSums(a, b):
+    """Return the ones' complement sum of two sums. """
+
+    total = a + b
+    while total >> 32:
+        total = (total & 0xffffffff) + (total >> 32)
+    return total
+
+def encodeChecksum(total):
+    """Return the 16-character CHECKSUM value for a header+data ones' complement sum. """
+
+    value = ~total & 0xffffffff
+    exclude = set(range(0x3a, 0x41)) | set(range(0x5b, 0x61))
+    asc = [0] * 16
+    for byte in range(4):
+        byteVal = (value >> (24 - 8*byte)) & 0xff
+        quotient = byteVal // 4 + 0x30
+        ch = [quotient + byteVal % 4, quotient, quotient, quotient]
+        check = True
+        while check:
+            check = False
+            for j in (0, 2):
+                if ch[j] in exclude or ch[j+1] in exclude:
+                    ch[j] += 1
+                    ch[j+1] -= 1
+                    check = True
+        for j in range(4):
+            asc[4*j + byte] = ch[j]
+    return ''.join(chr(asc[(i + 15) % 16]) for i in range(16))
+
+def checksumCards(dataSum=0):
+    return [dict(name='CHECKSUM', value=checksumPlaceholder, comment='HDU checksum'),
+            dict(name='DATASUM', value=str(dataSum), comment='data unit checksum')]
+
+def setChecksum(header, dataSum):
+    """Fill in the DATASUM and CHECKSUM cards of a complete header, in place.
+
+    Parameters
+    ----------
+    header : `bytearray`
+      The header blocks, which must already have CHECKSUM and DATASUM cards.
+    dataSum : `int`
+      The `onesSum` of the HDU's data unit.
+    """
+
+    where = dict()
+    for i in range(0, len(header), CARD):
+        name = bytes(header[i:i+8]).rstrip().decode('ascii')
+        if name in checksumNames:
+            where[name] = i
+    if len(where) != 2:
+        raise ValueError('header does not have both CHECKSUM and DATASUM cards')
+
+    for card, image in zip(checksumCards(dataSum), cardImages(checksumCards(dataSum))):
+        at = where[card['name']]
+        header[at:at+CARD] = image.encode('ascii')
+
+    valueAt = where['CHECKSUM'] + 11
+    header[valueAt:valueAt+16] = encodeChecksum(onesSum(header, dataSum)).encode('ascii')
+    return header
+
+def checksummedHeader(structural, cards, dataSum, minBlocks=0):
+    """Return a complete header, as `headerBytes`, with DATASUM and CHECKSUM for the given data sum. """
+
+    cards = [c for c in cards if c['name'] not in checksumNames] + checksumCards(dataSum)
+    return bytes(setChecksum(bytearray(headerBytes(structural, cards, minBlocks=minBlocks)), dataSum))
+
+def imageHduBytes(data, cards, extname=None, minBlocks=0):
+    """Return the checksummed (header, data) bytes of a complete image extension. """
+
+    dataBytes_ = dataBytes(data)
+    header = checksummedHeader(structuralCards(data.shape, data.dtype, extname), cards,
+                               onesSum(dataBytes_), minBlocks=minBlocks)
+    return header, dataBytes_
+
+def tableHduBytes(table, cards=(), extname=None):
+    """Return the checksummed (header, data) bytes of a binary table extension.
+
+    Parameters
+    ----------
+    table : `np.ndarray`
+      A structured array, with numeric columns of the `tableForms` types, or fixed-length strings.
+    """
+
+    structural = [dict(name='XTENSION', value='BINTABLE', comment='binary table extension'),
+                  dict(name='BITPIX', value=8),
+                  dict(name='NAXIS', value=2),
+                  dict(name='NAXIS1', value=table.dtype.itemsize, comment='bytes per row'),
+                  dict(name='NAXIS2', value=len(table), comment='number of rows'),
+                  dict(name='PCOUNT', value=0),
+                  dict(name='GCOUNT', value=1),
+                  dict(name='TFIELDS', value=len(table.dtype.names))]
+    for c_i, name in enumerate(table.dtype.names):
+        colType = table.dtype[name]
+        if colType.kind == 'S':
+            form = f'{colType.itemsize}A'
+        else:
+            form = tableForms[colType.newbyteorder('=')]
+        structural.append(dict(name=f'TTYPE{c_i+1}', value=name))
+        structural.append(dict(name=f'TFORM{c_i+1}', value=form))
+    if extname is not None:
+        structural.append(dict(name='EXTNAME', value=extname, comment='extension name'))
+
+    raw = table.astype(table.dtype.newbyteorder('>'), copy=False).tobytes()
+    data = raw + b'\0' * (paddedSize(len(raw)) - len(raw))
+    return checksummedHeader(structural, cards, onesSum(data)), data
+
+def updateCards(cards, newCards):
+    """Return a copy of cards, with newCards replacing same-named cards or appended. """
+
+    cards = list(cards)
+    for card in newCards:
+        for c_i, c in enumerate(cards):
+            if c['name'] == card['name'] and c['name'] not in {'COMMENT', 'HISTORY'}:
+                cards[c_i] = card
+                break
+        else:
+            cards.append(card)
+    return cards
+
+class PrimaryHeader(object):
+    def __init__(self, cards, reserveCards=0):
+        """A data-less primary header with a fixed size, so that it can be rewritten in place.
+
+        Parameters
+        ----------
+        cards : list of card dicts
+          The initial cards.
+        reserveCards : `int`
+          How many more 80-byte cards the header must be able to take. The
+          header is rounded up to whole blocks, so usually has a few more.
+        """
+
+        self.structural = structuralCards(primary=True)
+        self.cards = [c for c in cards if c['name'] not in checksumNames]
+        self.size = paddedSize((self.cardCount(self.cards) + reserveCards + 1) * CARD)
+
+    def cardCount(self, cards):
+        """Return how many 80-byte cards the header needs for cards, including CONTINUE cards. """
+
+        structural = sum(len(splitImage(pyfits.Card(c['name'], c['value']).image)) for c in self.structural)
+        return structural + len(cardImages(cards)) + len(checksumNames)
+
+    @property
+    def freeCards(self):
+        return headerCapacity(self.size) - self.cardCount(self.cards)
+
+    def toBytes(self):
+        return checksummedHeader(self.structural, self.cards, 0, minBlocks=self.size // BLOCK)
+
+    def amend(self, cards):
+        """Update or add cards, and return the new header bytes, which are always the same size.
+
+        Raises
+        ------
+        RuntimeError
+          if the new cards do not fit in the reserved space. The header is left unchanged.
+        """
+
+        newCards = updateCards(self.cards, [c for c in cards if c['name'] not in checksumNames])
+        nImages = self.cardCount(newCards)
+        if nImages > headerCapacity(self.size):
+            raise RuntimeError(f'amended PHDU needs {nImages} cards, but only '
+                               f'{headerCapacity(self.size)} fit in the reserved {self.size} bytes')
+        self.cards = newCards
+        return self.toBytes()
+
+def headerCapacity(nbytes):
+    """Return the number of cards (excluding END) which fit in a header of nbytes. """
+
+    return nbytes // CARD - 1
+
+def dataBytes(data):
+    """Return the big-endian FITS representation of an array, padded to whole blocks. """
+
+    dtype = np.dtype(data.dtype).newbyteorder('=')
+    bitpix, bzero = imageTypes[dtype]
+    if bzero is not None:
+        stored = np.bitwise_xor(data, np.array(bzero, dtype=dtype))
+    else:
+        stored = data
+    raw = stored.astype(dtype.newbyteorder('>'), copy=False).tobytes()
+    return raw + b'\0' * (paddedSize(len(raw)) - len(raw))
+
+def dataSize(shape, dtype):
+    """Return the padded on-disk size of an image's data. """
+
+    if shape is None:
+        return 0
+    return paddedSize(int(np.prod(shape)) * np.dtype(dtype).itemsize)
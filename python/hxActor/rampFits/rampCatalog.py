@@ -0,0 +1,225 @@
+"""A local SQLite catalogue of the ramps we have written.
+
+One row is added per ramp file, when the writer has closed it (see
+`hxActor.Commands.ramp.Ramp.closedFits`), from the writer's closedFits reply:
+which visit produced which file, with what detector and writer configuration,
+how many reads were actually written, whether the PHDU was patched, and the
+file's size, data checksum and per-read statistics.
+
+Every operation uses its own connection, so the catalogue can be used from the
+writer's reply thread and the command thread at once.
+
+  cat = RampCatalog('/data/ramps/rampCatalog.sqlite')
+  cat.find(visit=12301)
+  cat.find(exptype='DARK', since='2026-10-01', limit=20)
+
+Usage:
+  python -m hxActor.rampFits.rampCatalog [--visit V] [--camera CAM] [--exptype T] [--since DATE] catalog.sqlite
+"""
+
+import argparse
+import datetime
+import json
+import pathlib
+import sqlite3
+
+schema = """
+CREATE TABLE IF NOT EXISTS ramps (
+    id INTEGER PRIMARY KEY,
+    visit INTEGER,
+    path TEXT UNIQUE,
+    writtenPath TEXT,
+    camera TEXT,
+    exptype TEXT,
+    dateObs TEXT,
+    nread INTEGER,
+    nreadDone INTEGER,
+    stoppedAt INTEGER,
+    nreset INTEGER,
+    frameTime REAL,
+    irp INTEGER,
+    irpRatio INTEGER,
+    irpOffset INTEGER,
+    layout TEXT,
+    codecs TEXT,
+    formatVersion INTEGER,
+    fileSize INTEGER,
+    dataSum TEXT,
+    patched INTEGER,
+    closedAt TEXT,
+    readStats TEXT
+);
+CREATE INDEX IF NOT EXISTS ramps_visit ON ramps (visit);
+CREATE INDEX IF NOT EXISTS ramps_camera_closed ON ramps (camera, closedAt);
+CREATE INDEX IF NOT EXISTS ramps_exptype_closed ON ramps (exptype, closedAt);
+"""
+
+# The columns which hold JSON.
+jsonColumns = ('codecs', 'readStats')
+
+def visitFromPath(path):
+    """Return the visit from a ramp filename, e.g. PFJA00012301.fits -> 123, or None. """
+
+    try:
+        return int(pathlib.Path(path).stem[4:-2], base=10)
+    except ValueError:
+        return None
+
+def rowFromReply(reply, camera=None, finalPath=None):
+    """Build a catalogue row from a successful `RampWriter` closedFits reply.
+
+    Parameters
+    ----------
+    reply : `dict`
+      The closedFits reply.
+    camera : `str`
+      The camera name.
+    finalPath : `str`
+      If the file was written to a staging directory, where it will end up.
+    """
+
+    phdr = reply.get('phdr', dict())
+    plan = reply.get('plan') or dict()
+    readStats = reply.get('readStats', [])
+
+    nread = plan.get('nread')
+    nreadDone = len([r for r in readStats if r['extname'].startswith('IMAGE_')])
+    if phdr.get('W_H4NRED') is not None and nread is not None and phdr['W_H4NRED'] < nread:
+        stoppedAt = phdr['W_H4NRED']
+    elif nread is not None and nreadDone < nread:
+        stoppedAt = nreadDone
+    else:
+        stoppedAt = None
+
+    return dict(visit=visitFromPath(reply['path']),
+                path=str(finalPath if finalPath is not None else reply['path']),
+                writtenPath=str(reply['path']),
+                camera=camera,
+                exptype=phdr.get('DATA-TYP'),
+                dateObs=phdr.get('DATE-OBS'),
+                nread=nread,
+                nreadDone=nreadDone,
+                stoppedAt=stoppedAt,
+                nreset=plan.get('nreset'),
+                frameTime=phdr.get('W_H4FRMT'),
+                irp=phdr.get('W_H4IRP', plan.get('irp')),
+                irpRatio=phdr.get('W_H4IRPN'),
+                irpOffset=phdr.get('W_H4IRPO'),
+                layout=reply.get('layout'),
+                codecs=reply.get('codecs'),
+                formatVersion=phdr.get('W_4FMTVR'),
+                fileSize=reply.get('size'),
+                dataSum=reply.get('dataSum'),
+                patched=phdr.get('W_H4PTCH'),
+                closedAt=datetime.datetime.now().isoformat(timespec='seconds'),
+                readStats=readStats)
+
+class RampCatalog(object):
+    def __init__(self, dbPath):
+        """The catalogue in the SQLite database at dbPath, created if necessary.
+
+        Keep the database on a local disk: SQLite locking is not reliable over NFS.
+        """
+
+        self.dbPath = str(dbPath)
+        pathlib.Path(self.dbPath).parent.mkdir(parents=True, exist_ok=True)
+        with self.connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(schema)
+
+    def connect(self):
+        db = sqlite3.connect(self.dbPath, timeout=10.0)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def add(self, row):
+        """Add or replace the row for a ramp file. """
+
+        row = dict(row)
+        for name in jsonColumns:
+            if row.get(name) is not None:
+                row[name] = json.dumps(row[name])
+        names = list(row.keys())
+        sql = (f'INSERT OR REPLACE INTO ramps ({", ".join(names)}) '
+               f'VALUES ({", ".join(":" + n for n in names)})')
+        db = self.connect()
+        try:
+            with db:
+                db.execute(sql, row)
+        finally:
+            db.close()
+
+    def addRamp(self, reply, camera=None, finalPath=None):
+        """Add the ramp described by a closedFits reply. """
+
+        self.add(rowFromReply(reply, camera=camera, finalPath=finalPath))
+
+    def find(self, visit=None, camera=None, exptype=None, since=None, until=None,
+             stopped=None, limit=None):
+        """Return the matching ramps, newest first, as a list of dicts.
+
+        Parameters
+        ----------
+        visit : `int`
+        camera, exptype : `str`
+        since, until : `str`
+          ISO dates or times, compared against when the files were closed.
+        stopped : `bool`
+          If set, only ramps which were (or were not) stopped early.
+        limit : `int`
+          The maximum number of rows to return.
+        """
+
+        where = []
+        args = dict()
+        for name, value in (('visit', visit), ('camera', camera), ('exptype', exptype)):
+            if value is not None:
+                where.append(f'{name} = :{name}')
+                args[name] = value
+        if since is not None:
+            where.append('closedAt >= :since')
+            args['since'] = since
+        if until is not None:
+            where.append('closedAt < :until')
+            args['until'] = until
+        if stopped is not None:
+            where.append('stoppedAt IS NOT NULL' if stopped else 'stoppedAt IS NULL')
+
+        sql = 'SELECT * FROM ramps'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY closedAt DESC, id DESC'
+        if limit is not None:
+            sql += ' LIMIT :limit'
+            args['limit'] = limit
+
+        db = self.connect()
+        try:
+            rows = [dict(r) for r in db.execute(sql, args)]
+        finally:
+            db.close()
+
+        for row in rows:
+            for name in jsonColumns:
+                if row[name] is not None:
+                    row[name] = json.loads(row[name])
+        return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='query the ramp catalogue')
+    parser.add_argument('catalog', help='the catalogue database')
+    parser.add_argument('--visit', type=int, default=None)
+    parser.add_argument('--camera', default=None)
+    parser.add_argument('--exptype', default=None)
+    parser.add_argument('--since', default=None, help='ISO date or time')
+    parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    cat = RampCatalog(args.catalog)
+    for r in cat.find(visit=args.visit, camera=args.camera, exptype=args.exptype,
+                      since=args.since, limit=args.limit):
+        print(f'{"-" if r["visit"] is None else r["visit"]:>8} {r["closedAt"]} {r["camera"] or "-":4s} {r["exptype"] or "-":8s} '
+              f'{r["nreadDone"]}/{r["nread"]} patched={r["patched"]} {r["fileSize"]} {r["dataSum"]} {r["path"]}')
+
+if __name__ == '__main__':
+    main()
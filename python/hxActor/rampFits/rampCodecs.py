@@ -0,0 +1,233 @@
+"""Codecs for storing the HDUs of an H4 ramp file.
+
+A codec decides how a single read is stored in the ramp file: which (if any)
+FITS tile compression is applied, and whether the read is stored as-is or as
+the difference from the previous read of the same kind. Successive reads of a
+ramp are very highly correlated, so the differences are mostly small numbers
+which compress much better than the reads themselves.
+
+Codecs are named with short specs:
+  'none'       : plain uncompressed image
+  'rice'       : RICE_1 tile compression
+  'gzip_1'     : GZIP_1 tile compression
+  'gzip_2'     : GZIP_2 (byte-shuffled) tile compression
+  'hcompress'  : lossless HCOMPRESS_1 tile compression
+  'diff:SPEC'  : difference from previous read, stored with SPEC ('diff' alone is 'diff:none')
+
+The actor configuration can assign a codec per HDU type (IMAGE, REF, RESET).
+
+Independently of the codec, planes with a single value (the REF HDUs without
+IRP, and reset reads with no data) are stored as header-only HDUs: NAXIS=0,
+with CONSTVAL giving the value and CONSTNX/CONSTNY/CONSTDTY the shape and dtype
+of the plane. `expandConstant` rebuilds the array.
+"""
+
+import numpy as np
+
+hduTypes = ('IMAGE', 'REF', 'RESET')
+
+# The per-read HDU sequences of an 'hdus' layout file. Anything else (e.g. HDUINDEX) is not a read.
+readStreams = ('IMAGE', 'REF', 'RESET_IMAGE', 'RESET_REF')
+
+# Map our spec names to the fitsio `compress=` names.
+tileCompressions = dict(none=None,
+                        rice='RICE',
+                        gzip_1='GZIP',
+                        gzip_2='GZIP_2',
+                        hcompress='HCOMPRESS')
+
+def hduType(extname):
+    """Return the codec HDU type (IMAGE, REF, RESET) for an extension name. """
+
+    if extname.startswith('RESET_'):
+        return 'RESET'
+    if extname.startswith('REF'):
+        return 'REF'
+    return 'IMAGE'
+
+def hduStream(extname):
+    """Return the sequence of reads an HDU belongs to: e.g. 'RESET_REF' for 'RESET_REF_1'. """
+
+    return extname.rsplit('_', 1)[0]
+
+def isReadHdu(extname):
+    return bool(extname) and hduStream(extname) in readStreams
+
+class Codec(object):
+    def __init__(self, name, compression=None):
+        """Store reads as plain images, optionally with FITS tile compression.
+
+        Parameters
+        ----------
+        name : `str`
+          The spec this codec was built from.
+        compression : `str`
+          The fitsio compression name, or None.
+        """
+        self.name = name
+        self.compression = compression
+
+    isDifference = False
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name})'
+
+    @property
+    def isCompressed(self):
+        return self.compression is not None
+
+    def writeArgs(self):
+        """Return the extra keyword arguments for `fitsio.FITS.write` """
+
+        if self.compression is None:
+            return dict()
+        return dict(compress=self.compression)
+
+    def cards(self):
+        return [dict(name='W_H4CODC', value=self.name, comment='ramp codec used for this HDU')]
+
+    def encode(self, data, previous=None, previousName=None):
+        """Return the array to store for `data`, and any cards needed to decode it. """
+
+        return data, self.cards()
+
+    def decode(self, stored, hdr, previous=None):
+        """Return the original read from the stored array and its header. """
+
+        return stored
+
+class DifferenceCodec(Codec):
+    def __init__(self, name, compression=None):
+        """Store reads as the int32 difference from the previous read in the same stream.
+
+        The first read of each stream (and any read whose predecessor was not
+        kept) is stored whole, with W_H4DIFF=False. The W_H4DREF card names the
+        HDU that a difference is relative to.
+        """
+        Codec.__init__(self, name, compression=compression)
+
+    isDifference = True
+
+    def encode(self, data, previous=None, previousName=None):
+        cards = self.cards()
+        if previous is None or previous.shape != data.shape:
+            cards.append(dict(name='W_H4DIFF', value=False, comment='read is stored whole'))
+            return data, cards
+
+        diff = data.astype('i4')
+        diff -= previous
+        cards.append(dict(name='W_H4DIFF', value=True, comment='read is stored as difference from W_H4DREF'))
+        cards.append(dict(name='W_H4DREF', value=previousName, comment='HDU this read is relative to'))
+        cards.append(dict(name='W_H4DDTY', value=np.dtype(data.dtype).str, comment='dtype of the original read'))
+        return diff, cards
+
+    def decode(self, stored, hdr, previous=None):
+        return undoDifference(stored, hdr, previous)
+
+def undoDifference(stored, hdr, previous=None):
+    """Rebuild a read from a possibly difference-encoded HDU.
+
+    Parameters
+    ----------
+    stored : `np.ndarray`
+      The array as read from the file.
+    hdr : dict-like
+      The HDU header.
+    previous : `np.ndarray`
+      The decoded read named by the W_H4DREF card. Only needed if the HDU is a difference.
+    """
+
+    if not hdr.get('W_H4DIFF', False):
+        return stored
+    if previous is None:
+        raise ValueError(f'HDU is relative to {hdr.get("W_H4DREF")}, which was not provided')
+
+    data = previous.astype('i4')
+    data += stored
+    return data.astype(hdr.get('W_H4DDTY', '<u2'))
+
+def isConstantPlane(data):
+    """Return whether all the pixels of an array have the same value.
+
+    A sparse sample is checked first, so that real reads are rejected cheaply.
+    """
+
+    if data.size == 0:
+        return False
+    first = data.flat[0]
+    if not (data[..., ::97] == first).all():
+        return False
+    return bool((data == first).all())
+
+def constantCards(value, shape, dtype):
+    """Return the cards describing a constant plane stored as a header-only HDU. """
+
+    ny, nx = shape
+    return [dict(name='CONSTVAL', value=value.item() if hasattr(value, 'item') else value,
+                 comment='value of all pixels in this plane'),
+            dict(name='CONSTNX', value=int(nx), comment='width of the constant plane'),
+            dict(name='CONSTNY', value=int(ny), comment='height of the constant plane'),
+            dict(name='CONSTDTY', value=np.dtype(dtype).str, comment='dtype of the constant plane')]
+
+def expandConstant(hdr):
+    """Return the plane described by the CONSTxxx cards of a header-only HDU, or None. """
+
+    if 'CONSTVAL' not in hdr:
+        return None
+    return np.full((hdr['CONSTNY'], hdr['CONSTNX']), hdr['CONSTVAL'],
+                   dtype=hdr.get('CONSTDTY', '<u2'))
+
+def getCodec(spec):
+    """Return a codec from its spec string, e.g. 'rice' or 'diff:gzip_2'. """
+
+    spec = spec.strip().lower()
+    if spec == 'diff':
+        spec = 'diff:none'
+
+    if spec.startswith('diff:'):
+        codecClass = DifferenceCodec
+        compressionName = spec[5:]
+    else:
+        codecClass = Codec
+        compressionName = spec
+
+    try:
+        compression = tileCompressions[compressionName]
+    except KeyError:
+        raise ValueError(f'unknown codec {spec!r}; known compressions: {list(tileCompressions.keys())}')
+
+    return codecClass(spec, compression=compression)
+
+def allCodecSpecs():
+    """Return the specs of all the codecs we know of, plain then difference ones. """
+
+    plain = list(tileCompressions.keys())
+    return plain + [f'diff:{c}' for c in plain]
+
+def codecsFromConfig(codecConfig=None, doCompress=True):
+    """Build the per-HDU type codec dictionary from the site configuration.
+
+    Parameters
+    ----------
+    codecConfig : `str` or `dict` or None
+      Either a single codec spec for all HDU types, or a dictionary of specs keyed by
+      HDU type (IMAGE, REF, RESET). Missing types use the default.
+    doCompress : `bool`
+      The older boolean configuration: the default is 'rice' if True, else 'none'.
+
+    Returns
+    -------
+    codecs : `dict`
+      `Codec` for each of IMAGE, REF, RESET
+    """
+
+    default = 'rice' if doCompress else 'none'
+    if codecConfig is None:
+        codecConfig = dict()
+    elif isinstance(codecConfig, str):
+        codecConfig = {t:codecConfig for t in hduTypes}
+
+    codecs = dict()
+    for t in hduTypes:
+        codecs[t] = getCodec(codecConfig.get(t, default))
+    return codecs
@@ -0,0 +1,141 @@
+"""Convert ramp files between the 'hdus' and 'cube' layouts.
+
+See `hxActor.rampFits.rampWriter` for the two layouts. The conversion is
+lossless for the pixels and for the per-read cards. Converting to 'hdus' can
+apply any codecs; converting to 'cube' always stores plain pixels.
+
+Usage:
+  python -m hxActor.rampFits.rampLayout [--codecs SPEC] inRamp.fits outRamp.fits
+"""
+
+import argparse
+import logging
+import os
+import re
+
+import fitsio
+
+from hxActor.rampFits import rampCodecs
+from hxActor.rampFits import rampWriter
+
+# READS table columns which are not per-read cards.
+readsTableColumns = {'EXTNAME', 'TIME', 'MEDIAN', 'STDDEV', 'MINVAL', 'MAXVAL'}
+
+# Cards which describe the HDU structure, and which the writer regenerates.
+structuralCards = re.compile(r'^(SIMPLE|EXTEND|XTENSION|BITPIX|NAXIS\d*|PCOUNT|GCOUNT|BZERO|BSCALE|EXTNAME|'
+                             r'TFIELDS|T(TYPE|FORM|DIM|UNIT)\d+|Z[A-Z]+\d*|CHECKSUM|DATASUM)$')
+
+def headerCards(hdr):
+    """Return the non-structural cards of a fitsio header as a list of dicts. """
+
+    return [dict(name=r['name'], value=r['value'], comment=r.get('comment', ''))
+            for r in hdr.records()
+            if r['name'] and r['name'] not in {'COMMENT', 'HISTORY'} and not structuralCards.match(r['name'])]
+
+def cellValue(value):
+    """Return a plain python value from a table cell: fitsio returns bytes or str for strings. """
+
+    if isinstance(value, bytes):
+        value = value.decode('latin-1')
+    if isinstance(value, str):
+        return value.strip()
+    return value.item()
+
+def iterHdus(ff):
+    """Yield (extname, header, data) for the read HDUs of an 'hdus' layout file, fully decoded. """
+
+    decoded = dict()
+    for hdu in ff[1:]:
+        extname = hdu.get_extname()
+        if not rampCodecs.isReadHdu(extname):
+            continue
+        hdr = hdu.read_header()
+        data = rampCodecs.expandConstant(hdr)
+        if data is None:
+            data = rampCodecs.undoDifference(hdu.read(), hdr, decoded.get(hdr.get('W_H4DREF')))
+        decoded[extname] = data
+        yield extname, hdr, data
+
+def fileLayout(ff):
+    return rampWriter.layoutFromHeader(ff[0].read_header())
+
+def hdusToCube(inPath, outPath, logger=None):
+    """Convert an 'hdus' layout ramp file to the 'cube' layout. """
+
+    with fitsio.FITS(inPath) as ff:
+        phdr = ff[0].read_header()
+        hdus = list(iterHdus(ff))
+
+    images = [(n, h, d) for n, h, d in hdus if n.startswith('IMAGE_')]
+    refs = [(n, h, d) for n, h, d in hdus if n.startswith('REF_')]
+    if not images:
+        raise ValueError(f'{inPath} has no IMAGE HDUs')
+
+    plan = dict(nread=len(images),
+                nreset=len([n for n, h, d in hdus if n.startswith('RESET_IMAGE_')]),
+                dataShape=images[0][2].shape,
+                refShape=refs[0][2].shape if refs else None,
+                irp=any('CONSTVAL' not in h for n, h, d in refs),
+                dtype=images[0][2].dtype.str)
+
+    outDir = os.path.dirname(os.path.abspath(outPath))
+    out = rampWriter.CubeRampFile(outPath, headerCards(phdr), rampCodecs.codecsFromConfig('none'),
+                                  plan=plan, rampRoot=outDir, logger=logger)
+    for extname, hdr, data in hdus:
+        cards = [c for c in headerCards(hdr) if not c['name'].startswith(('CONST', 'W_H4D', 'W_H4CODC'))]
+        out.addHdu(data, cards, extname)
+    out.close()
+
+def cubeToHdus(inPath, outPath, codecs=None, logger=None):
+    """Convert a 'cube' layout ramp file to the 'hdus' layout, optionally with codecs. """
+
+    if codecs is None:
+        codecs = rampCodecs.codecsFromConfig('none')
+
+    with fitsio.FITS(inPath) as ff:
+        phdr = ff[0].read_header()
+        pcards = [c for c in headerCards(phdr) if c['name'] != 'W_4LAYOU']
+
+        rows = ff['READS'].read() if 'READS' in ff else []
+
+        outDir = os.path.dirname(os.path.abspath(outPath))
+        out = rampWriter.RampFile(outPath, pcards, codecs, rampRoot=outDir, logger=logger)
+        for row in rows:
+            extname = cellValue(row['EXTNAME'])
+            cubeName, plane = rampWriter.cubePlane(extname)
+            cards = []
+            for name in row.dtype.names:
+                if name in readsTableColumns:
+                    continue
+                cards.append(dict(name=name, value=cellValue(row[name])))
+
+            refName = extname.replace('IMAGE', 'REF')
+            refCube = 'REF' if cubeName == 'DATA' else 'RESETREF'
+            out.addHdu(ff[cubeName][plane:plane+1, :, :][0], cards, extname)
+            if refCube in ff:
+                refHdr = ff[refCube].read_header()
+                refPlane = rampCodecs.expandConstant(refHdr)
+                if refPlane is None:
+                    refPlane = ff[refCube][plane:plane+1, :, :][0]
+                out.addHdu(refPlane, None, refName)
+        out.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='convert ramp files between the hdus and cube layouts')
+    parser.add_argument('inPath', help='the existing ramp file')
+    parser.add_argument('outPath', help='the converted ramp file')
+    parser.add_argument('--codecs', default='none',
+                        help='the codec spec to use when converting to the hdus layout')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    with fitsio.FITS(args.inPath) as ff:
+        layout = fileLayout(ff)
+
+    if layout == 'cube':
+        cubeToHdus(args.inPath, args.outPath, codecs=rampCodecs.codecsFromConfig(args.codecs))
+    else:
+        hdusToCube(args.inPath, args.outPath)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""Move finished ramp files from a fast local staging directory to their final paths.
+
+When the final (butler) directory is on a network or RAID volume, writing
+ramps straight there puts that volume's stalls into the readout. Instead, the
+writer can write to a local staging directory, and `RampMigrator` copies each
+closed file to its final path in the background:
+
+ - the copy is rate-limited, so that it does not compete with the next ramp.
+ - the copy is made to a hidden temporary name, fsync'ed, then re-read and
+   compared against the CRC-32 of the staged file before being renamed into
+   place. Only then is the staged file removed.
+ - the queue of pending migrations is kept in a JSON file in the staging
+   directory, rewritten atomically on every change, so that files queued
+   before an actor restart are still migrated after it.
+ - each ramp is put in the queue, as not yet closed, before it is written
+   (`expect`), and is marked ready when it is closed (`enqueue`). On start-up
+   the staging directory is scanned, and any file which was closed but never
+   marked ready is migrated too.
+
+Files which fail to migrate stay in the queue, and are retried.
+"""
+
+import json
+import logging
+import os
+import pathlib
+import shutil
+import threading
+import time
+import zlib
+
+class RampMigrator(threading.Thread):
+    def __init__(self, stagingRoot, maxRate=None, chunkSize=8*1024*1024,
+                 retryDelay=60.0, statusCB=None, migratedCB=None, logLevel=logging.INFO):
+        """The thread which migrates staged ramp files to their final paths.
+
+        Parameters
+        ----------
+        stagingRoot : `str`
+          The local directory which ramps are written to.
+        maxRate : `float`
+          If set, the maximum copy rate, in MB/s.
+        chunkSize : `int`
+          How many bytes to copy at a time.
+        retryDelay : `float`
+          How long to wait before retrying a failed migration.
+        statusCB : callable
+          If set, called with `status()` whenever the queue changes.
+        migratedCB : callable
+          If set, called as migratedCB(stagedPath, finalPath) after each file is migrated.
+        """
+        super().__init__(name='rampMigrator', daemon=True)
+
+        self.logger = logging.getLogger('rampMigrator')
+        self.logger.setLevel(logLevel)
+
+        self.stagingRoot = pathlib.Path(stagingRoot)
+        self.stagingRoot.mkdir(parents=True, exist_ok=True)
+        self.queuePath = self.stagingRoot / 'migrationQueue.json'
+
+        self.maxRate = maxRate
+        self.chunkSize = chunkSize
+        self.retryDelay = retryDelay
+        self.statusCB = statusCB
+        self.migratedCB = migratedCB
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.queue = self._loadQueue()
+        self.lastError = None
+        self.lastRate = 0.0
+        self.exiting = False
+
+    def _loadQueue(self):
+        try:
+            with open(self.queuePath, 'rt') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            self.logger.warning(f'could not load migration queue {self.queuePath}, starting empty: {e}')
+            return []
+
+        # Drop anything whose staged file has gone. Keep anything else.
+        kept = [e for e in entries if os.path.exists(e['staged'])]
+        if len(kept) != len(entries):
+            self.logger.warning(f'dropping {len(entries) - len(kept)} migrations whose staged files are gone')
+        if kept:
+            self.logger.info(f'resuming {len(kept)} migrations from {self.queuePath}')
+        return self._scanStaging(kept)
+
+    def _scanStaging(self, entries):
+        """Ready the files which were closed in staging but never enqueued.
+
+        A ramp file only appears under its staged name once the writer has
+        closed it, so an expected entry whose staged file exists was closed
+        before a restart lost its `enqueue`. Staged files with no entry at all
+        have no known final path, and are left where they are.
+        """
+
+        known = {e['staged'] for e in entries}
+        for e in entries:
+            if not e.get('closed', True):
+                self.logger.warning(f'{e["staged"]} was closed but never queued: migrating it to {e["final"]}')
+                e['closed'] = True
+                e['size'] = os.path.getsize(e['staged'])
+                e['queued'] = time.time()
+
+        for path in sorted(self.stagingRoot.iterdir()):
+            if (path.name.startswith('.') or path in {self.queuePath, self.queuePath.with_suffix('.tmp')}
+                    or not path.is_file()):
+                continue
+            if str(path) not in known:
+                self.logger.warning(f'{path} is staged but has no migration entry: leaving it in place')
+        return entries
+
+    def _saveQueue(self):
+        """Atomically replace the persistent queue. Must be called with the lock held. """
+
+        tmpPath = self.queuePath.with_suffix('.tmp')
+        with open(tmpPath, 'wt') as f:
+            json.dump(self.queue, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpPath, self.queuePath)
+
+    def stagedPath(self, finalPath):
+        """Return where a ramp with the given final path should be written. """
+
+        return self.stagingRoot / pathlib.Path(finalPath).name
+
+    def expect(self, stagedPath, finalPath):
+        """Record the final path of a staged file which is about to be written.
+
+        The entry is not migrated until `enqueue` is called, or the file is
+        found closed when the migrator next starts.
+        """
+
+        entry = dict(staged=str(stagedPath), final=str(finalPath),
+                     size=0, queued=time.time(), tries=0, closed=False)
+        with self.lock:
+            self.queue = [e for e in self.queue if e['staged'] != entry['staged']]
+            self.queue.append(entry)
+            self._saveQueue()
+
+    def enqueue(self, stagedPath, finalPath):
+        """Queue a closed staged file for migration. """
+
+        entry = dict(staged=str(stagedPath), final=str(finalPath),
+                     size=os.path.getsize(stagedPath), queued=time.time(), tries=0, closed=True)
+        with self.lock:
+            self.queue = [e for e in self.queue if e['staged'] != entry['staged']]
+            self.queue.append(entry)
+            self._saveQueue()
+        self.logger.info(f'queued {stagedPath} -> {finalPath}')
+        self._reportStatus()
+        self.wakeup.set()
+
+    def status(self):
+        """Return a summary of the migration backlog. """
+
+        with self.lock:
+            closed = [e for e in self.queue if e.get('closed', True)]
+            nQueued = len(closed)
+            backlog = sum(e['size'] for e in closed)
+            oldest = min((e['queued'] for e in closed), default=None)
+        return dict(nQueued=nQueued,
+                    backlogMB=backlog / 1e6,
+                    oldestAge=0.0 if oldest is None else time.time() - oldest,
+                    lastRate=self.lastRate,
+                    lastError=self.lastError)
+
+    def _reportStatus(self):
+        if self.statusCB is None:
+            return
+        try:
+            self.statusCB(self.status())
+        except Exception as e:
+            self.logger.warning(f'migration status callback failed: {e}')
+
+    def exit(self):
+        self.exiting = True
+        self.wakeup.set()
+
+    def run(self):
+        while not self.exiting:
+            with self.lock:
+                now = time.time()
+                ready = [e for e in self.queue if e.get('closed', True) and e.get('retryAt', 0) <= now]
+            if not ready:
+                self.wakeup.wait(timeout=self.retryDelay)
+                self.wakeup.clear()
+                continue
+
+            entry = ready[0]
+            try:
+                self.migrate(entry['staged'], entry['final'])
+            except Exception as e:
+                self.lastError = f'{entry["staged"]}: {e}'
+                self.logger.warning(f'failed to migrate {entry["staged"]} to {entry["final"]}: {e}')
+                with self.lock:
+                    entry['tries'] += 1
+                    entry['retryAt'] = time.time() + self.retryDelay
+                    self._saveQueue()
+            else:
+                self.lastError = None
+                with self.lock:
+                    self.queue.remove(entry)
+                    self._saveQueue()
+                if self.migratedCB is not None:
+                    try:
+                        self.migratedCB(entry['staged'], entry['final'])
+                    except Exception as e:
+                        self.logger.warning(f'migrated file callback failed: {e}')
+            self._reportStatus()
+
+    def _throttle(self, nbytes, t0):
+        """Sleep long enough to keep the copy under maxRate. """
+
+        if not self.maxRate:
+            return
+        ahead = nbytes / (self.maxRate * 1e6) - (time.time() - t0)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def migrate(self, stagedPath, finalPath):
+        """Copy one file to its final path, verify the copy, and remove the staged file. """
+
+        stagedPath = pathlib.Path(stagedPath)
+        finalPath = pathlib.Path(finalPath)
+        tmpPath = finalPath.parent / f'.{finalPath.name}.migrating'
+        finalPath.parent.mkdir(parents=True, exist_ok=True)
+
+        t0 = time.time()
+        nbytes = 0
+        crc = 0
+        with open(stagedPath, 'rb') as inFile, open(tmpPath, 'wb') as outFile:
+            while True:
+                buf = inFile.read(self.chunkSize)
+                if not buf:
+                    break
+                crc = zlib.crc32(buf, crc)
+                outFile.write(buf)
+                nbytes += len(buf)
+                self._throttle(nbytes, t0)
+            outFile.flush()
+            os.fsync(outFile.fileno())
+            # Make the verification read come from the disk, not the page cache.
+            os.posix_fadvise(outFile.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+        copyCrc = 0
+        with open(tmpPath, 'rb') as f:
+            while True:
+                buf = f.read(self.chunkSize)
+                if not buf:
+                    break
+                copyCrc = zlib.crc32(buf, copyCrc)
+        if copyCrc != crc:
+            os.unlink(tmpPath)
+            raise IOError(f'checksum mismatch copying {stagedPath}: {copyCrc:#010x} vs {crc:#010x}')
+
+        shutil.copystat(stagedPath, tmpPath)
+        os.rename(tmpPath, finalPath)
+        dirFd = os.open(finalPath.parent, os.O_RDONLY)
+        try:
+            os.fsync(dirFd)
+        finally:
+            os.close(dirFd)
+        os.unlink(stagedPath)
+
+        dt = time.time() - t0
+        self.lastRate = nbytes / 1e6 / dt if dt > 0 else 0.0
+        self.logger.info(f'migrated {stagedPath} to {finalPath}: {nbytes} bytes at {self.lastRate:0.1f} MB/s')
@@ -0,0 +1,256 @@
+"""Random access to the reads of a ramp file, without walking its HDUs.
+
+The writer ends every ramp file with an HDUINDEX table giving the offsets and
+encoding of each HDU, and puts the table's offset in the PHDU W_IDXOFF card
+(see `hxActor.rampFits.rampWriter`). With that, the file is memory-mapped and
+any read, or any band of rows across all the reads, is a view at a known
+offset: only the pages actually used are read from disk, and no other header
+is parsed.
+
+Files without an index are indexed by scanning their headers only. Planes
+which cannot be mapped directly (tile-compressed or difference-coded HDUs)
+fall back to being decoded through fitsio.
+
+  rr = RampReader('PFJA00012301.fits')
+  read3 = rr.read(3)
+  band = rr.rows(1000, 1100)
+"""
+
+import mmap
+import os
+
+import fitsio
+import numpy as np
+
+import astropy.io.fits as pyfits
+
+from hxActor.rampFits import fitsBlocks
+from hxActor.rampFits import rampCodecs
+from hxActor.rampFits import rampWriter
+
+# Big-endian storage types for each BITPIX.
+bitpixTypes = {8: '>u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+def parseHeader(buf, offset):
+    """Parse the header starting at offset in buf.
+
+    Returns
+    -------
+    cards : `dict`
+      The keyword values.
+    dataStart : `int`
+      The offset just past the END card block.
+    """
+
+    cards = dict()
+    pos = offset
+    while pos < len(buf):
+        block = bytes(buf[pos:pos+fitsBlocks.BLOCK])
+        pos += fitsBlocks.BLOCK
+        for i in range(0, len(block), fitsBlocks.CARD):
+            image = block[i:i+fitsBlocks.CARD].decode('ascii')
+            name = image[:8].strip()
+            if name == 'END':
+                return cards, pos
+            if image[8:10] == '= ':
+                cards[name] = pyfits.Card.fromstring(image).value
+    raise ValueError(f'no END card in header at {offset}')
+
+def dataSize(cards):
+    """Return the padded size of an HDU's data from its header. """
+
+    naxis = cards.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    nelem = 1
+    for i in range(naxis):
+        nelem *= cards[f'NAXIS{i+1}']
+    nbytes = abs(cards['BITPIX']) // 8 * cards.get('GCOUNT', 1) * (nelem + cards.get('PCOUNT', 0))
+    return fitsBlocks.paddedSize(nbytes)
+
+def scanIndex(buf):
+    """Build the HDUINDEX rows of a file without one, by reading only its headers. """
+
+    rows = []
+    offset = 0
+    while offset < len(buf):
+        cards, dataStart = parseHeader(buf, offset)
+        dataEnd = dataStart + dataSize(cards)
+        if offset > 0:
+            if cards.get('ZIMAGE', False):
+                codec, shape = 'compressed', tuple(cards[f'ZNAXIS{i}'] for i in range(cards['ZNAXIS'], 0, -1))
+            elif 'CONSTVAL' in cards:
+                codec = 'const'
+                shape = (cards['CONSTNY'], cards['CONSTNX'])
+                if 'CONSTNZ' in cards:
+                    shape = (cards['CONSTNZ'], *shape)
+            else:
+                codec = 'diff' if cards.get('W_H4DIFF', False) else 'none'
+                shape = tuple(cards[f'NAXIS{i}'] for i in range(cards.get('NAXIS', 0), 0, -1))
+            if cards.get('XTENSION') == 'BINTABLE' and codec != 'compressed':
+                codec, shape = 'table', ()
+            bitpix, bzero = cards.get('BITPIX', 0), cards.get('BZERO', 0)
+            if codec == 'const':
+                bitpix, bzero = fitsBlocks.imageTypes[np.dtype(cards.get('CONSTDTY', '<u2')).newbyteorder('=')]
+            naxes = list(reversed(shape)) + [0, 0, 0]
+            rows.append((cards.get('EXTNAME', ''), offset, dataStart, dataEnd,
+                         naxes[0], naxes[1], naxes[2], bitpix, bzero or 0,
+                         codec, cards.get('W_H4DREF', ''), cards.get('CONSTVAL', np.nan)))
+        offset = dataEnd
+
+    return np.array(rows, dtype=rampWriter.indexDtype)
+
+class RampReader(object):
+    def __init__(self, path):
+        """Memory-map a ramp file and load its HDU index.
+
+        Parameters
+        ----------
+        path : `str`
+          The ramp file.
+        """
+
+        self.path = str(path)
+        self.fd = os.open(self.path, os.O_RDONLY)
+        self.mm = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        self.fits = None
+        self.decoded = dict()
+
+        self.phdr, _ = parseHeader(self.mm, 0)
+        self.layout = rampWriter.layoutFromHeader(self.phdr)
+
+        indexOffset = self.phdr.get('W_IDXOFF')
+        if indexOffset is not None:
+            cards, dataStart = parseHeader(self.mm, indexOffset)
+            table = np.frombuffer(self.mm, dtype=rampWriter.indexDtype.newbyteorder('>'),
+                                  count=cards['NAXIS2'], offset=dataStart)
+        else:
+            table = scanIndex(self.mm)
+
+        self.index = dict()
+        for row in table:
+            entry = {name: row[name].item() for name in rampWriter.indexDtype.names}
+            for name in 'EXTNAME', 'CODEC', 'DIFFREF':
+                if isinstance(entry[name], bytes):
+                    entry[name] = entry[name].decode('latin-1')
+                entry[name] = entry[name].strip()
+            self.index[entry['EXTNAME']] = entry
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.fits is not None:
+            self.fits.close()
+            self.fits = None
+        self.decoded = dict()
+        self.mm.close()
+        os.close(self.fd)
+
+    @property
+    def nreads(self):
+        if self.layout == 'cube':
+            return self.index['DATA']['NAXIS3'] if 'DATA' in self.index else 0
+        return len([e for e in self.index if e.startswith('IMAGE_')])
+
+    def extname(self, n, ref=False, reset=False):
+        return f'{"RESET_" if reset else ""}{"REF" if ref else "IMAGE"}_{n}'
+
+    def _shape(self, entry):
+        shape = (entry['NAXIS3'], entry['NAXIS2'], entry['NAXIS1'])
+        return shape if shape[0] else shape[1:]
+
+    def _rawView(self, entry):
+        """Return the stored pixels of an uncompressed HDU as a big-endian view into the map. """
+
+        return np.ndarray(self._shape(entry), dtype=bitpixTypes[entry['BITPIX']],
+                          buffer=self.mm, offset=entry['DATASTART'])
+
+    def _physical(self, stored, entry):
+        """Convert (a slice of) a stored view to native pixel values. """
+
+        bzero = entry['BZERO']
+        if bzero:
+            unsigned = stored.dtype.str.replace('i', 'u')
+            return np.bitwise_xor(stored.view(unsigned), np.array(bzero, dtype=unsigned)).astype(unsigned[1:])
+        return stored.astype(stored.dtype.newbyteorder('='))
+
+    def _decodeFallback(self, extname):
+        """Read a plane which cannot be mapped directly, through fitsio and the codecs. """
+
+        if extname in self.decoded:
+            return self.decoded[extname]
+
+        if self.fits is None:
+            self.fits = fitsio.FITS(self.path)
+
+        entry = self.index[extname]
+        hdr = self.fits[extname].read_header()
+        stored = self.fits[extname].read()
+        previous = self.readPlane(entry['DIFFREF']) if entry['DIFFREF'] else None
+        data = rampCodecs.undoDifference(stored, hdr, previous)
+
+        # Keep only the latest, which is all that a read-by-read walk down a difference chain needs.
+        self.decoded = {extname: data}
+        return data
+
+    def readPlane(self, extname):
+        """Return the full decoded plane of an 'hdus' layout HDU, or a whole cube. """
+
+        entry = self.index[extname]
+        if entry['CODEC'] == 'const':
+            dtype = np.dtype(bitpixTypes[entry['BITPIX']]).newbyteorder('=')
+            if entry['BZERO']:
+                dtype = np.dtype(dtype.str.replace('i', 'u'))
+            return np.full(self._shape(entry), entry['CONSTVAL'], dtype=dtype)
+        if entry['CODEC'] != 'none':
+            return self._decodeFallback(extname)
+        return self._physical(self._rawView(entry), entry)
+
+    def read(self, n, ref=False, reset=False):
+        """Return read n (1-based) of the ramp.
+
+        Parameters
+        ----------
+        n : `int`
+          The read number, as in the IMAGE_n extension names.
+        ref : `bool`
+          Return the reference (IRP) plane instead of the image.
+        reset : `bool`
+          Return the reset read instead of the data read.
+        """
+
+        extname = self.extname(n, ref=ref, reset=reset)
+        if self.layout != 'cube':
+            return self.readPlane(extname)
+
+        cubeName, plane = rampWriter.cubePlane(extname)
+        entry = self.index[cubeName]
+        if entry['CODEC'] == 'const':
+            return self.readPlane(cubeName)[plane]
+        return self._physical(self._rawView(entry)[plane], entry)
+
+    def rows(self, y0, y1, ref=False, reset=False):
+        """Return rows y0:y1 of every read, as an (nread, y1-y0, ncols) array. """
+
+        if self.layout == 'cube':
+            cubeName, _ = rampWriter.cubePlane(self.extname(1, ref=ref, reset=reset))
+            entry = self.index[cubeName]
+            if entry['CODEC'] == 'const':
+                return self.readPlane(cubeName)[:, y0:y1]
+            return self._physical(self._rawView(entry)[:, y0:y1], entry)
+
+        planes = []
+        n = 1
+        while self.extname(n, ref=ref, reset=reset) in self.index:
+            extname = self.extname(n, ref=ref, reset=reset)
+            entry = self.index[extname]
+            if entry['CODEC'] == 'none':
+                planes.append(self._physical(self._rawView(entry)[y0:y1], entry))
+            else:
+                planes.append(self.readPlane(extname)[y0:y1])
+            n += 1
+        return np.stack(planes) if planes else None
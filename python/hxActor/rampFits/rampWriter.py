@@ -0,0 +1,832 @@
+"""Persistent ramp FITS writer.
+
+The DAQ thread must never wait on the disk or on compression, so all FITS
+writing is done in a separate, long-lived process. The actor side
+(`RampBuffer`) queues requests to that process (`RampWriter`), and relays the
+replies back to the per-ramp reporter (see `hxActor.Commands.ramp.Ramp`).
+
+Each HDU is stored with the codec configured for its type (IMAGE, REF, RESET):
+see `hxActor.rampFits.rampCodecs`. Constant planes are stored as header-only HDUs,
+whether they are declared as such (`RampBuffer.addConstantHdu`) or detected.
+
+There are two file layouts:
+ - 'hdus': the original layout, with IMAGE_n and REF_n (and RESET_IMAGE_n,
+   RESET_REF_n) HDUs for each read.
+ - 'cube': preallocated 3-D DATA and REF (and RESET, RESETREF) cubes, with
+   each read written straight into its plane, plus a READS binary table of
+   the per-read cards and statistics. Cube files are never compressed, and
+   are identified by W_4LAYOU='CUBE' in their PHDU.
+
+`hxActor.rampFits.rampLayout` converts between the two.
+
+Uncompressed 'hdus' layout files with a ramp plan are written by
+`RawRampFile`, which preallocates the in-progress file and writes each HDU at
+its offset, instead of letting cfitsio grow the file.
+
+In all cases we write the primary header ourselves, with enough blank cards
+reserved for all the cards which will be patched at the end of the ramp. PHDU
+amendments are then always in-place overwrites of the header blocks: no data
+ever moves, and an amendment which does not fit is refused.
+
+Every HDU gets FITS DATASUM and CHECKSUM cards, computed from the data as it
+is written rather than by reading the file back. For HDUs written by cfitsio,
+the CHECKSUM values are filled into the headers when the file is closed. Only
+tile-compressed HDUs, whose bytes we never see, are checksummed by cfitsio, just
+after they are written.
+
+When a file is closed, a final HDUINDEX binary table is appended, with the
+byte offsets, shape, and encoding of every HDU, and its own offset is put in
+the PHDU W_IDXOFF card. `hxActor.rampFits.rampReader` uses it to go straight to
+any read.
+"""
+
+import logging
+import multiprocessing
+import os
+import pathlib
+import queue
+import threading
+import time
+
+import fitsio
+import numpy as np
+
+from hxActor.rampFits import fitsBlocks
+from hxActor.rampFits import rampCodecs
+
+# PHDU cards the writer itself adds when closing a file, which need reserved space.
+writerPhduCards = ('W_IDXOFF',)
+
+# PHDU cards whose final values are returned with the closedFits reply, for the ramp catalogue.
+summaryCards = ('DATA-TYP', 'DATE-OBS', 'EXPTIME', 'W_4FMTVR', 'W_H4FRMT', 'W_H4IRP', 'W_H4IRPN',
+                'W_H4IRPO', 'W_H4NRED', 'W_H4PTCH')
+
+# The rows of the HDUINDEX table. CODEC is 'none' for plain pixels, 'const' for
+# header-only constant planes (see CONSTVAL), else the codec which must be undone,
+# in which case DIFFREF names the HDU a difference is relative to.
+indexDtype = np.dtype([('EXTNAME', 'S16'),
+                       ('HDRSTART', 'i8'), ('DATASTART', 'i8'), ('DATAEND', 'i8'),
+                       ('NAXIS1', 'i4'), ('NAXIS2', 'i4'), ('NAXIS3', 'i4'),
+                       ('BITPIX', 'i4'), ('BZERO', 'i8'),
+                       ('CODEC', 'S16'), ('DIFFREF', 'S16'), ('CONSTVAL', 'f8')])
+
+def pwriteAll(fd, buf, offset):
+    """Write all of buf at offset, and return the offset just past it. """
+
+    view = memoryview(buf)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+    return offset
+
+def layoutFromHeader(phdr):
+    """Return the file layout named by a PHDU's W_4LAYOU card: 'hdus' if it has none. """
+
+    layout = phdr.get('W_4LAYOU', 'HDUS')
+    return 'cube' if str(layout).strip().upper() == 'CUBE' else 'hdus'
+
+def cubePlane(extname):
+    """Return the cube name and 0-based plane index for an 'hdus' layout extension name.
+
+    e.g. IMAGE_3 -> (DATA, 2), RESET_REF_1 -> (RESETREF, 0)
+    """
+
+    stream, read = extname.rsplit('_', 1)
+    cubeName = dict(IMAGE='DATA', REF='REF', RESET_IMAGE='RESET', RESET_REF='RESETREF')[stream]
+    return cubeName, int(read) - 1
+
+def planeStats(data, step=8):
+    """Return cheap statistics for a read, from a sparse sample of its pixels. """
+
+    sample = data[::step, ::step]
+    return dict(MEDIAN=float(np.median(sample)),
+                STDDEV=float(np.std(sample)),
+                MINVAL=float(sample.min()),
+                MAXVAL=float(sample.max()))
+
+def constantStats(value):
+    return dict(MEDIAN=float(value), STDDEV=0.0, MINVAL=float(value), MAXVAL=float(value))
+
+def rowsToTable(rows):
+    """Turn a list of per-read card dictionaries into a numpy table.
+
+    Columns are the union of all the scalar cards. Missing values are
+    NaN, -1, False, or ''.
+    """
+
+    columns = dict()
+    for row in rows:
+        for name, value in row.items():
+            if isinstance(value, (bool, np.bool_)):
+                kind = '?'
+            elif isinstance(value, (int, np.integer)):
+                kind = 'i8'
+            elif isinstance(value, (float, np.floating)):
+                kind = 'f8'
+            elif isinstance(value, str):
+                kind = 'S'
+            else:
+                continue
+            oldKind, oldLen = columns.get(name, (kind, 1))
+            if oldKind != kind:
+                kind = 'f8' if {oldKind, kind} <= {'i8', 'f8', '?'} else 'S'
+            strLen = max(oldLen, len(str(value)))
+            columns[name] = (kind, strLen)
+
+    dtype = [(name, f'S{strLen}' if kind == 'S' else kind) for name, (kind, strLen) in columns.items()]
+    fill = dict(f8=np.nan, i8=-1)
+    table = np.zeros(len(rows), dtype=dtype)
+    for name, (kind, _) in columns.items():
+        if kind in fill:
+            table[name] = fill[kind]
+    for r_i, row in enumerate(rows):
+        for name in columns:
+            if name in row:
+                value = row[name]
+                table[name][r_i] = value.encode('latin-1') if isinstance(value, str) else value
+
+    return table
+
+class RampFile(object):
+    layout = 'hdus'
+
+    def __init__(self, path, phdr, codecs, plan=None, reserveCards=0, rampRoot=None, logger=None):
+        """A single ramp file, open in the writer process.
+
+        The file is written to a temporary name, and renamed to `path` when closed.
+
+        Parameters
+        ----------
+        path : `str`
+          The final pathname of the file.
+        phdr : list of card dicts
+          The primary header.
+        codecs : `dict`
+          The `rampCodecs.Codec` to use for each HDU type.
+        plan : `dict`
+          The expected shape of the ramp: see `RampBuffer.createFile`
+        reserveCards : `int`
+          How many cards to reserve in the PHDU for amendments.
+        rampRoot : `str`
+          If set, the directory to write the in-progress file to.
+        """
+
+        self.logger = logger if logger is not None else logging.getLogger('rampFile')
+        self.path = pathlib.Path(path)
+        self.codecs = codecs
+        self.plan = plan
+
+        tmpDir = pathlib.Path(rampRoot) if rampRoot is not None else self.path.parent
+        self.tmpPath = tmpDir / f'.{self.path.name}.inprogress'
+
+        # The last read in each stream, for the difference codecs.
+        self.previous = dict()
+
+        # For each HDU which we checksum, its [headerStart, dataStart, dataSum]
+        self.checksums = dict()
+        # The HDUINDEX rows.
+        self.index = []
+        # The ones' complement sum of all the data units.
+        self.dataSum = 0
+
+        # We own the PHDU: cfitsio only ever appends after it.
+        self.phdu = fitsBlocks.PrimaryHeader(phdr, reserveCards=reserveCards + len(writerPhduCards))
+        with open(self.tmpPath, 'wb') as f:
+            f.write(self.phdu.toBytes())
+        self.fd = os.open(self.tmpPath, os.O_RDWR)
+
+        # ignore_empty lets us write header-only extensions, for constant planes.
+        self.fits = fitsio.FITS(str(self.tmpPath), 'rw', ignore_empty=True)
+
+    def addHdu(self, data, hdr, extname):
+        """Encode and append one HDU. """
+
+        if rampCodecs.isConstantPlane(data):
+            self.addConstantHdu(data.flat[0], data.shape, data.dtype, hdr, extname)
+            return
+
+        codec = self.codecs[rampCodecs.hduType(extname)]
+        stream = rampCodecs.hduStream(extname)
+        previousName, previous = self.previous.get(stream, (None, None))
+
+        stored, codecCards = codec.encode(data, previous=previous, previousName=previousName)
+        cards = list(hdr) if hdr is not None else []
+        cards.extend(codecCards)
+
+        isDiff = any(c['name'] == 'W_H4DIFF' and c['value'] for c in codecCards)
+        indexCodec = codec.name if (codec.isCompressed or isDiff) else 'none'
+        if codec.isCompressed:
+            self.fits.write(stored, header=cards, extname=extname, **codec.writeArgs())
+            dataSum = None
+        else:
+            self.fits.write(stored, header=cards, extname=extname)
+            dataSum = fitsBlocks.onesSum(fitsBlocks.dataBytes(stored))
+        self.finishHdu(extname, dataSum, shape=stored.shape, dtype=stored.dtype,
+                       codec=indexCodec, diffRef=previousName if isDiff else '')
+        if codec.isDifference:
+            self.previous[stream] = (extname, data)
+
+    def addConstantHdu(self, value, shape, dtype, hdr, extname):
+        """Append a header-only HDU standing in for a plane of a single value. """
+
+        cards = list(hdr) if hdr is not None else []
+        cards.extend(rampCodecs.constantCards(value, shape, dtype))
+        self.fits.write(None, header=cards, extname=extname)
+        self.finishHdu(extname, 0, shape=shape, dtype=dtype, codec='const', constVal=value)
+
+        # Never difference against a plane we do not have.
+        self.previous.pop(rampCodecs.hduStream(extname), None)
+
+    def addTable(self, table, hdr, extname):
+        """Append a binary table HDU. """
+
+        cards = list(hdr) if hdr is not None else []
+        self.fits.write(table, header=cards, extname=extname)
+        self.finishHdu(extname, None)
+
+    def finishHdu(self, extname, dataSum, **indexInfo):
+        """Checksum and index the HDU which cfitsio has just written.
+
+        If we know the data sum, add placeholder checksum cards and remember where
+        the header is, so that we can fill them in at close. fitsio drops these cards
+        from the headers it is given, so they are added afterwards. Otherwise have
+        cfitsio checksum the HDU now.
+        """
+
+        hdu = self.fits[-1]
+        if dataSum is None:
+            sums = hdu.write_checksum()
+            self.dataSum = fitsBlocks.addSums(self.dataSum, sums['datasum'])
+        else:
+            hdu.write_keys(fitsBlocks.checksumCards(), clean=False)
+        offsets = hdu.get_offsets()
+        if dataSum is not None:
+            self.checksums[extname] = [offsets['header_start'], offsets['data_start'], dataSum]
+        self.addIndexRow(extname, offsets['header_start'], offsets['data_start'], offsets['data_end'],
+                         **indexInfo)
+
+    def addIndexRow(self, extname, headerStart, dataStart, dataEnd,
+                    shape=None, dtype=None, codec='none', diffRef='', constVal=None):
+        shape = tuple(shape) if shape is not None else ()
+        bitpix, bzero = 0, None
+        if dtype is not None:
+            bitpix, bzero = fitsBlocks.imageTypes[np.dtype(dtype).newbyteorder('=')]
+        naxes = list(reversed(shape)) + [0, 0, 0]
+        self.index.append((extname, headerStart, dataStart, dataEnd,
+                           naxes[0], naxes[1], naxes[2], bitpix, bzero or 0,
+                           codec, diffRef or '', np.nan if constVal is None else float(constVal)))
+
+    def writeIndex(self, offset):
+        """Write the HDUINDEX table at offset, point W_IDXOFF at it, and return the new end of file. """
+
+        table = np.array(self.index, dtype=indexDtype)
+        header, data = fitsBlocks.tableHduBytes(table, extname='HDUINDEX')
+        end = pwriteAll(self.fd, header, offset)
+        end = pwriteAll(self.fd, data, end)
+        self.amendPHDU([dict(name='W_IDXOFF', value=offset, comment='byte offset of the HDUINDEX table')])
+        self.index = []
+        return end
+
+    def writeChecksums(self):
+        """Fill in the DATASUM and CHECKSUM cards of the HDUs which cfitsio has finished writing. """
+
+        for headerStart, dataStart, dataSum in self.checksums.values():
+            header = bytearray(os.pread(self.fd, dataStart - headerStart, headerStart))
+            os.pwrite(self.fd, fitsBlocks.setChecksum(header, dataSum), headerStart)
+            self.dataSum = fitsBlocks.addSums(self.dataSum, dataSum)
+        self.checksums = dict()
+
+    def summary(self):
+        """Return what the catalogue wants to know about a closed file. """
+
+        phdr = {c['name']: c['value'] for c in self.phdu.cards if c['name'] in summaryCards}
+        return dict(size=os.path.getsize(self.path),
+                    dataSum=f'{self.dataSum:08x}',
+                    layout=self.layout,
+                    codecs={t: c.name for t, c in self.codecs.items()},
+                    plan=self.plan,
+                    phdr=phdr)
+
+    def amendPHDU(self, cards):
+        """Update or add PHDU cards, overwriting the reserved header in place. """
+
+        os.pwrite(self.fd, self.phdu.amend(cards), 0)
+
+    def close(self):
+        self.fits.close()
+        self.writeChecksums()
+        self.writeIndex(os.fstat(self.fd).st_size)
+        os.close(self.fd)
+        self.previous = dict()
+        os.rename(self.tmpPath, self.path)
+
+class CubeRampFile(RampFile):
+    layout = 'cube'
+
+    def __init__(self, path, phdr, codecs, plan=None, reserveCards=0, rampRoot=None, logger=None):
+        """A ramp file with all reads in preallocated cubes.
+
+        The plan is required, and the cubes are created immediately:
+          RESET, RESETREF : (nreset, rows, cols), if nreset > 0
+          DATA, REF : (nread, rows, cols)
+        Without IRP the REF cubes are header-only constant HDUs, with CONSTNZ planes.
+        A read which does not fit its cube's planes is refused.
+        """
+
+        if plan is None:
+            raise ValueError('the cube layout needs a ramp plan')
+
+        phdr = fitsBlocks.updateCards(phdr,
+                                      [dict(name='W_4LAYOU', value='CUBE', comment='all reads are in DATA/REF cubes')])
+        RampFile.__init__(self, path, phdr, codecs, plan=plan, reserveCards=reserveCards,
+                          rampRoot=rampRoot, logger=logger)
+
+        if any(c.isCompressed or c.isDifference for c in codecs.values()):
+            self.logger.warning(f'cube layout ignores codecs ({codecs}): all planes are stored plain')
+
+        self.dtype = np.dtype(plan.get('dtype', 'u2'))
+        # cfitsio fills new cubes with raw zeros, which is BZERO for the unsigned types.
+        self.initialValue = fitsBlocks.imageTypes[self.dtype.newbyteorder('=')][1] or 0
+        self.rows = []
+        self.constantCubes = dict()
+        # The (nplanes, rows, cols) of each cube.
+        self.cubeShapes = dict()
+
+        nreset = plan.get('nreset', 0)
+        nread = plan['nread']
+        irp = plan.get('irp', True)
+        dataShape = tuple(plan['dataShape'])
+        refShape = plan.get('refShape')
+        refShape = tuple(refShape) if refShape is not None else None
+
+        self.createCube('RESET', nreset, dataShape)
+        self.createCube('RESETREF', nreset, refShape, isConstant=not irp)
+        self.createCube('DATA', nread, dataShape)
+        self.createCube('REF', nread, refShape, isConstant=not irp)
+
+    def createCube(self, extname, nplanes, shape, isConstant=False):
+        if nplanes == 0 or shape is None:
+            return
+        self.cubeShapes[extname] = (nplanes, *shape)
+
+        # Unwritten planes are raw zeros, which add nothing to the data sum.
+        if isConstant:
+            cards = rampCodecs.constantCards(0, shape, self.dtype)
+            cards.append(dict(name='CONSTNZ', value=nplanes, comment='number of constant planes'))
+            self.fits.write(None, header=cards, extname=extname)
+            self.constantCubes[extname] = 0
+            self.finishHdu(extname, 0, shape=(nplanes, *shape), dtype=self.dtype, codec='const', constVal=0)
+        else:
+            self.fits.create_image_hdu(dims=[nplanes, *shape], dtype=self.dtype, extname=extname)
+            self.finishHdu(extname, 0, shape=(nplanes, *shape), dtype=self.dtype)
+
+    def addToChecksum(self, cubeName, plane, planeData):
+        """Add a plane which has just been written to its cube's data sum. """
+
+        planeBytes = fitsBlocks.dataBytes(planeData)
+        total = self.checksums[cubeName][2]
+        self.checksums[cubeName][2] = fitsBlocks.onesSum(planeBytes, total, offset=plane*planeData.nbytes)
+
+    def checkPlane(self, extname, shape):
+        """Return the cube and plane for a read, if it has one of the right shape. """
+
+        cubeName, plane = cubePlane(extname)
+        if cubeName not in self.cubeShapes:
+            raise ValueError(f'{extname} has no {cubeName} cube in this ramp plan')
+        nplanes, *planeShape = self.cubeShapes[cubeName]
+        if plane >= nplanes:
+            raise ValueError(f'{extname} is beyond the {nplanes} planes of the {cubeName} cube')
+        if tuple(shape) != tuple(planeShape):
+            raise ValueError(f'{extname} has shape {tuple(shape)}, but the {cubeName} cube planes '
+                             f'are {tuple(planeShape)}')
+        return cubeName, plane
+
+    def addHdu(self, data, hdr, extname):
+        """Write a read into its plane, and save its cards and stats for the READS table. """
+
+        cubeName, plane = self.checkPlane(extname, data.shape)
+        if cubeName in self.constantCubes:
+            if not rampCodecs.isConstantPlane(data) or data.flat[0] != self.constantCubes[cubeName]:
+                raise ValueError(f'{extname} has data, but the {cubeName} cube is constant')
+        else:
+            planeData = data.astype(self.dtype, copy=False)
+            self.fits[cubeName].write(planeData[np.newaxis, ...], start=[plane, 0, 0])
+            self.addToChecksum(cubeName, plane, planeData)
+
+        if cubeName in {'DATA', 'RESET'}:
+            self.addRow(extname, hdr, planeStats(data))
+
+    def addConstantHdu(self, value, shape, dtype, hdr, extname):
+        """Fill a plane with a single value, unless the cube was created with it. """
+
+        cubeName, plane = self.checkPlane(extname, shape)
+        if cubeName in self.constantCubes:
+            if value != self.constantCubes[cubeName]:
+                raise ValueError(f'{extname} has value {value}, but the {cubeName} cube is '
+                                 f'{self.constantCubes[cubeName]}')
+        elif value != self.initialValue:
+            planeData = np.full(shape, value, dtype=self.dtype)
+            self.fits[cubeName].write(planeData[np.newaxis, ...], start=[plane, 0, 0])
+            self.addToChecksum(cubeName, plane, planeData)
+
+        if cubeName in {'DATA', 'RESET'}:
+            self.addRow(extname, hdr, constantStats(value))
+
+    def addRow(self, extname, hdr, stats):
+        row = dict(EXTNAME=extname, TIME=time.time())
+        for c in (hdr if hdr is not None else []):
+            row[c['name']] = c['value']
+        row.update(stats)
+        self.rows.append(row)
+
+    def close(self):
+        if self.rows:
+            self.fits.write(rowsToTable(self.rows), extname='READS')
+            self.finishHdu('READS', None)
+        self.rows = []
+        RampFile.close(self)
+
+class RawRampFile(RampFile):
+    layout = 'hdus'
+
+    def __init__(self, path, phdr, codecs, plan=None, reserveCards=0, rampRoot=None, logger=None,
+                 hduHeaderBlocks=2):
+        """An uncompressed 'hdus' layout ramp file, preallocated on disk.
+
+        The expected size of the whole file is calculated from the plan and
+        reserved with posix_fallocate when the file is created. Each HDU is
+        then written with pwrite at its offset: while the ramp follows the
+        plan, exactly where the plan put it. Any unused space (e.g. after
+        `ramp finish stopRamp`) is truncated away when the file is closed.
+        As for `RampFile`, the file is written to a temporary name and
+        renamed to `path` when closed.
+
+        Parameters
+        ----------
+        hduHeaderBlocks : `int`
+          Every read header is padded to this many 2880-byte blocks, so
+          that the offsets do not depend on the cards.
+        """
+
+        if plan is None:
+            raise ValueError('preallocated ramp files need a ramp plan')
+
+        self.logger = logger if logger is not None else logging.getLogger('rampFile')
+        self.path = pathlib.Path(path)
+        self.codecs = codecs
+        self.plan = plan
+
+        tmpDir = pathlib.Path(rampRoot) if rampRoot is not None else self.path.parent
+        self.tmpPath = tmpDir / f'.{self.path.name}.inprogress'
+
+        self.previous = dict()
+        self.index = []
+        self.dataSum = 0
+        self.hduHeaderBlocks = hduHeaderBlocks
+
+        self.phdu = fitsBlocks.PrimaryHeader(phdr, reserveCards=reserveCards + len(writerPhduCards))
+        self.expectedSize = self.phdu.size + self.plannedSize(plan)
+
+        self.fd = os.open(self.tmpPath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o664)
+        try:
+            os.posix_fallocate(self.fd, 0, self.expectedSize)
+        except OSError as e:
+            self.logger.warning(f'failed to preallocate {self.expectedSize} bytes for {self.tmpPath}: {e}')
+
+        self.offset = 0
+        self.write(self.phdu.toBytes())
+
+    def plannedSize(self, plan):
+        """Return the expected size of all the read HDUs in the plan. """
+
+        headerSize = self.hduHeaderBlocks * fitsBlocks.BLOCK
+        dtype = plan.get('dtype', 'u2')
+
+        imageSize = headerSize + fitsBlocks.dataSize(plan['dataShape'], dtype)
+        refShape = plan.get('refShape')
+        if refShape is None:
+            refSize = 0
+        elif plan.get('irp', True):
+            refSize = headerSize + fitsBlocks.dataSize(refShape, dtype)
+        else:
+            refSize = headerSize
+
+        return (plan['nread'] + plan.get('nreset', 0)) * (imageSize + refSize)
+
+    def write(self, buf, offset=None):
+        """Write all of buf at offset, by default at the end of what we have written. """
+
+        if offset is None:
+            self.offset = pwriteAll(self.fd, buf, self.offset)
+        else:
+            pwriteAll(self.fd, buf, offset)
+
+    def addHdu(self, data, hdr, extname):
+        if rampCodecs.isConstantPlane(data):
+            self.addConstantHdu(data.flat[0], data.shape, data.dtype, hdr, extname)
+            return
+
+        codec = self.codecs[rampCodecs.hduType(extname)]
+        cards = list(hdr) if hdr is not None else []
+        cards.extend(codec.cards())
+
+        dataBytes = fitsBlocks.dataBytes(data)
+        dataSum = fitsBlocks.onesSum(dataBytes)
+        header = fitsBlocks.checksummedHeader(fitsBlocks.structuralCards(data.shape, data.dtype, extname),
+                                              cards, dataSum, minBlocks=self.hduHeaderBlocks)
+        self.dataSum = fitsBlocks.addSums(self.dataSum, dataSum)
+        headerStart = self.offset
+        self.write(header)
+        self.write(dataBytes)
+        self.addIndexRow(extname, headerStart, headerStart + len(header), self.offset,
+                         shape=data.shape, dtype=data.dtype)
+
+    def addConstantHdu(self, value, shape, dtype, hdr, extname):
+        cards = list(hdr) if hdr is not None else []
+        cards.extend(rampCodecs.constantCards(value, shape, dtype))
+        headerStart = self.offset
+        self.write(fitsBlocks.checksummedHeader(fitsBlocks.structuralCards(extname=extname),
+                                                cards, 0, minBlocks=self.hduHeaderBlocks))
+        self.addIndexRow(extname, headerStart, self.offset, self.offset,
+                         shape=shape, dtype=dtype, codec='const', constVal=value)
+
+    def addTable(self, table, hdr, extname):
+        header, data = fitsBlocks.tableHduBytes(table, cards=list(hdr) if hdr is not None else [],
+                                                extname=extname)
+        self.dataSum = fitsBlocks.addSums(self.dataSum, fitsBlocks.onesSum(data))
+        headerStart = self.offset
+        self.write(header)
+        self.write(data)
+        self.addIndexRow(extname, headerStart, headerStart + len(header), self.offset)
+
+    def amendPHDU(self, cards):
+        self.write(self.phdu.amend(cards), offset=0)
+
+    def close(self):
+        if self.offset != self.expectedSize:
+            self.logger.info(f'{self.path} has {self.offset} bytes of reads, not the planned {self.expectedSize}')
+        self.offset = self.writeIndex(self.offset)
+        os.ftruncate(self.fd, self.offset)
+        os.close(self.fd)
+        self.previous = dict()
+        os.rename(self.tmpPath, self.path)
+
+rampFileClasses = dict(hdus=RampFile, cube=CubeRampFile)
+
+class RampWriter(multiprocessing.Process):
+    def __init__(self, inQ, outQ, codecs, layout='hdus', preallocate=True, rampRoot=None,
+                 logLevel=logging.INFO):
+        """The process which does all the actual ramp file writing.
+
+        Requests arrive on `inQ` as tuples, and are handled strictly in order:
+          ('create', path, phdr, plan, reserveCards)
+          ('hdu', data, hdr, hduId, extname)
+          ('constantHdu', value, shape, dtype, hdr, hduId, extname)
+          ('table', table, hdr, extname)
+          ('amend', cards)
+          ('finish',)
+          ('exit',)
+
+        Each request gets a reply dictionary on `outQ`, with the name of the `Ramp` reporter
+        method which should receive it as 'action'. The closedFits reply also has the
+        file's `RampFile.summary` and the statistics of each data and reset image.
+        """
+        super().__init__(name='RampWriter', daemon=True)
+
+        self.inQ = inQ
+        self.outQ = outQ
+        self.codecs = codecs
+        self.rampFileClass = rampFileClasses[layout]
+        self.preallocate = preallocate
+        self.rampRoot = rampRoot
+        self.logLevel = logLevel
+        self.rampFile = None
+        self.readStats = []
+
+    def reply(self, action, path, hduId=None, error=None, **info):
+        reply = dict(action=action, path=str(path), hduId=hduId,
+                     status='OK' if error is None else 'ERROR',
+                     errorDetails=None if error is None else str(error))
+        reply.update(info)
+        self.outQ.put(reply)
+
+    def run(self):
+        self.logger = logging.getLogger('rampWriter')
+        self.logger.setLevel(self.logLevel)
+        self.logger.info(f'starting ramp writer with codecs={self.codecs} '
+                         f'layout={self.rampFileClass.layout} rampRoot={self.rampRoot}')
+
+        while True:
+            req = self.inQ.get()
+            action, args = req[0], req[1:]
+            if action == 'exit':
+                if self.rampFile is not None:
+                    self._finish()
+                return
+            try:
+                getattr(self, f'_{action}')(*args)
+            except Exception as e:
+                path = self.rampFile.path if self.rampFile is not None else None
+                self.logger.exception(f'failed to {action} for {path}')
+                self.reply('fitsFailure', path, error=e)
+
+    def _create(self, path, phdr, plan, reserveCards):
+        if self.rampFile is not None:
+            self.logger.warning(f'closing {self.rampFile.path} before creating {path}')
+            self._finish()
+
+        fileClass = self.rampFileClass
+        if (self.preallocate and fileClass is RampFile and plan is not None
+                and all(c.name == 'none' for c in self.codecs.values())):
+            fileClass = RawRampFile
+        self.readStats = []
+        try:
+            self.rampFile = fileClass(path, phdr, self.codecs, plan=plan, reserveCards=reserveCards,
+                                      rampRoot=self.rampRoot, logger=self.logger)
+        except Exception as e:
+            self.reply('createdFits', path, error=e)
+            return
+        self.reply('createdFits', path)
+
+    def noteRead(self, extname, stats):
+        """Keep the statistics of the data and reset images, for the closedFits reply. """
+
+        if rampCodecs.hduStream(extname) in {'IMAGE', 'RESET_IMAGE'}:
+            self.readStats.append(dict(extname=extname, **stats))
+
+    def _hdu(self, data, hdr, hduId, extname):
+        t0 = time.time()
+        try:
+            self.rampFile.addHdu(data, hdr, extname)
+        except Exception as e:
+            self.reply('wroteHdu', self.rampFile.path, hduId=hduId, error=e)
+            return
+        self.noteRead(extname, planeStats(data))
+        self.reply('wroteHdu', self.rampFile.path, hduId=hduId, extname=extname,
+                   writeTime=time.time() - t0)
+
+    def _constantHdu(self, value, shape, dtype, hdr, hduId, extname):
+        try:
+            self.rampFile.addConstantHdu(value, shape, dtype, hdr, extname)
+        except Exception as e:
+            self.reply('wroteHdu', self.rampFile.path, hduId=hduId, error=e)
+            return
+        self.noteRead(extname, constantStats(value))
+        self.reply('wroteHdu', self.rampFile.path, hduId=hduId, extname=extname, writeTime=0.0)
+
+    def _table(self, table, hdr, extname):
+        try:
+            self.rampFile.addTable(table, hdr, extname)
+        except Exception as e:
+            self.reply('wroteTable', self.rampFile.path, extname=extname, error=e)
+            return
+        self.reply('wroteTable', self.rampFile.path, extname=extname, nrows=len(table))
+
+    def _amend(self, cards):
+        try:
+            self.rampFile.amendPHDU(cards)
+        except Exception as e:
+            self.reply('amendedPHDU', self.rampFile.path, error=e)
+            return
+        self.reply('amendedPHDU', self.rampFile.path)
+
+    def _finish(self):
+        rampFile, self.rampFile = self.rampFile, None
+        try:
+            rampFile.close()
+            summary = rampFile.summary()
+        except Exception as e:
+            self.reply('closedFits', rampFile.path, error=e)
+            return
+        self.reply('closedFits', rampFile.path, readStats=self.readStats, **summary)
+
+class RampBuffer(object):
+    def __init__(self, codecs=None, layout='hdus', preallocate=True, rampRoot=None,
+                 logLevel=logging.INFO):
+        """The actor side of the persistent ramp writer.
+
+        Parameters
+        ----------
+        codecs : `dict`
+          The `rampCodecs.Codec` for each HDU type. By default, RICE-compress everything.
+        layout : {'hdus', 'cube'}
+          The ramp file layout.
+        preallocate : `bool`
+          Whether to preallocate uncompressed 'hdus' layout files, whose HDUs are
+          then written at planned offsets. posix_fallocate falls back to writing zeros on filesystems
+          which cannot reserve space, so turn this off for those.
+        rampRoot : `str`
+          If set, the directory to write in-progress files to.
+        """
+
+        self.logger = logging.getLogger('rampBuffer')
+        self.logger.setLevel(logLevel)
+
+        if codecs is None:
+            codecs = rampCodecs.codecsFromConfig()
+        self.codecs = codecs
+        if layout not in rampFileClasses:
+            raise ValueError(f'unknown ramp file layout {layout!r}')
+        self.layout = layout
+
+        # Replies are routed to the reporter of the file they are about.
+        self.reporters = dict()
+
+        self.inQ = multiprocessing.Queue()
+        self.outQ = multiprocessing.Queue()
+        self.writer = RampWriter(self.inQ, self.outQ, codecs, layout=layout, preallocate=preallocate,
+                                 rampRoot=rampRoot, logLevel=logLevel)
+        self.writer.start()
+
+        self.replyThread = threading.Thread(target=self._relayReplies,
+                                            name='rampReplies', daemon=True)
+        self.replyThread.start()
+
+    def _relayReplies(self):
+        while True:
+            try:
+                reply = self.outQ.get(timeout=1.0)
+            except queue.Empty:
+                if not self.writer.is_alive():
+                    self.logger.warning('ramp writer process has exited')
+                    return
+                continue
+
+            path = reply['path']
+            action = reply.pop('action')
+            reporter = self.reporters.get(path)
+            if action == 'closedFits' or (action == 'createdFits' and reply['status'] != 'OK'):
+                self.reporters.pop(path, None)
+            if reporter is None:
+                self.logger.warning(f'no reporter for {action} reply: {reply}')
+                continue
+            try:
+                getattr(reporter, action)(reply)
+            except Exception as e:
+                self.logger.warning(f'reporter failed to handle {action} reply {reply}: {e}')
+
+    def createFile(self, rampReporter, path, phdr, plan=None, reserveCards=0):
+        """Start a new ramp file. All following HDUs and amendments go to it.
+
+        Parameters
+        ----------
+        rampReporter : `hxActor.Commands.ramp.Ramp`
+          What gets told about this file's progress.
+        path : `str`
+          The final pathname of the file.
+        phdr : list of card dicts
+          The primary header.
+        plan : `dict`
+          The expected shape of the ramp, required by the 'cube' layout:
+            nread, nreset : the number of data and reset reads to be written
+            dataShape, refShape : the (rows, cols) of the IMAGE and REF planes
+            irp : whether the REF planes have data
+            dtype : the pixel type, default 'u2'
+        reserveCards : `int`
+          How many cards later `amendPHDU` calls might add or need to rewrite. Amendments
+          are always done in place, and are refused if they do not fit.
+        """
+
+        self.reporters[str(path)] = rampReporter
+        self.inQ.put(('create', str(path), phdr, plan, reserveCards))
+
+    def addHdu(self, data, hdr, hduId=None, extname=None):
+        """Append an HDU to the current ramp file. """
+
+        self.inQ.put(('hdu', data, hdr, hduId, extname))
+
+    def addConstantHdu(self, value, shape, dtype, hdr=None, hduId=None, extname=None):
+        """Append a plane with a single value to the current ramp file, without sending the plane.
+
+        dtype can be anything `np.dtype` takes, including a type such as np.uint16.
+        """
+
+        self.inQ.put(('constantHdu', value, tuple(shape), np.dtype(dtype).str, hdr, hduId, extname))
+
+    def addTable(self, table, hdr=None, extname=None):
+        """Append a binary table HDU to the current ramp file.
+
+        Parameters
+        ----------
+        table : `np.ndarray`
+          A structured array, with numeric or fixed-length string columns.
+        hdr : list of card dicts
+          Any non-structural cards for the table header.
+        """
+
+        self.inQ.put(('table', table, hdr, extname))
+
+    def amendPHDU(self, cards):
+        """Update or add cards in the primary header of the current ramp file, in place. """
+
+        self.inQ.put(('amend', cards))
+
+    def finishFile(self):
+        """Close the current ramp file and move it to its final name. """
+
+        self.inQ.put(('finish',))
+
+    def exit(self):
+        self.inQ.put(('exit',))
+        self.writer.join(timeout=30)
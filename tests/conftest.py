@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The package lives under python/, as set up by the ups table.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'python'))
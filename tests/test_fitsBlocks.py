@@ -0,0 +1,89 @@
+import io
+import warnings
+
+import astropy.io.fits as pyfits
+import numpy as np
+
+from hxActor.rampFits import fitsBlocks
+from hxActor.rampFits import rampCodecs
+from hxActor.rampFits import rampWriter
+
+longObject = 'a long OBJECT name, which astropy has to split over CONTINUE cards: ' + 'x' * 40
+
+def openChecked(source):
+    """Open a FITS file with astropy, verifying its checksums, and treating any warning as an error. """
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        with pyfits.open(source, checksum=True) as hdul:
+            hdul.verify('exception')
+            return [(hdu.header.copy(), None if hdu.data is None else np.array(hdu.data)) for hdu in hdul]
+
+def testLongCardHeaderIsWholeBlocks():
+    cards = [dict(name='OBJECT', value=longObject, comment='object name')]
+    header, data = fitsBlocks.imageHduBytes(np.arange(12, dtype='u2').reshape(3, 4), cards,
+                                            extname='IMAGE_1')
+    assert len(header) % fitsBlocks.BLOCK == 0
+
+    phdu = fitsBlocks.PrimaryHeader(cards)
+    hdus = openChecked(io.BytesIO(phdu.toBytes() + header + data))
+    assert hdus[0][0]['OBJECT'] == longObject
+    assert hdus[1][0]['OBJECT'] == longObject
+    assert hdus[1][1].tolist() == np.arange(12).reshape(3, 4).tolist()
+
+def testRawRampFileWithLongObject(tmp_path):
+    path = tmp_path / 'PFJA00000100.fits'
+    plan = dict(nread=1, nreset=0, dataShape=(8, 16), refShape=None, irp=False, dtype='u2')
+    codecs = rampCodecs.codecsFromConfig('none')
+    phdr = [dict(name='OBJECT', value=longObject, comment='object name')]
+
+    rampFile = rampWriter.RawRampFile(path, phdr, codecs, plan=plan, reserveCards=10)
+    image = np.arange(8*16, dtype='u2').reshape(8, 16)
+    rampFile.addHdu(image, [dict(name='OBJECT', value=longObject)], 'IMAGE_1')
+    rampFile.amendPHDU([dict(name='W_H4PTCH', value=True)])
+    rampFile.close()
+
+    assert path.stat().st_size % fitsBlocks.BLOCK == 0
+    hdus = openChecked(path)
+    assert hdus[0][0]['OBJECT'] == longObject
+    assert hdus[0][0]['W_H4PTCH'] is True
+    assert np.array_equal(hdus[1][1], image)
+
+def testPrimaryHeaderCountsContinueCards():
+    phdu = fitsBlocks.PrimaryHeader([dict(name='OBJECT', value='short')], reserveCards=0)
+    size = phdu.size
+    free = phdu.freeCards
+
+    # Each of these needs two 80-byte cards.
+    longCards = [dict(name=f'W_DSGN{i:02d}', value=longObject) for i in range(free // 2)]
+    assert len(fitsBlocks.cardImages(longCards[:1])) == 2
+    header = phdu.amend(longCards)
+    assert len(header) == size
+    assert phdu.freeCards == free - 2*len(longCards)
+    hdus = openChecked(io.BytesIO(header))
+    assert hdus[0][0]['W_DSGN00'] == longObject
+
+    # At most one card is left, so a new long card does not fit, and is refused.
+    try:
+        phdu.amend([dict(name='W_DSGNXX', value=longObject)])
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('an amendment which does not fit was accepted')
+    assert len(phdu.toBytes()) == size
+
+def testRampFileWithLongDesignName(tmp_path):
+    path = tmp_path / 'PFJA00000101.fits'
+    codecs = rampCodecs.codecsFromConfig('none')
+    phdr = [dict(name='OBJECT', value=longObject),
+            dict(name='W_DSGNNM', value='design ' + longObject, comment='pfsDesign name')]
+
+    rampFile = rampWriter.RampFile(path, phdr, codecs, reserveCards=10)
+    image = np.arange(8*16, dtype='u2').reshape(8, 16)
+    rampFile.addHdu(image, [], 'IMAGE_1')
+    rampFile.amendPHDU([dict(name='W_H4PTCH', value=True)])
+    rampFile.close()
+
+    hdus = openChecked(path)
+    assert hdus[0][0]['W_DSGNNM'] == 'design ' + longObject
+    assert np.array_equal(hdus[1][1], image)
@@ -0,0 +1,50 @@
+import types
+
+import pytest
+
+opticslab = pytest.importorskip('hxActor.Commands.opticslab')
+
+class RecordingCmd(object):
+    """Stands in for an actor command, keeping every reply. """
+
+    def __init__(self):
+        self.replies = []
+
+    def __getattr__(self, level):
+        return lambda text='': self.replies.append((level, text))
+
+def makeSampler(lamp, nSamples):
+    sampler = opticslab.PhotodiodeSampler(readCurrent=lambda: 1e-9)
+    sampler.startSampling(lamp)
+    for i in range(nSamples):
+        sampler.times[i] = 100.0 + i
+        sampler.currents[i] = 1e-9
+    sampler.nSamples = nSamples
+    return sampler
+
+@pytest.mark.parametrize('lamp, nSamples', [(0, 0), (0, 1), (99, 5)])
+def testSummaryWithoutFlux(lamp, nSamples):
+    samples = makeSampler(lamp, nSamples).stopSampling()
+    assert samples.integratedFlux() is None
+    assert samples.summary() == f'{nSamples} samples (0 dropped, 0 failed reads), no integrated flux'
+    assert all(c['value'] is not None for c in samples.cards() if c['name'] == 'W_OLNSMP')
+
+def testSummaryWithFlux():
+    samples = makeSampler(0, 3).stopSampling()
+    assert samples.summary() == ('3 samples (0 dropped, 0 failed reads), integrated flux %g photons' %
+                                 (2 * 1e-9 * opticslab.lamps[0][1]))
+
+@pytest.mark.parametrize('lamp, nSamples', [(0, 0), (0, 1), (99, 5)])
+def testStopPhotodiodeWithoutFlux(lamp, nSamples):
+    """The ramp-close path must survive lamps with no integrated flux. """
+
+    HxCmd = pytest.importorskip('hxActor.Commands.HxCmd')
+
+    sampler = makeSampler(lamp, nSamples)
+    hxCmd = types.SimpleNamespace(actor=types.SimpleNamespace(photodiodeSampler=sampler), lampSamples=None)
+    cmd = RecordingCmd()
+    HxCmd.HxCmd.stopPhotodiode(hxCmd, cmd)
+
+    assert len(hxCmd.lampSamples) == nSamples
+    assert cmd.replies == [('inform', f'text="photodiode: {nSamples} samples (0 dropped, 0 failed reads), '
+                                      f'no integrated flux"')]
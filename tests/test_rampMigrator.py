@@ -0,0 +1,36 @@
+import threading
+
+from hxActor.rampFits import rampMigrator
+
+def testClosedButNotQueuedIsMigrated(tmp_path):
+    """A file closed in staging just before a restart, with no `enqueue`, is still migrated. """
+
+    stagingRoot = tmp_path / 'staging'
+    finalPath = tmp_path / 'butler' / 'PFJA00000105.fits'
+
+    migrator = rampMigrator.RampMigrator(stagingRoot)
+    stagedPath = migrator.stagedPath(finalPath)
+    migrator.expect(stagedPath, finalPath)
+    assert migrator.status()['nQueued'] == 0
+    stagedPath.write_bytes(b'ramp' * 720)
+    del migrator
+
+    migrated = []
+    done = threading.Event()
+
+    def migratedCB(staged, final):
+        migrated.append((staged, final))
+        done.set()
+
+    migrator = rampMigrator.RampMigrator(stagingRoot, migratedCB=migratedCB)
+    assert migrator.status()['nQueued'] == 1
+    migrator.start()
+    try:
+        assert done.wait(10)
+    finally:
+        migrator.exit()
+        migrator.join(10)
+
+    assert migrated == [(str(stagedPath), str(finalPath))]
+    assert finalPath.read_bytes() == b'ramp' * 720
+    assert not stagedPath.exists()
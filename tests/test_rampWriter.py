@@ -0,0 +1,125 @@
+import threading
+
+import numpy as np
+import pytest
+
+from hxActor.rampFits import rampCodecs
+from hxActor.rampFits import rampReader
+from hxActor.rampFits import rampWriter
+
+class RecordingReporter(object):
+    """Stands in for `hxActor.Commands.ramp.Ramp`, keeping every reply. """
+
+    def __init__(self):
+        self.replies = []
+        self.closed = threading.Event()
+
+    def _record(self, action, reply):
+        self.replies.append((action, reply))
+        if action == 'closedFits':
+            self.closed.set()
+
+    def __getattr__(self, action):
+        return lambda reply: self._record(action, reply)
+
+    def failures(self):
+        return [(action, reply) for action, reply in self.replies if reply.get('status') != 'OK']
+
+@pytest.mark.parametrize('withPlan', [False, True])
+def testConstantHduRoundTrip(tmp_path, withPlan):
+    """Write the empty reset read HDUs as `HxCmd.writeSingleRead` does when image is None. """
+
+    shape, refShape = (8, 16), (8, 4)
+    plan = dict(nread=1, nreset=1, dataShape=shape, refShape=refShape, irp=True, dtype='u2')
+    path = tmp_path / 'PFJA00000102.fits'
+
+    rampBuffer = rampWriter.RampBuffer(codecs=rampCodecs.codecsFromConfig('none'))
+    try:
+        reporter = RecordingReporter()
+        rampBuffer.createFile(reporter, path, [dict(name='OBJECT', value='constant test')],
+                              plan=plan if withPlan else None)
+        rampBuffer.addConstantHdu(0, shape, np.uint16, [dict(name='W_H4READ', value=0)],
+                                  hduId=(0, 0, 1), extname='RESET_IMAGE_1')
+        rampBuffer.addConstantHdu(0, refShape, np.uint16, None,
+                                  hduId=(0, 0, None), extname='RESET_REF_1')
+        image = np.arange(8*16, dtype='u2').reshape(shape)
+        rampBuffer.addHdu(image, None, hduId=(0, 1, 1), extname='IMAGE_1')
+        rampBuffer.addConstantHdu(7, refShape, np.dtype('u2'), None, hduId=(0, 1, None), extname='REF_1')
+        rampBuffer.finishFile()
+        assert reporter.closed.wait(30)
+    finally:
+        rampBuffer.exit()
+        rampBuffer.writer.join(10)
+
+    assert reporter.failures() == []
+    with rampReader.RampReader(path) as ramp:
+        resetImage = ramp.read(1, reset=True)
+        assert resetImage.dtype == np.uint16
+        assert resetImage.shape == shape and not resetImage.any()
+        assert ramp.read(1, ref=True, reset=True).shape == refShape
+        assert np.array_equal(ramp.read(1), image)
+        assert (ramp.read(1, ref=True) == 7).all()
+
+def testCubeKeepsFormatVersion(tmp_path):
+    """The cube layout is named by W_4LAYOU alone: W_4FMTVR is written as given. """
+
+    shape = (8, 16)
+    plan = dict(nread=2, nreset=0, dataShape=shape, refShape=None, irp=False, dtype='u2')
+    path = tmp_path / 'PFJA00000103.fits'
+
+    rampBuffer = rampWriter.RampBuffer(codecs=rampCodecs.codecsFromConfig('none'), layout='cube')
+    try:
+        reporter = RecordingReporter()
+        rampBuffer.createFile(reporter, path, [dict(name='W_4FMTVR', value=3)], plan=plan)
+        for n in 1, 2:
+            image = np.full(shape, n, dtype='u2')
+            rampBuffer.addHdu(image, None, hduId=(0, n, 1), extname=f'IMAGE_{n}')
+        rampBuffer.finishFile()
+        assert reporter.closed.wait(30)
+    finally:
+        rampBuffer.exit()
+        rampBuffer.writer.join(10)
+
+    assert reporter.failures() == []
+    with rampReader.RampReader(path) as ramp:
+        assert ramp.phdr['W_4FMTVR'] == 3
+        assert ramp.layout == 'cube'
+        assert ramp.nreads == 2
+        assert (ramp.read(2) == 2).all()
+
+def testRawRampFileRenamedOnClose(tmp_path):
+    """Preallocated files are written in rampRoot and only appear at their path when closed. """
+
+    rampRoot = tmp_path / 'staging'
+    rampRoot.mkdir()
+    path = tmp_path / 'PFJA00000104.fits'
+    plan = dict(nread=1, nreset=0, dataShape=(8, 16), refShape=None, irp=False, dtype='u2')
+
+    rampFile = rampWriter.RawRampFile(path, [dict(name='OBJECT', value='rename test')],
+                                      rampCodecs.codecsFromConfig('none'), plan=plan, rampRoot=rampRoot)
+    assert rampFile.tmpPath.parent == rampRoot
+    image = np.arange(8*16, dtype='u2').reshape(8, 16)
+    rampFile.addHdu(image, None, 'IMAGE_1')
+    assert rampFile.tmpPath.exists() and not path.exists()
+
+    rampFile.close()
+    assert path.exists() and not rampFile.tmpPath.exists()
+    with rampReader.RampReader(path) as ramp:
+        assert np.array_equal(ramp.read(1), image)
+
+def testCubeRefusesMismatchedPlane(tmp_path):
+    """A read smaller than the planned frame is refused, not written into the wrong rows. """
+
+    plan = dict(nread=2, nreset=0, dataShape=(8, 16), refShape=None, irp=False, dtype='u2')
+    rampFile = rampWriter.CubeRampFile(tmp_path / 'PFJA00000106.fits', [], rampCodecs.codecsFromConfig('none'),
+                                       plan=plan)
+    try:
+        with pytest.raises(ValueError, match='shape'):
+            rampFile.addHdu(np.ones((4, 16), dtype='u2'), None, 'IMAGE_1')
+        with pytest.raises(ValueError, match='shape'):
+            rampFile.addConstantHdu(1, (4, 16), np.uint16, None, 'IMAGE_1')
+        with pytest.raises(ValueError, match='beyond'):
+            rampFile.addHdu(np.ones((8, 16), dtype='u2'), None, 'IMAGE_3')
+        rampFile.addHdu(np.ones((8, 16), dtype='u2'), None, 'IMAGE_1')
+    finally:
+        rampFile.close()
@@ -0,0 +1,37 @@
+import warnings
+
+import astropy.io.fits as pyfits
+import numpy as np
+
+from hxActor.charis import readStacker
+from hxActor.rampFits import fitsBlocks
+
+longCard = 'an IDL/Gen2 string card, long enough that astropy needs CONTINUE cards: ' + 'y' * 40
+
+def writeRead(path, n):
+    image = (np.arange(6*10, dtype='u2') + 1000*n).reshape(6, 10)
+    hdr = pyfits.Header()
+    hdr['OBJECT'] = longCard
+    hdr['READN'] = n
+    pyfits.PrimaryHDU(image, header=hdr).writeto(path)
+    return image
+
+def testStackLongStringCards(tmp_path):
+    images = [writeRead(tmp_path / f'read{n}.fits', n) for n in range(1, 4)]
+    outfile = tmp_path / 'stack.fits'
+
+    with readStacker.ReadStacker(str(outfile), [dict(name='PROPOSAL', value=longCard)]) as stacker:
+        for n in range(1, 4):
+            stacker.addRead(tmp_path / f'read{n}.fits')
+
+    assert outfile.stat().st_size % fitsBlocks.BLOCK == 0
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        with pyfits.open(outfile, checksum=True) as hdul:
+            hdul.verify('exception')
+            assert hdul[0].header['PROPOSAL'] == longCard
+            assert len(hdul) == 4
+            for n, image in enumerate(images, start=1):
+                assert hdul[n].header['OBJECT'] == longCard
+                assert hdul[n].header['READN'] == n
+                assert np.array_equal(hdul[n].data, image)